@@ -0,0 +1,188 @@
+"""Admission control: caps on concurrent tunnels with a bounded wait queue.
+
+Every CONNECT takes a slot from its account's limiter and then from the
+global limiter before the upstream socket is opened, and gives both back
+when the tunnel closes. When a limiter is full the connection waits in
+its queue for up to queue_timeout seconds; if the queue itself is full,
+or the wait times out, the connection is rejected (SOCKS5 reply 0x05 /
+0x01, HTTP 503) instead of piling more sockets onto Tor.
+
+Config (optional, top level of config.json; max_tunnels and queue_timeout
+0 mean unlimited, queue_size 0 rejects instead of queueing):
+
+    "admission": {"max_tunnels": 512, "queue_size": 128, "queue_timeout": 5,
+                  "per_account": {"max_tunnels": 128, "queue_size": 32, "queue_timeout": 5}}
+
+An account can override "per_account" with its own "admission" object.
+"""
+import asyncio
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_TUNNELS = 0
+DEFAULT_QUEUE_SIZE = 64
+DEFAULT_QUEUE_TIMEOUT = 5.0
+
+REASON_QUEUE_FULL = "queue_full"
+REASON_TIMEOUT = "timeout"
+
+
+class Rejected(Exception):
+    """No slot could be had; reason is REASON_QUEUE_FULL or REASON_TIMEOUT"""
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+class Limiter:
+    """Counting semaphore with a bounded FIFO wait queue"""
+
+    def __init__(self, name, max_tunnels=DEFAULT_MAX_TUNNELS, queue_size=DEFAULT_QUEUE_SIZE,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.name = name
+        self.max_tunnels = max_tunnels
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters = collections.deque()
+        self.admitted = 0
+        self.rejected = {REASON_QUEUE_FULL: 0, REASON_TIMEOUT: 0}
+
+    def __repr__(self):
+        return f"Limiter({self.name}, {self.active}/{self.max_tunnels or 'unlimited'})"
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "queued": len(self.waiters),
+            "max_tunnels": self.max_tunnels,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected[REASON_QUEUE_FULL],
+            "rejected_timeout": self.rejected[REASON_TIMEOUT],
+        }
+
+    def update(self, max_tunnels, queue_size, queue_timeout):
+        self.max_tunnels = max_tunnels
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        # A raised limit admits waiters right away
+        while self.waiters and self._has_room():
+            self._hand_over()
+
+    def _has_room(self):
+        return self.max_tunnels <= 0 or self.active < self.max_tunnels
+
+    def _hand_over(self):
+        """Give a free slot to the first live waiter; False if there was none"""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+                return True
+        return False
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        raise Rejected(f"{self.name}: {self.active} tunnels active, "
+                       f"{len(self.waiters)} queued ({reason})", reason)
+
+    async def acquire(self):
+        if not self.waiters and self._has_room():
+            self.active += 1
+            self.admitted += 1
+            return
+        if len(self.waiters) >= self.queue_size:
+            self._reject(REASON_QUEUE_FULL)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await asyncio.wait([waiter], timeout=self.queue_timeout if self.queue_timeout > 0 else None)
+        except BaseException:
+            # Cancelled while queued: give back a slot handed over meanwhile
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            else:
+                waiter.cancel()
+                self.waiters.remove(waiter)
+            raise
+        if not waiter.done():
+            waiter.cancel()
+            self.waiters.remove(waiter)
+            self._reject(REASON_TIMEOUT)
+        self.admitted += 1
+
+    def release(self):
+        self.active -= 1
+        if self._has_room():
+            self._hand_over()
+
+
+class Ticket:
+    """Slots held by one tunnel; release() is idempotent"""
+    __slots__ = ("limiters",)
+
+    def __init__(self, limiters):
+        self.limiters = limiters
+
+    def release(self):
+        limiters, self.limiters = self.limiters, ()
+        for limiter in limiters:
+            limiter.release()
+
+
+_settings = {}
+_global = Limiter("global")
+_accounts = {}
+
+
+def _account_limits(account_config):
+    limits = dict(_settings.get("per_account", {}))
+    limits.update(account_config.get("admission", {}))
+    return (limits.get("max_tunnels", DEFAULT_MAX_TUNNELS),
+            limits.get("queue_size", DEFAULT_QUEUE_SIZE),
+            limits.get("queue_timeout", DEFAULT_QUEUE_TIMEOUT))
+
+
+def configure(config):
+    """Apply the config's "admission" limits; existing limiters keep their tunnels"""
+    global _settings
+    _settings = config.get("admission", {})
+    _global.update(_settings.get("max_tunnels", DEFAULT_MAX_TUNNELS),
+                   _settings.get("queue_size", DEFAULT_QUEUE_SIZE),
+                   _settings.get("queue_timeout", DEFAULT_QUEUE_TIMEOUT))
+    for email, account_config in config.get("accounts", {}).items():
+        if email in _accounts:
+            _accounts[email].update(*_account_limits(account_config))
+
+
+def _limiter_for(account_config):
+    email = account_config["email"]
+    limiter = _accounts.get(email)
+    if limiter is None:
+        limiter = _accounts[email] = Limiter(email, *_account_limits(account_config))
+    return limiter
+
+
+async def admit(account_config):
+    """Wait for an account slot and a global slot; raises Rejected"""
+    account = _limiter_for(account_config)
+    await account.acquire()
+    try:
+        await _global.acquire()
+    except BaseException:
+        account.release()
+        raise
+    return Ticket((account, _global))
+
+
+def stats():
+    """Limiter stats: {"global": {...}, "accounts": {email: {...}}}"""
+    return {
+        "global": _global.stats(),
+        "accounts": {email: limiter.stats() for email, limiter in _accounts.items()},
+    }
@@ -0,0 +1,330 @@
+"""Per-account bandwidth limits and weighted fair sharing of an upstream.
+
+Every account has a token bucket per direction (up = client to target),
+shared by all of its tunnels. The relay charges each chunk it moved to
+the bucket after writing it; an account over its rate waits before its
+tunnels read again, so its average stays at the limit while bursts of up
+to burst seconds' worth of bytes go through untouched.
+
+Accounts routed through the same upstream share one Tor client. When the
+upstream's capacity is given, chunks are also charged to that upstream's
+link: while it has capacity left they pass, once it is saturated the
+waiting reads of all accounts are served in start-time fair queueing
+order, so each busy account gets bandwidth in proportion to its weight
+and a bulk download cannot starve interactive traffic of the others.
+Capacity an account does not use goes to the rest.
+
+Config (optional; rates in bytes/s, 0 means unlimited):
+
+    "bandwidth": {"up": 0, "down": 0, "burst": 1.0,
+                  "upstreams": {"Tor": {"up": 250000, "down": 1500000}}}
+
+An account can override "up", "down" and its "weight" (default 1, must be
+above 0) with its own "bandwidth" object. Upstreams are matched by name.
+A config reload updates the buckets and links of open tunnels in place
+and forgets removed accounts. Current rates are served as JSON on GET
+/bandwidth of the metrics listener and exported as gauges.
+"""
+import asyncio
+import heapq
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+UP = "up"
+DOWN = "down"
+DIRECTIONS = (UP, DOWN)
+DEFAULT_RATE = 0
+DEFAULT_BURST = 1.0
+DEFAULT_WEIGHT = 1.0
+# Rates are averaged over at least this many seconds
+RATE_WINDOW = 5.0
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def _timer(delay):
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+    loop.call_later(delay, _wake, waiter)
+    return waiter
+
+
+class RateMeter:
+    """Bytes counter with a rate averaged over RATE_WINDOW to twice that"""
+    __slots__ = ("sent", "_samples")
+
+    def __init__(self):
+        self.sent = 0
+        now = time.monotonic()
+        self._samples = ((now, 0), (now, 0))   # (time, bytes) older and newer
+
+    def rate(self, now):
+        older, newer = self._samples
+        if now - newer[0] >= RATE_WINDOW:
+            older, newer = newer, (now, self.sent)
+            self._samples = (older, newer)
+        elapsed = now - older[0]
+        return (self.sent - older[1]) / elapsed if elapsed > 0 else 0.0
+
+
+class TokenBucket(RateMeter):
+    """One account's limit in one direction.
+
+    Chunks are charged after they moved, so the bucket can go into debt;
+    charge() returns how long the account has to wait until it is paid off.
+    """
+    __slots__ = ("limit", "burst", "tokens", "updated", "throttled")
+
+    def __init__(self, limit=DEFAULT_RATE, burst=DEFAULT_BURST):
+        super().__init__()
+        self.limit = limit
+        self.burst = limit * burst
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.throttled = 0
+
+    def __repr__(self):
+        return f"TokenBucket({self.limit or 'unlimited'} B/s, {self.tokens:.0f} B)"
+
+    def update(self, limit, burst):
+        self.limit = limit
+        self.burst = limit * burst
+        self.tokens = min(self.tokens, self.burst)
+
+    def charge(self, n):
+        self.sent += n
+        if self.limit <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.limit) - n
+        self.updated = now
+        if self.tokens >= 0:
+            return 0.0
+        self.throttled += 1
+        return -self.tokens / self.limit
+
+
+class Share:
+    """An account's place in an upstream link's fair queue"""
+    __slots__ = ("weight", "finish")
+
+    def __init__(self, weight):
+        self.weight = weight
+        self.finish = 0.0   # virtual time its last queued chunk ends at
+
+
+class Link(RateMeter):
+    """One direction of an upstream, shared by the accounts routed through it"""
+    __slots__ = ("name", "capacity", "burst", "tokens", "updated", "virtual", "waiters", "timer", "shares",
+                 "queued", "_seq")
+
+    def __init__(self, name, capacity=DEFAULT_RATE, burst=DEFAULT_BURST):
+        super().__init__()
+        self.name = name
+        self.capacity = capacity
+        self.burst = capacity * burst
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.virtual = 0.0
+        self.waiters = []        # heap of (start tag, seq, bytes, future)
+        self.timer = None
+        self.shares = {}         # email -> Share
+        self.queued = 0
+        self._seq = 0
+
+    def __repr__(self):
+        return f"Link({self.name}, {self.capacity or 'unlimited'} B/s, {len(self.waiters)} waiting)"
+
+    def share_for(self, email, weight):
+        share = self.shares.get(email)
+        if share is None:
+            share = self.shares[email] = Share(weight)
+        return share
+
+    def update(self, capacity, burst):
+        self.capacity = capacity
+        self.burst = capacity * burst
+        self.tokens = min(self.tokens, self.burst)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if capacity <= 0:
+            # Now unlimited: nobody waits any more
+            while self.waiters:
+                _wake(heapq.heappop(self.waiters)[3])
+        else:
+            self._release()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.capacity)
+        self.updated = now
+
+    def request(self, share, n):
+        """Charge n bytes; None if the account may go on, else a future to wait for"""
+        self.sent += n
+        if self.capacity <= 0:
+            return None
+        self._refill(time.monotonic())
+        start = max(self.virtual, share.finish)
+        share.finish = start + n / share.weight
+        if not self.waiters and self.tokens >= 0:
+            self.tokens -= n
+            self.virtual = start
+            return None
+        waiter = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        self.queued += 1
+        heapq.heappush(self.waiters, (start, self._seq, n, waiter))
+        self._schedule()
+        return waiter
+
+    def _schedule(self):
+        if self.waiters and self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(max(0.0, -self.tokens / self.capacity),
+                                                                self._release)
+
+    def _release(self):
+        """Let queued chunks go in fair order while the link has capacity"""
+        self.timer = None
+        self._refill(time.monotonic())
+        while self.waiters and self.tokens >= 0:
+            start, _, n, waiter = heapq.heappop(self.waiters)
+            # A cancelled waiter's bytes moved all the same
+            self.tokens -= n
+            self.virtual = start
+            _wake(waiter)
+        self._schedule()
+
+
+class Shaper:
+    """One account's traffic in one direction through one upstream"""
+    __slots__ = ("bucket", "link", "share")
+
+    def __init__(self, bucket, link, share):
+        self.bucket = bucket
+        self.link = link
+        self.share = share
+
+    def __repr__(self):
+        return f"Shaper({self.bucket!r}, {self.link!r})"
+
+    def charge(self, n):
+        """Count n relayed bytes; None if the next read may start now, else a future done once it may"""
+        delay = self.bucket.charge(n)
+        queued = self.link.request(self.share, n)
+        if delay <= 0:
+            return queued
+        waiter = _timer(delay)
+        return waiter if queued is None else asyncio.gather(waiter, queued)
+
+
+_settings = {}
+_weights = {}    # email -> weight
+_buckets = {}    # (email, direction) -> TokenBucket
+_links = {}      # (upstream name, direction) -> Link
+_shapers = {}    # (email, upstream name, direction) -> Shaper
+
+
+def _burst():
+    return _settings.get("burst", DEFAULT_BURST)
+
+
+def _account_settings(account_config):
+    settings = {key: _settings[key] for key in DIRECTIONS if key in _settings}
+    settings.update(account_config.get("bandwidth", {}))
+    return settings
+
+
+def _capacity(name, direction):
+    return _settings.get("upstreams", {}).get(name, {}).get(direction, DEFAULT_RATE)
+
+
+def _weight(email, account_config):
+    weight = _account_settings(account_config).get("weight", DEFAULT_WEIGHT)
+    if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not weight > 0:
+        logger.warning(f"Invalid bandwidth weight {weight!r} for {email}, using {DEFAULT_WEIGHT:g}")
+        return DEFAULT_WEIGHT
+    return weight
+
+
+def configure(config):
+    """Apply the config's "bandwidth" section; open tunnels' shapers change in place"""
+    global _settings, _weights
+    _settings = config.get("bandwidth", {})
+    accounts = config.get("accounts", {})
+    _weights = {email: _weight(email, acc_config) for email, acc_config in accounts.items()}
+    # Tunnels of removed accounts keep their shapers until they close
+    for key in [key for key in _shapers if key[0] not in accounts]:
+        del _shapers[key]
+    for key in [key for key in _buckets if key[0] not in accounts]:
+        del _buckets[key]
+    for (email, direction), bucket in _buckets.items():
+        bucket.update(_account_settings(accounts[email]).get(direction, DEFAULT_RATE), _burst())
+    for (name, direction), link in _links.items():
+        for email in [email for email in link.shares if email not in accounts]:
+            del link.shares[email]
+        for email, share in link.shares.items():
+            share.weight = _weights[email]
+        link.update(_capacity(name, direction), _burst())
+
+
+def shaper_for(account_config, upstream, direction):
+    """Shaper for an account's tunnels through upstream (created on first use)"""
+    email = account_config["email"]
+    key = (email, upstream["name"], direction)
+    shaper = _shapers.get(key)
+    if shaper is None:
+        settings = _account_settings(account_config)
+        bucket = _buckets.get((email, direction))
+        if bucket is None:
+            bucket = _buckets[email, direction] = TokenBucket(settings.get(direction, DEFAULT_RATE), _burst())
+        link = _links.get((upstream["name"], direction))
+        if link is None:
+            link = _links[upstream["name"], direction] = Link(
+                upstream["name"], _capacity(upstream["name"], direction), _burst())
+        share = link.share_for(email, _weights.get(email, DEFAULT_WEIGHT))
+        shaper = _shapers[key] = Shaper(bucket, link, share)
+    return shaper
+
+
+def shapers_for(account_config, upstream):
+    """(up, down) shapers of a tunnel"""
+    return shaper_for(account_config, upstream, UP), shaper_for(account_config, upstream, DOWN)
+
+
+def bandwidth_stats():
+    """Limits and current rates: {"accounts": {email: {direction: {...}}}, "upstreams": {name: {...}}}"""
+    now = time.monotonic()
+    accounts = {}
+    for (email, direction), bucket in _buckets.items():
+        accounts.setdefault(email, {})[direction] = {
+            "limit": bucket.limit,
+            "rate": round(bucket.rate(now)),
+            "bytes": bucket.sent,
+            "throttled": bucket.throttled,
+        }
+    upstreams = {}
+    for (name, direction), link in _links.items():
+        upstreams.setdefault(name, {})[direction] = {
+            "capacity": link.capacity,
+            "rate": round(link.rate(now)),
+            "bytes": link.sent,
+            "waiting": len(link.waiters),
+            "queued": link.queued,
+            "weights": {email: share.weight for email, share in link.shares.items()},
+        }
+    return {"accounts": accounts, "upstreams": upstreams}
+
+
+def totals():
+    """Process-wide counters for worker_stats()"""
+    return {
+        "throttled": sum(bucket.throttled for bucket in _buckets.values()),
+        "queued": sum(link.queued for link in _links.values()),
+        "waiting": sum(len(link.waiters) for link in _links.values()),
+    }
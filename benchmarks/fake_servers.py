@@ -0,0 +1,160 @@
+"""Local stand-in servers used by the benchmarks"""
+import asyncio
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import socks5
+
+BULK_CHUNK = bytes(65536)
+
+# handler task -> its client writer, for close_servers()
+_handlers = {}
+
+
+def _tracked(handle):
+    """Wrap a client handler so close_servers() can end it"""
+    async def run(reader, writer):
+        task = asyncio.current_task()
+        _handlers[task] = writer
+        try:
+            await handle(reader, writer)
+        finally:
+            del _handlers[task]
+    return run
+
+
+async def close_servers(*servers):
+    """Stop the servers and end every fake server connection still open.
+
+    Closing a handler's connection ends its read or drain, so each one
+    returns normally instead of being cancelled at loop shutdown.
+    """
+    for server in servers:
+        server.close()
+    tasks = list(_handlers)
+    for writer in _handlers.values():
+        writer.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def start_bulk_server(total_bytes, host="127.0.0.1"):
+    """Server that sends total_bytes to every client and then closes"""
+    async def handle(reader, writer):
+        try:
+            remaining = total_bytes
+            while remaining > 0:
+                chunk = BULK_CHUNK if remaining >= len(BULK_CHUNK) else BULK_CHUNK[:remaining]
+                writer.write(chunk)
+                await writer.drain()
+                remaining -= len(chunk)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(_tracked(handle), host, 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def start_echo_server(host="127.0.0.1"):
+    """Server that echoes everything back"""
+    async def handle(reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(_tracked(handle), host, 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def delayed_reader(reader, delay):
+    """StreamReader that sees the peer's bytes `delay` seconds late.
+
+    Models the network round trip between the proxy and Tor: a lock-step
+    handshake pays it once per exchange, a pipelined one only once.
+    """
+    if delay <= 0:
+        return reader, None
+    loop = asyncio.get_running_loop()
+    delayed = asyncio.StreamReader()
+
+    async def pump():
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                loop.call_later(delay, delayed.feed_data, data)
+        except (ConnectionError, OSError):
+            pass
+        loop.call_later(delay, delayed.feed_eof)
+
+    return delayed, asyncio.create_task(pump())
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_fake_socks_server(latency=0.0, connect_delay=0.0, failure_rate=0.0, host="127.0.0.1"):
+    """Stand-in for Tor's SOCKS port.
+
+    latency delays every byte the server receives (network round trip),
+    connect_delay is added before each CONNECT reply (circuit setup) and
+    failure_rate is the fraction of CONNECTs answered with 0x05. Successful
+    CONNECTs are forwarded to the requested host:port.
+    """
+    async def handle(raw_reader, writer):
+        reader, pump = delayed_reader(raw_reader, latency)
+        try:
+            await socks5.read_frame(reader, socks5.greeting_length)
+            writer.write(bytes([socks5.VERSION, socks5.METHOD_NO_AUTH]))
+            request = await socks5.read_frame(reader, socks5.request_length)
+            _, _, dst_host, dst_port = socks5.parse_request(request)
+
+            if connect_delay:
+                await asyncio.sleep(connect_delay)
+            if failure_rate and random.random() < failure_rate:
+                writer.write(socks5.socks_reply(socks5.REP_CONNECTION_REFUSED))
+                await writer.drain()
+                return
+            try:
+                target_reader, target_writer = await asyncio.open_connection(dst_host, dst_port)
+            except OSError:
+                writer.write(socks5.socks_reply(socks5.REP_CONNECTION_REFUSED))
+                await writer.drain()
+                return
+
+            writer.write(socks5.socks_reply(socks5.REP_SUCCESS))
+            await writer.drain()
+            await asyncio.gather(_pipe(reader, target_writer), _pipe(target_reader, writer))
+        except (asyncio.IncompleteReadError, socks5.Socks5Error, ConnectionError, OSError):
+            pass
+        finally:
+            if pump is not None:
+                pump.cancel()
+            writer.close()
+
+    server = await asyncio.start_server(_tracked(handle), host, 0)
+    return server, server.sockets[0].getsockname()[1]
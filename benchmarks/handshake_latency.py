@@ -0,0 +1,124 @@
+"""Handshake latency through a tor upstream, lock-step vs pipelined vs pooled.
+
+Runs both proxies against a local fake Tor SOCKS server whose input is
+delayed by --latency-ms, and measures the time from the client's TCP
+connect to the proxy's success reply.
+
+    python3 benchmarks/handshake_latency.py --latency-ms 5 --count 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import socks5
+import tor_pool
+from swiss_proxy_stream import SwissProxy
+from swiss_socks5_proxy import SwissSOCKS5Proxy
+
+from fake_servers import close_servers, start_echo_server, start_fake_socks_server
+
+MODES = {
+    # Pre-change behaviour: fresh socket, greeting, wait, CONNECT, wait
+    "lockstep": {"pool_size": 0, "pipelined": False},
+    "pipelined": {"pool_size": 0, "pipelined": True},
+    "pooled": {"pool_size": 8},
+}
+
+
+async def socks_handshake(port, dst_port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(socks5.GREETING_NO_AUTH)
+    await reader.readexactly(2)
+    writer.write(socks5.build_connect_request("127.0.0.1", dst_port, socks5.ATYP_IPV4))
+    reply = await socks5.read_frame(reader, socks5.reply_length)
+    writer.close()
+    return reply[1] == socks5.REP_SUCCESS
+
+
+async def http_handshake(port, dst_port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"CONNECT 127.0.0.1:{dst_port} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".encode())
+    head = await reader.readuntil(b"\r\n\r\n")
+    writer.close()
+    return b" 200 " in head
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run_case(proxy_cls, mode, args, echo_port):
+    fake, fake_port = await start_fake_socks_server(latency=args.latency_ms / 1000)
+    upstream = {"type": "tor", "name": "fake tor", "socks_host": "127.0.0.1",
+                "socks_port": fake_port, **MODES[mode]}
+    account = {"email": "bench@example.com", "original_port": 0, "http_port": 0,
+               "proxy_port": 0, "upstream": upstream}
+    proxy = proxy_cls({"accounts": {}}, allocate_ports=False)
+    server = await asyncio.start_server(proxy.create_client_handler(0, account), "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    handshake = socks_handshake if proxy_cls is SwissSOCKS5Proxy else http_handshake
+
+    # Let the pool warm up before measuring
+    await handshake(port, echo_port)
+    await asyncio.sleep(0.2 + 4 * args.latency_ms / 1000)
+
+    samples = []
+    for _ in range(args.count):
+        start = time.perf_counter()
+        if not await handshake(port, echo_port):
+            raise RuntimeError(f"{proxy_cls.__name__}/{mode}: handshake failed")
+        samples.append((time.perf_counter() - start) * 1000)
+        if mode == "pooled":
+            # Give the background refill a chance, as real traffic would
+            await asyncio.sleep(2 * args.latency_ms / 1000)
+
+    server.close()
+    await tor_pool.get_pool(upstream).close()
+    await close_servers(fake)
+    return {
+        "proxy": proxy_cls.__name__,
+        "mode": mode,
+        "latency_ms": args.latency_ms,
+        "count": args.count,
+        "p50_ms": round(percentile(samples, 50), 3),
+        "p99_ms": round(percentile(samples, 99), 3),
+        "mean_ms": round(statistics.mean(samples), 3),
+    }
+
+
+async def main_async(args):
+    echo, echo_port = await start_echo_server()
+    results = []
+    for proxy_cls in (SwissSOCKS5Proxy, SwissProxy):
+        for mode in MODES:
+            result = await run_case(proxy_cls, mode, args, echo_port)
+            results.append(result)
+            print(f"{result['proxy']:18} {mode:10} p50 {result['p50_ms']:>8} ms  "
+                  f"p99 {result['p99_ms']:>8} ms")
+    await close_servers(echo)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency-ms", type=float, default=5.0,
+                        help="delay added to everything the fake Tor receives")
+    parser.add_argument("--count", type=int, default=100, help="handshakes per case")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
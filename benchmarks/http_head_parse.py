@@ -0,0 +1,102 @@
+"""Request head parsing, readline() per line vs one bounded readuntil().
+
+Feeds a CONNECT head with --headers header lines into a StreamReader and
+times reading it back, once with the loop handle_client used before
+(readline + UTF-8 decode of the request line, then readline per header)
+and once with http_head.read_head(). Both run under a request deadline
+like handle_client does (--no-deadline to drop it). The head arrives in
+one piece, as it does from a real client, so the difference is parsing
+and per-read overhead rather than network waits.
+
+    python3 benchmarks/http_head_parse.py --headers 8 --count 100000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import http_head
+import timeouts
+
+
+def build_head(headers):
+    lines = [b"CONNECT www.example.com:443 HTTP/1.1", b"Host: www.example.com:443",
+             b"Proxy-Authorization: Basic dXNlcjpwYXNz"]
+    lines += [b"X-Header-%d: %s" % (i, b"v" * 32) for i in range(max(0, headers - 2))]
+    return b"\r\n".join(lines) + b"\r\n\r\n"
+
+
+async def readline_loop(reader, deadline):
+    """The pre-change handle_client head reading"""
+    request_line = (await timeouts.before(deadline, reader.readline())).decode('utf-8').strip()
+    parts = request_line.split()
+    headers = []
+    while True:
+        header_line = await timeouts.before(deadline, reader.readline())
+        if not header_line or header_line == b'\r\n' or header_line == b'\n':
+            break
+        headers.append(header_line)
+    return parts[0], parts[1], headers
+
+
+async def single_shot(reader, deadline):
+    head = await http_head.read_head(reader, deadline)
+    return head.method, head.target, head.host
+
+
+PARSERS = {"readline": readline_loop, "readuntil": single_shot}
+
+
+async def run_case(name, head, count, deadline):
+    parse = PARSERS[name]
+    started = time.perf_counter()
+    for _ in range(count):
+        reader = asyncio.StreamReader()
+        reader.feed_data(head)
+        await parse(reader, timeouts.deadline(deadline))
+    elapsed = time.perf_counter() - started
+    return {
+        "parser": name,
+        "head_bytes": len(head),
+        "count": count,
+        "us_per_head": round(elapsed / count * 1e6, 3),
+        "heads_per_s": round(count / elapsed),
+    }
+
+
+async def main_async(args):
+    results = []
+    for headers in args.headers:
+        head = build_head(headers)
+        for name in PARSERS:
+            result = await run_case(name, head, args.count, None if args.no_deadline else 10.0)
+            result["headers"] = headers
+            result["deadline"] = not args.no_deadline
+            results.append(result)
+            print(f"{headers:3} headers  {name:10} {result['us_per_head']:>8} us/head  "
+                  f"{result['heads_per_s']:>9} heads/s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--headers", type=int, action="append",
+                        help="header lines per head (repeatable, default 2, 8 and 32)")
+    parser.add_argument("--count", type=int, default=50000, help="heads parsed per case")
+    parser.add_argument("--no-deadline", action="store_true", help="parse without a request deadline")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+    args.headers = args.headers or [2, 8, 32]
+
+    results = asyncio.run(main_async(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""Load test of both proxies against a local fake Tor SOCKS upstream.
+
+Each proxy runs in its own process (as in production) with one account
+routed through a stand-in Tor SOCKS server (fake_servers.py) that adds
+--latency-ms to everything it receives, --connect-delay-ms before each
+CONNECT reply and refuses --failure-rate of the CONNECTs. Behind it sit
+a local echo server and a bulk-data server. Measured per proxy:
+
+- connections/s: --connections tunnels opened by --concurrency clients,
+  each doing the handshake, one echo round trip and close,
+- p50/p99 handshake latency of those (TCP connect to success reply),
+- bulk throughput per tunnel: --bulk-tunnels concurrent downloads of
+  --bulk-mb MiB each,
+- RSS per 1,000 idle tunnels: growth of the proxy process's resident
+  memory after opening --idle-tunnels tunnels that then sit idle.
+
+Results go to --json (with the run's settings) so runs can be compared;
+--compare OLD.json prints the change against an earlier run.
+
+    python3 benchmarks/load_test.py --latency-ms 5 --failure-rate 0.01 --json run.json
+    python3 benchmarks/load_test.py --compare run.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import socks5
+
+from fake_servers import close_servers, start_bulk_server, start_echo_server, start_fake_socks_server
+
+PROXIES = ("http", "socks5")
+# Metrics compared by --compare, and whether higher is better
+METRICS = {
+    "connections_per_s": True,
+    "handshake_p50_ms": False,
+    "handshake_p99_ms": False,
+    "bulk_mb_per_s_per_tunnel": True,
+    "rss_kib_per_1000_idle": False,
+}
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def rss_kib(pid):
+    """Resident set size of a process from /proc, in KiB"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    raise RuntimeError(f"no VmRSS for pid {pid}")
+
+
+def _serve_proxy(kind, config, account, ready):
+    """Body of the proxy process: one account listener on an ephemeral port"""
+    raise_fd_limit()
+    if kind == "socks5":
+        from swiss_socks5_proxy import SwissSOCKS5Proxy as proxy_cls
+    else:
+        from swiss_proxy_stream import SwissProxy as proxy_cls
+
+    async def serve():
+        proxy = proxy_cls(config, allocate_ports=False)
+        server = await asyncio.start_server(proxy.create_client_handler(0, account), "127.0.0.1", 0,
+                                            backlog=1024)
+        ready.put(server.sockets[0].getsockname()[1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def start_proxy(kind, fake_port, args):
+    upstream = {"type": "tor", "name": "fake tor", "socks_host": "127.0.0.1", "socks_port": fake_port}
+    account = {"email": "bench@example.com", "original_port": 0, "http_port": 0, "proxy_port": 0,
+               "upstream": upstream}
+    config = {"accounts": {}, "health": {"interval": 0},
+              "logging": {"access": args.access_log}, "tracing": {"enabled": args.trace}}
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Queue()
+    process = ctx.Process(target=_serve_proxy, args=(kind, config, account, ready), daemon=True)
+    process.start()
+    return process, ready.get(timeout=30)
+
+
+async def open_tunnel(kind, port, dst_port):
+    """Tunnel through the proxy to 127.0.0.1:dst_port; (reader, writer) or None if refused"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        if kind == "socks5":
+            writer.write(socks5.GREETING_NO_AUTH)
+            await reader.readexactly(2)
+            writer.write(socks5.build_connect_request("127.0.0.1", dst_port, socks5.ATYP_IPV4))
+            reply = await socks5.read_frame(reader, socks5.reply_length)
+            ok = reply[1] == socks5.REP_SUCCESS
+        else:
+            writer.write(f"CONNECT 127.0.0.1:{dst_port} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n".encode())
+            ok = b" 200 " in await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, ConnectionError):
+        ok = False
+    if not ok:
+        writer.close()
+        return None
+    return reader, writer
+
+
+async def open_tunnel_retrying(kind, port, dst_port, attempts=20):
+    for _ in range(attempts):
+        tunnel = await open_tunnel(kind, port, dst_port)
+        if tunnel is not None:
+            return tunnel
+    raise RuntimeError(f"{kind}: no tunnel after {attempts} attempts")
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def measure_connections(kind, port, echo_port, args):
+    samples = []
+    failures = 0
+    remaining = args.connections
+
+    async def client():
+        nonlocal remaining, failures
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            tunnel = await open_tunnel(kind, port, echo_port)
+            if tunnel is None:
+                failures += 1
+                continue
+            samples.append((time.perf_counter() - started) * 1000)
+            reader, writer = tunnel
+            writer.write(b"ping")
+            await reader.readexactly(4)
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "connections": len(samples),
+        "failures": failures,
+        "connections_per_s": round(len(samples) / elapsed, 1),
+        "handshake_p50_ms": round(percentile(samples, 50), 3) if samples else None,
+        "handshake_p99_ms": round(percentile(samples, 99), 3) if samples else None,
+        "handshake_mean_ms": round(statistics.mean(samples), 3) if samples else None,
+    }
+
+
+async def measure_bulk(kind, port, bulk_port, args):
+    size = args.bulk_mb * 1024 * 1024
+
+    async def download():
+        reader, writer = await open_tunnel_retrying(kind, port, bulk_port)
+        started = time.perf_counter()
+        received = 0
+        while True:
+            data = await reader.read(262144)
+            if not data:
+                break
+            received += len(data)
+        elapsed = time.perf_counter() - started
+        writer.close()
+        if received != size:
+            raise RuntimeError(f"{kind}: expected {size} bytes, got {received}")
+        return received / elapsed / 1e6
+
+    rates = await asyncio.gather(*(download() for _ in range(args.bulk_tunnels)))
+    return {
+        "bulk_mb_per_s_per_tunnel": round(statistics.mean(rates), 1),
+        "bulk_mb_per_s_total": round(sum(rates), 1),
+    }
+
+
+async def measure_idle(kind, port, pid, echo_port, args):
+    await asyncio.sleep(0.5)
+    before = rss_kib(pid)
+    tunnels = []
+    for _ in range(0, args.idle_tunnels, args.concurrency):
+        batch = min(args.concurrency, args.idle_tunnels - len(tunnels))
+        tunnels += await asyncio.gather(*(open_tunnel_retrying(kind, port, echo_port) for _ in range(batch)))
+    # Let every relay reach its steady state before sampling
+    await asyncio.sleep(1.0)
+    after = rss_kib(pid)
+    for _, writer in tunnels:
+        writer.close()
+    return {
+        "idle_tunnels": len(tunnels),
+        "rss_kib_before": before,
+        "rss_kib_per_1000_idle": round((after - before) * 1000 / len(tunnels), 1),
+    }
+
+
+async def run_proxy(kind, args, echo_port, bulk_port, fake_port):
+    process, port = start_proxy(kind, fake_port, args)
+    try:
+        result = {"proxy": kind}
+        result.update(await measure_connections(kind, port, echo_port, args))
+        result.update(await measure_bulk(kind, port, bulk_port, args))
+        if args.idle_tunnels:
+            result.update(await measure_idle(kind, port, process.pid, echo_port, args))
+    finally:
+        process.terminate()
+        process.join(5)
+    return result
+
+
+async def main_async(args):
+    raise_fd_limit()
+    echo, echo_port = await start_echo_server()
+    bulk, bulk_port = await start_bulk_server(args.bulk_mb * 1024 * 1024)
+    fake, fake_port = await start_fake_socks_server(latency=args.latency_ms / 1000,
+                                                    connect_delay=args.connect_delay_ms / 1000,
+                                                    failure_rate=args.failure_rate)
+    results = []
+    try:
+        for kind in args.proxy:
+            result = await run_proxy(kind, args, echo_port, bulk_port, fake_port)
+            results.append(result)
+            print(f"{kind:7} {result['connections_per_s']:>8} conn/s  "
+                  f"handshake p50 {result['handshake_p50_ms']} ms p99 {result['handshake_p99_ms']} ms  "
+                  f"({result['failures']} refused)  "
+                  f"bulk {result['bulk_mb_per_s_per_tunnel']} MB/s/tunnel  "
+                  f"RSS {result.get('rss_kib_per_1000_idle')} KiB/1000 idle")
+    finally:
+        await close_servers(echo, bulk, fake)
+    return results
+
+
+def compare(results, baseline):
+    """Print the change of each metric against an earlier run"""
+    old = {r["proxy"]: r for r in baseline["results"]}
+    for result in results:
+        previous = old.get(result["proxy"])
+        if previous is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            new_value, old_value = result.get(metric), previous.get(metric)
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / old_value * 100
+            worse = change < 0 if higher_is_better else change > 0
+            flag = "  worse" if worse and abs(change) >= 5 else ""
+            print(f"{result['proxy']:7} {metric:26} {old_value:>10} -> {new_value:>10} "
+                  f"({change:+.1f}%){flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--proxy", action="append", choices=PROXIES,
+                        help="proxy to test (repeatable, default both)")
+    parser.add_argument("--latency-ms", type=float, default=5.0,
+                        help="delay added to everything the fake Tor receives")
+    parser.add_argument("--connect-delay-ms", type=float, default=0.0,
+                        help="delay before the fake Tor answers each CONNECT (circuit setup)")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="fraction of CONNECTs the fake Tor refuses")
+    parser.add_argument("--connections", type=int, default=2000, help="tunnels opened for conn/s")
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent clients")
+    parser.add_argument("--bulk-mb", type=int, default=64, help="MiB downloaded per bulk tunnel")
+    parser.add_argument("--bulk-tunnels", type=int, default=4, help="concurrent bulk tunnels")
+    parser.add_argument("--idle-tunnels", type=int, default=1000,
+                        help="idle tunnels for the RSS measurement (0 = skip)")
+    parser.add_argument("--access-log", action="store_true",
+                        help="keep per-tunnel access records on in the proxies")
+    parser.add_argument("--trace", action="store_true",
+                        help="keep per-tunnel timelines (tunnel_trace.py) on in the proxies")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", metavar="OLD_JSON", help="compare against an earlier --json file")
+    args = parser.parse_args()
+    args.proxy = args.proxy or list(PROXIES)
+
+    results = asyncio.run(main_async(args))
+    report = {
+        "settings": {key: value for key, value in vars(args).items() if key not in ("json", "compare")},
+        "host": {"python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S%z")},
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Throughput comparison of the relay engines.
+
+Runs a local bulk-data server, puts each proxy's relay in front of it and
+downloads through it with every available engine.
+
+    python3 benchmarks/relay_throughput.py --size-mb 256 --tunnels 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import relay_engine
+from swiss_proxy_stream import SwissProxy
+from swiss_socks5_proxy import SwissSOCKS5Proxy
+
+from fake_servers import start_bulk_server
+
+
+def make_relay(proxy_cls, engine):
+    proxy = proxy_cls({"accounts": {}, "relay": {"engine": engine}})
+    if proxy_cls is SwissSOCKS5Proxy:
+        return lambda cr, cw, tr, tw: proxy.relay_data(cr, cw, tr, tw, 0)
+    return proxy.bridge_connections
+
+
+async def start_relay_front(relay, upstream_port):
+    """Listener that relays every client to the bulk server"""
+    async def handle(reader, writer):
+        target_reader, target_writer = await asyncio.open_connection("127.0.0.1", upstream_port)
+        try:
+            await relay(reader, writer, target_reader, target_writer)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def download(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    received = 0
+    while True:
+        data = await reader.read(262144)
+        if not data:
+            break
+        received += len(data)
+    writer.close()
+    return received
+
+
+async def run_case(proxy_cls, engine, size, tunnels):
+    bulk_server, bulk_port = await start_bulk_server(size)
+    front, front_port = await start_relay_front(make_relay(proxy_cls, engine), bulk_port)
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    received = await asyncio.gather(*(download(front_port) for _ in range(tunnels)))
+    wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+    front.close()
+    bulk_server.close()
+    total = sum(received)
+    if total != size * tunnels:
+        raise RuntimeError(f"{engine}: expected {size * tunnels} bytes, got {total}")
+
+    return {
+        "proxy": proxy_cls.__name__,
+        "engine": engine,
+        "tunnels": tunnels,
+        "bytes": total,
+        "seconds": round(wall, 4),
+        "mb_per_s": round(total / wall / 1e6, 1),
+        "cpu_s_per_gb": round(cpu / (total / 1e9), 3),
+    }
+
+
+async def main_async(args):
+    engines = [relay_engine.ENGINE_ASYNCIO, relay_engine.ENGINE_PROTOCOL]
+    if relay_engine.splice_supported():
+        engines.append(relay_engine.ENGINE_SPLICE)
+
+    results = []
+    for proxy_cls in (SwissSOCKS5Proxy, SwissProxy):
+        for engine in engines:
+            result = await run_case(proxy_cls, engine, args.size_mb * 1024 * 1024, args.tunnels)
+            results.append(result)
+            print(f"{result['proxy']:18} {engine:8} {result['mb_per_s']:>9} MB/s  "
+                  f"{result['cpu_s_per_gb']:>7} CPU s/GB")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=128, help="bytes per tunnel, in MiB")
+    parser.add_argument("--tunnels", type=int, default=1, help="concurrent tunnels per case")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
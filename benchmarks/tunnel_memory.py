@@ -0,0 +1,251 @@
+"""Memory per idle and per active tunnel of both proxies.
+
+Each proxy runs in its own process with one account routed through the
+local stand-in Tor SOCKS server (fake_servers.py) to an echo server, and
+tracemalloc on. The benchmark opens --tunnels tunnels (handshake plus one
+echo round trip each) and samples the proxy process:
+
+- idle: all tunnels open, nothing moving,
+- active: every tunnel echoing --payload bytes back and forth in a loop,
+  sampled --samples times while the traffic runs.
+
+Reported per tunnel are the growth of the Python heap (tracemalloc,
+after a gc.collect()) and of the resident set size over the empty proxy.
+tracemalloc's own bookkeeping inflates RSS; --no-tracemalloc measures
+RSS alone. --top N prints the N allocation sites that grew most while
+idle, to see where the bytes go.
+
+    python3 benchmarks/tunnel_memory.py --tunnels 2000 --engine asyncio --engine protocol
+    python3 benchmarks/tunnel_memory.py --json before.json
+    python3 benchmarks/tunnel_memory.py --compare before.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import relay_engine
+
+from fake_servers import close_servers, start_echo_server, start_fake_socks_server
+from load_test import PROXIES, open_tunnel_retrying, raise_fd_limit, rss_kib
+
+# Metrics compared by --compare (lower is better for all of them)
+METRICS = ("heap_bytes_per_idle", "heap_bytes_per_active", "rss_bytes_per_idle", "rss_bytes_per_active")
+# Frames kept per allocation for --top
+TRACE_FRAMES = 4
+
+
+def _sample(top=0, baseline=None):
+    """(heap bytes, RSS KiB, top allocation sites since baseline) of this process"""
+    gc.collect()
+    if not tracemalloc.is_tracing():
+        return 0, rss_kib(os.getpid()), []
+    sites = []
+    if top and baseline is not None:
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+        snapshot = tracemalloc.take_snapshot().filter_traces(ignore)
+        for stat in snapshot.compare_to(baseline.filter_traces(ignore), "lineno")[:top]:
+            frame = stat.traceback[0]
+            sites.append((f"{os.path.basename(frame.filename)}:{frame.lineno}", stat.size_diff, stat.count_diff))
+    return tracemalloc.get_traced_memory()[0], rss_kib(os.getpid()), sites
+
+
+def _serve_proxy(kind, engine, account, use_tracemalloc, top, control):
+    """Body of the proxy process: serve one account and answer sample requests on control"""
+    raise_fd_limit()
+    if use_tracemalloc:
+        tracemalloc.start(TRACE_FRAMES)
+    if kind == "socks5":
+        from swiss_socks5_proxy import SwissSOCKS5Proxy as proxy_cls
+    else:
+        from swiss_proxy_stream import SwissProxy as proxy_cls
+    config = {"accounts": {}, "health": {"interval": 0}, "relay": {"engine": engine},
+              "logging": {"access": False}, "tracing": {"enabled": False}}
+    baseline = None
+
+    def answer():
+        nonlocal baseline
+        request = control.recv()
+        sample = _sample(top if request == "top" else 0, baseline)
+        if request == "baseline" and top:
+            # --top compares against the empty proxy
+            baseline = tracemalloc.take_snapshot()
+        control.send(sample)
+
+    async def serve():
+        proxy = proxy_cls(config, allocate_ports=False)
+        server = await asyncio.start_server(proxy.create_client_handler(0, account), "127.0.0.1", 0,
+                                            backlog=1024)
+        asyncio.get_running_loop().add_reader(control.fileno(), answer)
+        control.send(server.sockets[0].getsockname()[1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def request_sample(control, request="sample"):
+    control.send(request)
+    # The proxy answers from its event loop; poll instead of blocking ours
+    while not control.poll():
+        await asyncio.sleep(0.01)
+    return control.recv()
+
+
+async def measure(kind, engine, fake_port, echo_port, args):
+    upstream = {"type": "tor", "name": "fake tor", "socks_host": "127.0.0.1", "socks_port": fake_port}
+    account = {"email": "bench@example.com", "original_port": 0, "http_port": 0, "proxy_port": 0,
+               "upstream": upstream}
+    ctx = multiprocessing.get_context("spawn")
+    control, child = ctx.Pipe()
+    process = ctx.Process(target=_serve_proxy, daemon=True,
+                          args=(kind, engine, account, not args.no_tracemalloc, args.top, child))
+    process.start()
+    tunnels = []
+    try:
+        port = control.recv() if control.poll(30) else None
+        if port is None:
+            raise RuntimeError(f"{kind}: proxy did not start")
+
+        # Warm up caches, pools and free lists so they don't count as per-tunnel cost
+        for _ in range(50):
+            _, writer = await open_tunnel_retrying(kind, port, echo_port)
+            writer.close()
+        await asyncio.sleep(0.5)
+        base_heap, base_rss, _ = await request_sample(control, "baseline")
+
+        while len(tunnels) < args.tunnels:
+            batch = min(args.concurrency, args.tunnels - len(tunnels))
+            opened = await asyncio.gather(*(open_tunnel_retrying(kind, port, echo_port) for _ in range(batch)))
+            for reader, writer in opened:
+                writer.write(b"x")
+            for reader, _ in opened:
+                await reader.readexactly(1)
+            tunnels += opened
+        # Let every relay reach its steady state before sampling
+        await asyncio.sleep(1.0)
+        idle_heap, idle_rss, sites = await request_sample(control, "top" if args.top else "sample")
+
+        payload = bytes(args.payload)
+        running = True
+
+        async def echo(reader, writer):
+            while running:
+                writer.write(payload)
+                await reader.readexactly(len(payload))
+
+        clients = [asyncio.create_task(echo(reader, writer)) for reader, writer in tunnels]
+        await asyncio.sleep(1.0)
+        samples = []
+        for _ in range(args.samples):
+            samples.append(await request_sample(control))
+            await asyncio.sleep(0.2)
+        running = False
+        await asyncio.gather(*clients, return_exceptions=True)
+    finally:
+        for _, writer in tunnels:
+            writer.close()
+        process.terminate()
+        process.join(5)
+
+    n = len(tunnels)
+    active_heap = sum(heap for heap, _, _ in samples) / len(samples)
+    active_rss = sum(rss for _, rss, _ in samples) / len(samples)
+    result = {
+        "proxy": kind,
+        "engine": engine,
+        "tunnels": n,
+        "rss_bytes_per_idle": round((idle_rss - base_rss) * 1024 / n),
+        "rss_bytes_per_active": round((active_rss - base_rss) * 1024 / n),
+    }
+    if not args.no_tracemalloc:
+        result["heap_bytes_per_idle"] = round((idle_heap - base_heap) / n)
+        result["heap_bytes_per_active"] = round((active_heap - base_heap) / n)
+    if sites:
+        result["top_idle_sites"] = [{"site": site, "bytes_per_tunnel": round(size / n),
+                                     "objects_per_tunnel": round(count / n, 1)} for site, size, count in sites]
+    return result
+
+
+async def main_async(args):
+    raise_fd_limit()
+    echo, echo_port = await start_echo_server()
+    fake, fake_port = await start_fake_socks_server()
+    results = []
+    try:
+        for kind in args.proxy:
+            for engine in args.engine:
+                result = await measure(kind, engine, fake_port, echo_port, args)
+                results.append(result)
+                heap = (f"heap {result['heap_bytes_per_idle']} B idle, {result['heap_bytes_per_active']} B active  "
+                        if "heap_bytes_per_idle" in result else "")
+                print(f"{kind:7} {engine:9} {heap}RSS {result['rss_bytes_per_idle']} B idle, "
+                      f"{result['rss_bytes_per_active']} B active  (per tunnel, {result['tunnels']} tunnels)")
+                for site in result.get("top_idle_sites", ()):
+                    print(f"    {site['bytes_per_tunnel']:>7} B {site['objects_per_tunnel']:>5} objects  {site['site']}")
+    finally:
+        await close_servers(echo, fake)
+    return results
+
+
+def compare(results, baseline):
+    """Print the change of each metric against an earlier run"""
+    old = {(r["proxy"], r["engine"]): r for r in baseline["results"]}
+    for result in results:
+        previous = old.get((result["proxy"], result["engine"]))
+        if previous is None:
+            continue
+        for metric in METRICS:
+            new_value, old_value = result.get(metric), previous.get(metric)
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / old_value * 100
+            flag = "  worse" if change >= 5 else ""
+            print(f"{result['proxy']:7} {result['engine']:9} {metric:22} {old_value:>8} -> {new_value:>8} "
+                  f"({change:+.1f}%){flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--proxy", action="append", choices=PROXIES,
+                        help="proxy to measure (repeatable, default both)")
+    parser.add_argument("--engine", action="append", choices=relay_engine.ENGINES,
+                        help="relay engine (repeatable, default asyncio)")
+    parser.add_argument("--tunnels", type=int, default=1000, help="tunnels held open")
+    parser.add_argument("--concurrency", type=int, default=50, help="tunnels opened at a time")
+    parser.add_argument("--payload", type=int, default=16384, help="bytes per echo round trip while active")
+    parser.add_argument("--samples", type=int, default=5, help="samples averaged while active")
+    parser.add_argument("--top", type=int, default=0, help="print the N allocation sites that grew most")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="measure RSS only")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", metavar="OLD_JSON", help="compare against an earlier --json file")
+    args = parser.parse_args()
+    args.proxy = args.proxy or list(PROXIES)
+    args.engine = args.engine or [relay_engine.ENGINE_ASYNCIO]
+    if args.top and args.no_tracemalloc:
+        parser.error("--top needs tracemalloc")
+
+    results = asyncio.run(main_async(args))
+    report = {
+        "settings": {key: value for key, value in vars(args).items() if key not in ("json", "compare")},
+        "host": {"python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S%z")},
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Hot config reload for the proxies (SIGHUP or a config.json watch).
+
+The new config.json is diffed against the running one by account email:
+
+- new accounts get a listener,
+- removed accounts have their listener closed,
+- changed accounts keep their listener (unless proxy_port moved, which is
+  a remove + add) and get the new upstream/relay/timeouts/admission
+  settings for connections accepted from now on. In --workers mode a
+  moved account stays on its old port until a restart.
+
+Tunnels that are already open keep the account dict they were accepted
+with and finish on their old settings; closing a listener does not close
+the connections it accepted. The top-level relay, dns, admission and
+timeouts sections are re-applied as well.
+
+A reload is checked before anything changes: every account needs a valid
+proxy_port and a named upstream, and the listeners of new accounts are
+bound first. A config that fails to load, validate or bind is logged and
+the running config stays in place; if applying the settings fails, the
+previous settings are put back.
+
+Trigger with `kill -HUP <pid>` (`./manager_v2.sh reload`) or poll the
+file with --watch-config SECONDS. In --workers mode the parent applies the
+reload, closes the sockets of removed accounts and forwards SIGHUP to the
+workers; new accounts need a restart there because every worker must
+share the parent's listening sockets.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+
+import port_map
+import tor_pool
+
+logger = logging.getLogger(__name__)
+
+
+def load(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def diff_accounts(old_accounts, new_accounts):
+    """(added, removed, changed) sets of account emails"""
+    added = set(new_accounts) - set(old_accounts)
+    removed = set(old_accounts) - set(new_accounts)
+    changed = {email for email in set(old_accounts) & set(new_accounts)
+               if old_accounts[email] != new_accounts[email]}
+    return added, removed, changed
+
+
+def validate_accounts(proxy, accounts):
+    """email -> account_entry for every account; raises ValueError if one can't be served"""
+    if not isinstance(accounts, dict):
+        raise ValueError('"accounts" must be an object')
+    entries = {}
+    for email, acc_config in accounts.items():
+        if not isinstance(acc_config, dict):
+            raise ValueError(f"{email}: account must be an object")
+        port = acc_config.get("proxy_port")
+        if not isinstance(port, int) or isinstance(port, bool):
+            raise ValueError(f"{email}: proxy_port must be a port number, got {port!r}")
+        upstream = acc_config.get("upstream")
+        if not isinstance(upstream, dict) or not isinstance(upstream.get("name"), str):
+            raise ValueError(f"{email}: upstream needs a name")
+        entry = entries[email] = proxy.account_entry(email, acc_config)
+        if not 0 < entry["original_port"] < 65536:
+            raise ValueError(f"{email}: port {entry['original_port']} is out of range")
+    return entries
+
+
+def reload_accounts(proxy, config, listeners=True):
+    """Apply config to a running proxy; returns (added, removed, changed).
+
+    proxy provides config, account_by_port, apply_settings(),
+    account_entry(), bind_ports(), register(), release_port() and, when
+    listeners is true, start_listener()/stop_listener(). With listeners
+    false (or a proxy serving pre-bound --workers sockets) new accounts
+    are skipped.
+
+    Raises ValueError for an unusable config and OSError/RuntimeError if
+    a new listener can't be bound, in both cases before anything changed.
+    """
+    old_config = proxy.config
+    old_accounts = old_config.get("accounts", {})
+    new_accounts = config.get("accounts", {})
+    entries = validate_accounts(proxy, new_accounts)
+    added, removed, changed = diff_accounts(old_accounts, new_accounts)
+    can_bind = listeners and not proxy.prebound
+    ports = {entry["email"]: port for port, entry in proxy.account_by_port.items()}
+    for email in sorted(changed):
+        new_port = new_accounts[email]["proxy_port"]
+        if old_accounts[email]["proxy_port"] == new_port:
+            continue
+        if can_bind:
+            changed.discard(email)
+            removed.add(email)
+            added.add(email)
+        else:
+            # The workers share the parent's sockets: keep serving on the old port
+            logger.warning(f"Reload: {email} moved to port {new_port}, restart the proxy to listen there; "
+                           f"it stays on port {ports.get(email)} until then")
+    if not can_bind:
+        for email in sorted(added):
+            logger.warning(f"Reload: {email} is new, restart the proxy to listen for it in --workers mode")
+        added = set()
+    # Bind before changing anything, so a port that can't be had leaves the running config alone
+    bound = proxy.bind_ports({email: entries[email] for email in added})
+    try:
+        proxy.apply_settings(config)
+    except Exception:
+        for _, sock in bound.values():
+            sock.close()
+        proxy.apply_settings(old_config)
+        raise
+
+    for email in sorted(removed):
+        port = ports.get(email)
+        if port is None:
+            continue
+        if listeners:
+            proxy.stop_listener(port)
+        proxy.release_port(port)
+        logger.info(f"Reload: removed {email} (port {port})")
+
+    for email in sorted(changed):
+        port = ports.get(email)
+        if port is not None:
+            # Only connections accepted from now on see the new settings
+            proxy.account_by_port[port] = entries[email]
+            logger.info(f"Reload: updated {email} (port {port}, "
+                        f"route: {new_accounts[email]['upstream']['name']})")
+
+    for email in sorted(added):
+        port, sock = bound[email]
+        proxy.register(entries[email], port, sock)
+        proxy.start_listener(port)
+        logger.info(f"Reload: added {email} (port {port})")
+
+    tor_pool.warm_pools(proxy.account_by_port.values())
+    if not proxy.prebound:
+        port_map.publish(proxy)
+    logger.info(f"Config reloaded: {len(added)} added, {len(removed)} removed, {len(changed)} changed")
+    return added, removed, changed
+
+
+def reload_from_file(proxy, listeners=True):
+    """Re-read proxy.config_path and apply it; False if the file is unusable"""
+    try:
+        config = load(proxy.config_path)
+        return reload_accounts(proxy, config, listeners)
+    except (OSError, ValueError, KeyError, TypeError, RuntimeError) as e:
+        logger.error(f"Config reload failed, keeping the running config: {e}")
+        return False
+
+
+class ConfigWatcher:
+    """Detects config.json changes by polling its mtime and size"""
+
+    def __init__(self, path):
+        self.path = path
+        self.signature = self._stat()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def changed(self):
+        signature = self._stat()
+        if signature is None or signature == self.signature:
+            return False
+        self.signature = signature
+        return True
+
+
+async def _watch(proxy, interval):
+    watcher = ConfigWatcher(proxy.config_path)
+    while True:
+        await asyncio.sleep(interval)
+        if watcher.changed():
+            logger.info(f"{proxy.config_path} changed, reloading")
+            reload_from_file(proxy)
+
+
+def install(proxy):
+    """Reload on SIGHUP, and on file changes if proxy.watch_interval is set.
+
+    Returns the watch task (or None); call from the proxy's event loop.
+    """
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, reload_from_file, proxy)
+    # Workers follow the parent's SIGHUP rather than watching on their own
+    if proxy.watch_interval and not proxy.prebound:
+        return asyncio.create_task(_watch(proxy, proxy.watch_interval))
+    return None
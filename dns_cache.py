@@ -0,0 +1,264 @@
+"""Resolver cache and Happy Eyeballs connect for the direct upstream.
+
+`type: direct` accounts used to call asyncio.open_connection(host, port),
+which runs getaddrinfo in the default executor for every connection. The
+cache keeps answers per host name with a TTL, remembers failures for a
+shorter negative TTL, is bounded by an LRU and coalesces concurrent
+lookups for the same name into one getaddrinfo call. A hung resolver
+costs at most `timeout` seconds per name instead of one executor thread
+per connection.
+
+getaddrinfo does not expose record TTLs, so every entry gets the
+configured TTL.
+
+Config (optional, top level of config.json):
+
+    "dns": {"ttl": 300, "negative_ttl": 30, "max_entries": 1024, "timeout": 5}
+
+and per direct upstream:
+
+    "upstream": {"type": "direct", "connect_timeout": 10, "happy_eyeballs_delay": 0.25}
+"""
+import asyncio
+import collections
+import logging
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 300.0
+DEFAULT_NEGATIVE_TTL = 30.0
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_RESOLVE_TIMEOUT = 5.0
+DEFAULT_CONNECT_TIMEOUT = 10.0
+# RFC 8305 recommends 250 ms between connection attempts
+DEFAULT_HAPPY_EYEBALLS_DELAY = 0.25
+STATS_LOG_INTERVAL = 300.0
+
+
+def _literal_address(host):
+    """(family, address) if host is an IP literal, else None"""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+        except (OSError, ValueError):
+            continue
+        return family, host
+    return None
+
+
+def _interleave(addresses):
+    """Alternate address families, starting with the resolver's first choice"""
+    by_family = collections.OrderedDict()
+    for family, address in addresses:
+        by_family.setdefault(family, []).append(address)
+    queues = [collections.deque((family, a) for a in addrs) for family, addrs in by_family.items()]
+    ordered = []
+    while queues:
+        for queue in list(queues):
+            ordered.append(queue.popleft())
+            if not queue:
+                queues.remove(queue)
+    return ordered
+
+
+class DnsCache:
+    """TTL + LRU cache of getaddrinfo answers with single-flight lookups"""
+
+    def __init__(self, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL,
+                 max_entries=DEFAULT_MAX_ENTRIES, timeout=DEFAULT_RESOLVE_TIMEOUT):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        # host -> (expires_at, [(family, address), ...] or exception)
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.evictions = 0
+        self._last_stats_log = time.monotonic()
+
+    def __repr__(self):
+        return f"DnsCache(ttl={self.ttl}, entries={len(self.entries)}/{self.max_entries})"
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses + self.coalesced
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "evictions": self.evictions,
+            "hit_rate": round((lookups - self.misses) / lookups, 3) if lookups else 0.0,
+        }
+
+    def _get(self, host):
+        entry = self.entries.get(host)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.entries[host]
+            return None
+        self.entries.move_to_end(host)
+        return entry[1]
+
+    def _put(self, host, value, ttl):
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        self.entries[host] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(host)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def _lookup(self, host):
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await asyncio.wait_for(
+                loop.getaddrinfo(host, None, type=socket.SOCK_STREAM, proto=socket.IPPROTO_TCP),
+                self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            if isinstance(e, asyncio.TimeoutError):
+                e = socket.gaierror(socket.EAI_AGAIN, f"lookup timed out after {self.timeout}s")
+            self.failures += 1
+            self._put(host, e, self.negative_ttl)
+            raise e
+        finally:
+            del self.inflight[host]
+
+        addresses = []
+        for family, _, _, _, sockaddr in infos:
+            if (family, sockaddr[0]) not in addresses:
+                addresses.append((family, sockaddr[0]))
+        self._put(host, addresses, self.ttl)
+        return addresses
+
+    async def resolve(self, host):
+        """Return [(family, address), ...] for host, raising OSError on failure"""
+        literal = _literal_address(host)
+        if literal is not None:
+            return [literal]
+
+        self._maybe_log_stats()
+        cached = self._get(host)
+        if isinstance(cached, Exception):
+            self.negative_hits += 1
+            raise type(cached)(*cached.args)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        task = self.inflight.get(host)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(self._lookup(host))
+            # Retrieve the result even if every caller got cancelled
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self.inflight[host] = task
+        else:
+            self.coalesced += 1
+        # Shielded so one cancelled caller doesn't fail the others
+        return await asyncio.shield(task)
+
+    def _maybe_log_stats(self):
+        now = time.monotonic()
+        if now - self._last_stats_log >= STATS_LOG_INTERVAL:
+            self._last_stats_log = now
+            logger.info(f"DNS cache stats: {self.stats()}")
+
+
+def _close_unused(task):
+    if not task.cancelled() and task.exception() is None:
+        task.result().close()
+
+
+async def _connect_one(family, sockaddr):
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        await loop.sock_connect(sock, sockaddr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def happy_eyeballs_connect(addresses, port, delay=DEFAULT_HAPPY_EYEBALLS_DELAY):
+    """Race connection attempts (RFC 8305) and return the first connected socket.
+
+    A new attempt starts every `delay` seconds, or as soon as the previous
+    one fails. Losing attempts are cancelled and their sockets closed.
+    """
+    remaining = collections.deque(_interleave(addresses))
+    pending = set()
+    errors = []
+    try:
+        while remaining or pending:
+            if remaining:
+                family, address = remaining.popleft()
+                sockaddr = (address, port, 0, 0) if family == socket.AF_INET6 else (address, port)
+                pending.add(asyncio.create_task(_connect_one(family, sockaddr)))
+            done, pending = await asyncio.wait(
+                pending, timeout=delay if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    task.result().close()
+            if winner is not None:
+                return winner
+    finally:
+        for task in pending:
+            task.cancel()
+            task.add_done_callback(_close_unused)
+
+    if len(errors) == 1:
+        raise errors[0]
+    raise OSError(f"all {len(errors)} connection attempts failed: "
+                  + "; ".join(str(e) for e in errors))
+
+
+_cache = DnsCache()
+
+
+def configure(settings):
+    """Replace the shared cache using the config's "dns" section"""
+    global _cache
+    _cache = DnsCache(
+        ttl=settings.get("ttl", DEFAULT_TTL),
+        negative_ttl=settings.get("negative_ttl", DEFAULT_NEGATIVE_TTL),
+        max_entries=settings.get("max_entries", DEFAULT_MAX_ENTRIES),
+        timeout=settings.get("timeout", DEFAULT_RESOLVE_TIMEOUT),
+    )
+
+
+def get_cache():
+    return _cache
+
+
+def cache_stats():
+    return _cache.stats()
+
+
+async def open_connection(host, port, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                          happy_eyeballs_delay=DEFAULT_HAPPY_EYEBALLS_DELAY):
+    """Cached resolve + Happy Eyeballs connect, returning (reader, writer)"""
+    addresses = await _cache.resolve(host)
+    try:
+        sock = await asyncio.wait_for(
+            happy_eyeballs_connect(addresses, port, happy_eyeballs_delay), connect_timeout)
+    except asyncio.TimeoutError:
+        raise OSError(f"connect to {host}:{port} timed out after {connect_timeout}s")
+    return await asyncio.open_connection(sock=sock)
@@ -0,0 +1,208 @@
+"""Backpressure for the asyncio stream relay.
+
+Each direction of a tunnel is a pump: read a chunk, write it to the other
+side, and only wait for drain() once the writer's transport buffer passes
+its high watermark (drain() then returns at the low watermark). On top of
+the per-writer watermarks:
+
+- a tunnel stops reading while the write buffers of both its sides
+  together exceed max_tunnel_buffer,
+- every tunnel stops reading while the whole process has more than
+  max_buffered_bytes queued in relay write buffers,
+- the read size adapts between min_chunk and max_chunk: it doubles while
+  reads fill the chunk and the writer keeps up, and halves on short reads
+  or when the writer falls behind.
+
+Config (optional, "relay" at the top level of config.json; everything but
+max_buffered_bytes can be overridden in an account's own "relay" section):
+
+    "relay": {"high_water": 262144, "low_water": 65536,
+              "max_tunnel_buffer": 1048576,
+              "min_chunk": 4096, "max_chunk": 65536,
+              "max_buffered_bytes": 67108864}
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HIGH_WATER = 256 * 1024
+DEFAULT_LOW_WATER = 64 * 1024
+DEFAULT_MAX_TUNNEL_BUFFER = 1024 * 1024
+DEFAULT_MIN_CHUNK = 4096
+DEFAULT_MAX_CHUNK = 65536
+DEFAULT_MAX_BUFFERED_BYTES = 64 * 1024 * 1024
+# How stale the process total may get before it is recomputed
+POLL_INTERVAL = 0.05
+# Backstop for a paused pump nobody wakes: write buffers the kernel empties
+# without any transport having hit its high watermark send no signal
+RECHECK_INTERVAL = 1.0
+
+
+class FlowSettings:
+    """Watermarks and chunk bounds for one tunnel"""
+    __slots__ = ("high_water", "low_water", "max_tunnel_buffer", "min_chunk", "max_chunk")
+
+    def __init__(self, high_water=DEFAULT_HIGH_WATER, low_water=DEFAULT_LOW_WATER,
+                 max_tunnel_buffer=DEFAULT_MAX_TUNNEL_BUFFER,
+                 min_chunk=DEFAULT_MIN_CHUNK, max_chunk=DEFAULT_MAX_CHUNK):
+        self.high_water = high_water
+        self.low_water = min(low_water, high_water)
+        self.max_tunnel_buffer = max_tunnel_buffer
+        self.min_chunk = max(1, min_chunk)
+        self.max_chunk = max(self.min_chunk, max_chunk)
+
+    def __repr__(self):
+        return (f"FlowSettings(high={self.high_water}, low={self.low_water}, "
+                f"tunnel_max={self.max_tunnel_buffer}, chunk={self.min_chunk}..{self.max_chunk})")
+
+    @classmethod
+    def from_config(cls, relay_settings, account_config=None):
+        """Global "relay" settings overridden by the account's "relay" section"""
+        settings = dict(relay_settings)
+        if account_config:
+            settings.update(account_config.get("relay", {}))
+        return cls(
+            high_water=settings.get("high_water", DEFAULT_HIGH_WATER),
+            low_water=settings.get("low_water", DEFAULT_LOW_WATER),
+            max_tunnel_buffer=settings.get("max_tunnel_buffer", DEFAULT_MAX_TUNNEL_BUFFER),
+            min_chunk=settings.get("min_chunk", DEFAULT_MIN_CHUNK),
+            max_chunk=settings.get("max_chunk", DEFAULT_MAX_CHUNK),
+        )
+
+
+class BufferBudget:
+    """Process-wide cap on bytes queued in relay write buffers.
+
+    Writes are added to the running total as they happen; the total is
+    recomputed from the registered transports at most every POLL_INTERVAL
+    so bytes the kernel has accepted since are released. Paused pumps wait
+    on a future that wake() resolves whenever a relay writer finishes
+    draining or goes away.
+    """
+
+    def __init__(self, limit=DEFAULT_MAX_BUFFERED_BYTES):
+        self.limit = limit
+        self.transports = set()
+        self.buffered = 0
+        self.pauses = 0
+        self._recomputed_at = 0.0
+        self._waiters = set()
+
+    def __repr__(self):
+        return f"BufferBudget({self.buffered}/{self.limit} B)"
+
+    def stats(self):
+        self._recompute(time.monotonic())
+        return {"buffered_bytes": self.buffered, "limit": self.limit, "pauses": self.pauses}
+
+    def register(self, transport):
+        self.transports.add(transport)
+
+    def unregister(self, transport):
+        self.transports.discard(transport)
+        self.wake()
+
+    def note_write(self, nbytes):
+        self.buffered += nbytes
+
+    def _recompute(self, now):
+        self._recomputed_at = now
+        self.buffered = sum(t.get_write_buffer_size() for t in self.transports)
+
+    def exceeded(self):
+        if self.limit <= 0 or self.buffered <= self.limit:
+            return False
+        now = time.monotonic()
+        if now - self._recomputed_at >= POLL_INTERVAL:
+            self._recompute(now)
+        return self.buffered > self.limit
+
+    async def wait(self, timeout=RECHECK_INTERVAL):
+        """Return at the next wake(), or after timeout at the latest"""
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._waiters.discard(waiter)
+
+    def wake(self):
+        """Let every paused pump re-check its limits"""
+        waiters, self._waiters = self._waiters, set()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+_budget = BufferBudget()
+
+
+def configure(relay_settings):
+    """Set the process-wide budget from the config's "relay" section"""
+    _budget.limit = relay_settings.get("max_buffered_bytes", DEFAULT_MAX_BUFFERED_BYTES)
+
+
+def budget_stats():
+    return _budget.stats()
+
+
+async def _wait_for_room(flow, chunk):
+    """Pause reading while the tunnel or the process is over its limit"""
+    paused = False
+    while True:
+        buffered = flow.buffered()
+        tunnel_full = buffered and buffered + chunk > flow.settings.max_tunnel_buffer
+        if not (tunnel_full or _budget.exceeded()):
+            return
+        if not paused:
+            paused = True
+            _budget.pauses += 1
+        await _budget.wait()
+
+
+async def pump(reader, writer, stats, attr, flow, shaper=None):
+    """Copy reader -> writer until EOF, honouring the tunnel's flow limits.
+
+    flow is the tunnel (tunnel_state.Tunnel): its FlowSettings as .settings
+    and .buffered(), the bytes queued on both of its sides. shaper
+    (bandwidth.Shaper) is charged for every chunk and holds the next read
+    back while the account or its upstream is over its rate.
+    """
+    settings = flow.settings
+    transport = writer.transport
+    transport.set_write_buffer_limits(high=settings.high_water, low=settings.low_water)
+    _budget.register(transport)
+    chunk = settings.min_chunk
+    try:
+        while not transport.is_closing():
+            await _wait_for_room(flow, chunk)
+            data = await reader.read(chunk)
+            if not data:
+                break
+            n = len(data)
+            setattr(stats, attr, getattr(stats, attr) + n)
+
+            before = transport.get_write_buffer_size()
+            writer.write(data)
+            buffered = transport.get_write_buffer_size()
+            _budget.note_write(buffered - before)
+
+            if buffered > settings.high_water:
+                chunk = max(chunk // 2, settings.min_chunk)
+                # Returns once the transport is back under low_water
+                await writer.drain()
+                _budget.wake()
+            elif n == chunk and buffered <= settings.low_water:
+                chunk = min(chunk * 2, settings.max_chunk)
+            elif n < chunk // 4:
+                chunk = max(chunk // 2, settings.min_chunk)
+            if shaper is not None:
+                waiter = shaper.charge(n)
+                if waiter is not None:
+                    await waiter
+    finally:
+        _budget.unregister(transport)
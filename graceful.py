@@ -0,0 +1,309 @@
+"""Graceful drain and zero-downtime restart by listener socket handoff.
+
+SIGTERM no longer cuts open tunnels. The proxy stops accepting (closes its
+listeners and the metrics endpoint), lets the connections it already
+accepted finish for up to --drain-timeout seconds (default 30), then
+cancels whatever is left and exits. A second SIGTERM ends the drain early.
+
+To restart without refusing a single connection, the running proxy also
+listens on a Unix socket next to config.json (<kind>.handoff.sock, mode
+0600). A new process started with --takeover connects to it and receives
+every account's listening socket over SCM_RIGHTS, together with the
+account and requested port it belongs to. It serves on those same sockets
+(connections waiting in the kernel backlog are not lost) and confirms;
+only then does the old process stop accepting and drain as on SIGTERM. If
+the new process exits before confirming, the old one keeps serving. A
+proxy started without --takeover leaves a handoff socket that a running
+process still answers on alone, and each process removes its socket
+when it exits.
+
+    python3 swiss_proxy_stream.py --takeover      # ./manager_v2.sh graceful-restart
+
+In --workers mode the parent hands over the SO_REUSEPORT sockets of every
+worker slot and then stops its workers, which drain. Both sides must run
+in --workers mode (the number of workers may differ). Accounts that are
+new in config.json get fresh listeners, removed ones have their handed
+over socket closed. With nothing to take over, --takeover starts normally.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DRAIN_TIMEOUT = 30.0
+# How long the old process waits for the new one to confirm
+HANDOFF_TIMEOUT = 30.0
+# Cancelled connections get this long to run their cleanup
+CANCEL_GRACE = 5.0
+CONFIRM = b"OK"
+SOCKET_NAME = "{kind}.handoff.sock"
+# Linux accepts at most 253 descriptors per SCM_RIGHTS message
+MAX_FDS_PER_MESSAGE = 250
+
+_bound = {}   # handoff socket path -> (st_dev, st_ino) of the file this process bound
+
+
+def path_for(config_path, kind):
+    return os.path.join(os.path.dirname(os.path.abspath(config_path)), SOCKET_NAME.format(kind=kind))
+
+
+def _in_use(path):
+    """True if a live process answers on the Unix socket at path"""
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    probe.settimeout(1.0)
+    try:
+        probe.connect(path)
+    except OSError:
+        return False
+    finally:
+        probe.close()
+    return True
+
+
+def bind_handoff_socket(path, replace=False):
+    """Listening Unix socket at path, replacing a stale one; None if that fails.
+
+    A socket some running proxy still answers on is only replaced when
+    replace is true (this process just took that one's listeners over);
+    otherwise that process keeps its handoff endpoint and this one serves
+    without one.
+    """
+    if not replace and _in_use(path):
+        logger.warning(f"Another running proxy serves listener handoffs at {path} "
+                       f"(use --takeover to replace it); starting without a handoff socket")
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        sock.bind(path)
+        os.chmod(path, 0o600)
+        sock.listen(1)
+        st = os.stat(path)
+    except OSError as e:
+        sock.close()
+        logger.warning(f"No listener handoff socket at {path}: {e}")
+        return None
+    _bound[path] = (st.st_dev, st.st_ino)
+    return sock
+
+
+def close_handoff_socket(sock, path):
+    """Close a socket from bind_handoff_socket() and remove its path, unless a newer process rebound it"""
+    sock.close()
+    identity = _bound.pop(path, None)
+    try:
+        st = os.stat(path)
+        if (st.st_dev, st.st_ino) == identity:
+            os.unlink(path)
+    except OSError:
+        pass
+
+
+def offer(conn, accounts, slots, reuseport):
+    """Send the listening sockets over conn.
+
+    accounts maps email -> (port, requested port); slots is a list (one
+    per worker slot) of port -> listening socket.
+    """
+    emails = sorted(accounts)
+    fds = [slot[accounts[email][0]].fileno() for slot in slots for email in emails]
+    header = {"pid": os.getpid(), "reuseport": reuseport, "slots": len(slots), "count": len(fds),
+              "accounts": {email: list(accounts[email]) for email in emails}}
+    message = json.dumps(header).encode() + b"\n"
+    for start in range(0, max(len(fds), 1), MAX_FDS_PER_MESSAGE):
+        socket.send_fds(conn, [message], fds[start:start + MAX_FDS_PER_MESSAGE])
+        message = b"F"
+
+
+def account_ports(proxy):
+    """email -> (port, requested port) of a proxy's accounts"""
+    return {entry["email"]: (port, entry["original_port"]) for port, entry in proxy.account_by_port.items()}
+
+
+class Handoff:
+    """Listening sockets received from the process being taken over"""
+
+    def __init__(self, conn, pid, accounts, slots, reuseport):
+        self.conn = conn
+        self.pid = pid
+        self.accounts = accounts      # email -> (port, requested port) in the old process
+        self.slots = slots            # per worker slot: email -> socket
+        self.reuseport = reuseport
+
+    def __repr__(self):
+        return f"Handoff(from PID {self.pid}, {len(self.accounts)} accounts, {len(self.slots)} slots)"
+
+    def take(self, slot, email, original_port):
+        """(port, socket) the old process served email on, if it asked for the same port"""
+        port, requested = self.accounts.get(email, (None, None))
+        if requested != original_port or slot >= len(self.slots):
+            return None
+        sock = self.slots[slot].pop(email, None)
+        return (port, sock) if sock is not None else None
+
+    def close_unused(self):
+        for slot in self.slots:
+            for sock in slot.values():
+                sock.close()
+            slot.clear()
+
+    def confirm(self):
+        """Tell the old process we are serving; it then stops accepting and drains"""
+        self.close_unused()
+        try:
+            self.conn.sendall(CONFIRM)
+        except OSError as e:
+            logger.warning(f"Could not confirm the takeover to PID {self.pid}: {e}")
+        self.conn.close()
+        logger.info(f"Took over the listeners of PID {self.pid}, which now drains")
+
+
+def _receive(conn):
+    data = b""
+    fds = []
+    header = None
+    while header is None or len(fds) < header["count"]:
+        message, received, _, _ = socket.recv_fds(conn, 65536, MAX_FDS_PER_MESSAGE)
+        fds += received
+        if not message:
+            for fd in fds:
+                os.close(fd)
+            return None
+        data += message
+        if header is None and b"\n" in data:
+            header = json.loads(data.split(b"\n", 1)[0])
+    return header, fds
+
+
+def take_over(proxy, workers=0):
+    """Handoff from the running proxy of the same kind, or None if there is none.
+
+    Raises RuntimeError if the running proxy uses the other process mode
+    (single vs --workers); it keeps serving then.
+    """
+    path = path_for(proxy.config_path, proxy.port_map_kind)
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(HANDOFF_TIMEOUT)
+    try:
+        conn.connect(path)
+        received = _receive(conn)
+    except OSError as e:
+        conn.close()
+        logger.info(f"Nothing to take over at {path} ({e}), starting normally")
+        return None
+    if received is None:
+        conn.close()
+        logger.info(f"The proxy at {path} refused the takeover (already draining), starting normally")
+        return None
+
+    header, fds = received
+    sockets = [socket.socket(fileno=fd) for fd in fds]
+    if header["reuseport"] != (workers > 0):
+        for sock in sockets:
+            sock.close()
+        conn.close()
+        mode = "--workers" if header["reuseport"] else "single-process"
+        raise RuntimeError(f"PID {header['pid']} runs in {mode} mode; stop it instead of taking over")
+    emails = sorted(header["accounts"])
+    slots = []
+    for slot in range(header["slots"]):
+        slots.append(dict(zip(emails, sockets[slot * len(emails):(slot + 1) * len(emails)])))
+    for sock in sockets:
+        sock.setblocking(False)
+    accounts = {email: tuple(ports) for email, ports in header["accounts"].items()}
+    handoff = Handoff(conn, header["pid"], accounts, slots, header["reuseport"])
+    logger.info(f"Received {len(sockets)} listening sockets from PID {handoff.pid}")
+    return handoff
+
+
+async def _serve_handoff(proxy, sock, path):
+    try:
+        await _accept_handoffs(proxy, sock)
+    finally:
+        close_handoff_socket(sock, path)
+
+
+async def _accept_handoffs(proxy, sock):
+    loop = asyncio.get_running_loop()
+    while True:
+        conn, _ = await loop.sock_accept(sock)
+        try:
+            if proxy.draining:
+                continue
+            # Each account's asyncio server listens on exactly one socket
+            listening = {port: server.sockets[0] for port, server in proxy.servers.items() if server.sockets}
+            accounts = {email: ports for email, ports in account_ports(proxy).items() if ports[0] in listening}
+            offer(conn, accounts, [listening], reuseport=False)
+            try:
+                reply = await asyncio.wait_for(loop.sock_recv(conn, len(CONFIRM)), HANDOFF_TIMEOUT)
+            except asyncio.TimeoutError:
+                reply = b""
+            if reply == CONFIRM:
+                logger.info("Listeners handed over to a new process")
+                begin_drain(proxy)
+            else:
+                logger.warning("Takeover was not confirmed, still serving")
+        except OSError as e:
+            logger.warning(f"Listener handoff failed: {e}")
+        finally:
+            conn.close()
+
+
+def install(proxy):
+    """Drain on SIGTERM, confirm a pending takeover and serve handoffs.
+
+    Call from the proxy's event loop once its listeners are started.
+    Returns the handoff server task (None for --workers children, whose
+    parent owns the handoff socket).
+    """
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, begin_drain, proxy)
+    took_over = proxy.handoff is not None
+    if took_over:
+        proxy.handoff.confirm()
+        proxy.handoff = None
+    if proxy.prebound:
+        return None
+    path = path_for(proxy.config_path, proxy.port_map_kind)
+    # The process taken over still answers on the path while it drains
+    sock = bind_handoff_socket(path, replace=took_over)
+    if sock is None:
+        return None
+    sock.setblocking(False)
+    return asyncio.create_task(_serve_handoff(proxy, sock, path))
+
+
+def begin_drain(proxy):
+    """Stop accepting; start_servers() then waits for open connections"""
+    if proxy.draining:
+        logger.warning(f"Closing the {len(proxy.clients)} connections still draining")
+        for task in list(proxy.clients):
+            task.cancel()
+        return
+    proxy.draining = True
+    logger.info(f"Stopped accepting; draining {len(proxy.clients)} connections "
+                f"(up to {proxy.drain_timeout:g}s)")
+    for port in list(proxy.listeners):
+        proxy.stop_listener(port)
+    if proxy.metrics_server is not None:
+        proxy.metrics_server.close()
+
+
+async def drain(proxy):
+    """Wait up to proxy.drain_timeout for the open connections, then cancel them"""
+    if not proxy.clients:
+        return
+    _, pending = await asyncio.wait(list(proxy.clients), timeout=proxy.drain_timeout)
+    if pending:
+        logger.warning(f"Drain timeout, closing {len(pending)} connections")
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending, timeout=CANCEL_GRACE)
+    logger.info("Drained")
@@ -0,0 +1,447 @@
+"""Plain-HTTP forwarding for SwissProxy (absolute-form GET/POST/HEAD).
+
+A request like `GET http://example.com/path HTTP/1.1` is sent on to the
+origin in origin form through the account's upstream (Tor or direct),
+with hop-by-hop headers removed and Host set from the URL. Request and
+response bodies are streamed as they arrive: Content-Length bodies are
+copied by length, chunked bodies are passed through with their framing
+(or decoded for HTTP/1.0 clients), and responses without either are
+read until the origin closes. A request whose body length is ambiguous
+(conflicting Content-Length values, Transfer-Encoding not ending in
+chunked, or both headers) is refused with 400 so it can't desync a pooled
+origin connection. `Expect: 100-continue` is answered by the proxy, which
+then streams the body on.
+
+Both sides keep their connection alive when they can. After a complete
+response the upstream connection goes back to an idle pool per account,
+upstream and origin; the next request to that origin reuses it. A GET or
+HEAD that fails on a reused connection before any response arrives is
+retried once on a fresh one, since the origin may have closed it while
+it sat idle.
+
+Config (optional, top level of config.json; an account can override it
+with its own "http_forward" object):
+
+    "http_forward": {"pool_max_idle": 4, "pool_idle_timeout": 30}
+"""
+import asyncio
+import collections
+import logging
+import time
+from urllib.parse import urlsplit
+
+from http_head import split_header
+from upstream import open_tunnel
+
+logger = logging.getLogger(__name__)
+
+FORWARD_METHODS = ("GET", "POST", "HEAD")
+# Requests safe to resend when a reused connection turns out to be dead
+RETRY_METHODS = ("GET", "HEAD")
+DEFAULT_POOL_MAX_IDLE = 4
+DEFAULT_POOL_IDLE_TIMEOUT = 30.0
+CHUNK_SIZE = 65536
+HOP_BY_HOP = frozenset((b"connection", b"keep-alive", b"proxy-connection", b"proxy-authorization",
+                        b"proxy-authenticate", b"te", b"trailer", b"upgrade", b"host"))
+
+# Body framing
+FRAMING_NONE = "none"
+FRAMING_LENGTH = "length"
+FRAMING_CHUNKED = "chunked"
+FRAMING_CLOSE = "close"
+
+
+class ForwardError(Exception):
+    """A request could not be forwarded; status is the reply for the client"""
+
+    def __init__(self, message, status=b"502 Bad Gateway", stage="http_upstream"):
+        super().__init__(message)
+        self.status = status
+        self.stage = stage
+
+
+def _get(headers, name):
+    """Last value of a header (name in lower case), or None"""
+    value = None
+    for key, v in headers:
+        if key.lower() == name:
+            value = v
+    return value
+
+
+def _tokens(headers, name):
+    tokens = set()
+    for key, value in headers:
+        if key.lower() == name:
+            tokens.update(t.strip().lower() for t in value.split(b","))
+    return tokens
+
+
+def _content_length(headers):
+    """Content-Length as an int, None if absent; ValueError if invalid or conflicting"""
+    values = set()
+    for key, value in headers:
+        if key.lower() == b"content-length":
+            values.update(v.strip() for v in value.split(b","))
+    if not values:
+        return None
+    if len(values) > 1:
+        raise ValueError(f"conflicting Content-Length values {sorted(values)[:4]!r}")
+    length = values.pop()
+    if not length.isdigit():
+        raise ValueError(f"invalid Content-Length {length[:20]!r}")
+    return int(length)
+
+
+def _framing(headers, request=False):
+    """(framing, length) from Transfer-Encoding / Content-Length, None if neither.
+
+    A request whose body length is ambiguous (RFC 9112 6.3) raises
+    ValueError: Transfer-Encoding not ending in chunked, or together with
+    Content-Length. Letting either through could desync a pooled origin
+    connection.
+    """
+    codings = [t.strip().lower() for key, value in headers if key.lower() == b"transfer-encoding"
+               for t in value.split(b",")]
+    length = _content_length(headers)
+    if codings:
+        if request and length is not None:
+            raise ValueError("both Transfer-Encoding and Content-Length")
+        if codings[-1] == b"chunked":
+            return FRAMING_CHUNKED, None
+        if request:
+            raise ValueError(f"request Transfer-Encoding {codings[-1][:20]!r} is not chunked")
+        return FRAMING_CLOSE, None
+    if length is not None:
+        return FRAMING_LENGTH, length
+    return None
+
+
+def _forwarded_headers(headers, drop=()):
+    """Header lines minus hop-by-hop headers and those named in Connection"""
+    skip = HOP_BY_HOP | _tokens(headers, b"connection") | frozenset(drop)
+    return [name + b": " + value for name, value in headers if name.lower() not in skip]
+
+
+class Request:
+    """One parsed absolute-form request head"""
+    __slots__ = ("method", "version", "headers", "host", "port", "path", "framing", "length", "expect_continue")
+
+    def __init__(self, method, target, version, headers):
+        if not target.startswith("http://"):
+            raise ForwardError(f"only absolute http:// URLs can be forwarded, got {target[:80]}",
+                               b"400 Bad Request", "http_request")
+        try:
+            url = urlsplit(target)
+            port = url.port or 80
+            framing = _framing(headers, request=True)
+        except ValueError as e:
+            raise ForwardError(str(e), b"400 Bad Request", "http_request")
+        if not url.hostname:
+            raise ForwardError(f"no host in {target[:80]}", b"400 Bad Request", "http_request")
+        self.method = method
+        self.version = version
+        self.headers = headers
+        self.host = url.hostname
+        self.port = port
+        self.path = (url.path or "/") + (f"?{url.query}" if url.query else "")
+        self.framing, self.length = framing or (FRAMING_NONE, 0)
+        # Answered here rather than by the origin (see _exchange)
+        self.expect_continue = b"100-continue" in _tokens(headers, b"expect")
+
+    @classmethod
+    def from_head(cls, head):
+        """Request from an http_head.RequestHead"""
+        try:
+            headers = head.headers
+        except ValueError as e:
+            raise ForwardError(str(e), b"400 Bad Request", "http_request")
+        return cls(head.method, head.target, head.version, headers)
+
+    def __repr__(self):
+        return f"Request({self.method} http://{self.host}:{self.port}{self.path})"
+
+    @property
+    def client_keep_alive(self):
+        connection = _tokens(self.headers, b"connection") | _tokens(self.headers, b"proxy-connection")
+        if self.version == "HTTP/1.1":
+            return b"close" not in connection
+        return b"keep-alive" in connection
+
+    def head(self):
+        host = self.host if ":" not in self.host else f"[{self.host}]"
+        authority = host if self.port == 80 else f"{host}:{self.port}"
+        drop = (b"expect",) if self.expect_continue else ()
+        lines = [f"{self.method} {self.path} HTTP/1.1".encode(), b"Host: " + authority.encode()]
+        lines += _forwarded_headers(self.headers, drop)
+        return b"\r\n".join(lines) + b"\r\n\r\n"
+
+
+class OriginPool:
+    """Idle keep-alive connections to one origin through one upstream"""
+
+    def __init__(self, max_idle=DEFAULT_POOL_MAX_IDLE, idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = collections.deque()   # (reader, writer, idle_since)
+        self.in_use = 0                   # requests forwarding through this pool right now
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"OriginPool({len(self.idle)}/{self.max_idle} idle, {self.in_use} in use)"
+
+    def take(self):
+        """Most recently used live connection, or None"""
+        now = time.monotonic()
+        while self.idle:
+            reader, writer, since = self.idle.pop()
+            if now - since > self.idle_timeout or reader.at_eof() or writer.is_closing():
+                writer.close()
+                continue
+            self.hits += 1
+            return reader, writer
+        self.misses += 1
+        return None
+
+    def put(self, reader, writer):
+        if self.max_idle <= 0:
+            writer.close()
+            return
+        self.idle.append((reader, writer, time.monotonic()))
+        while len(self.idle) > self.max_idle:
+            self.idle.popleft()[1].close()
+        _start_sweeper()
+
+    def sweep(self, now):
+        while self.idle and now - self.idle[0][2] > self.idle_timeout:
+            self.idle.popleft()[1].close()
+
+
+_settings = {}
+_pools = {}
+_sweeper = None
+# Counts of pools dropped by the sweeper, so the totals don't go backwards
+_retired = {"hits": 0, "misses": 0}
+
+
+def configure(config):
+    global _settings
+    _settings = config.get("http_forward", {})
+
+
+def get_pool(account_config, upstream, host, port):
+    """Shared pool for an account's upstream and origin"""
+    key = (account_config["email"], upstream["name"], host, port)
+    pool = _pools.get(key)
+    if pool is None:
+        settings = dict(_settings)
+        settings.update(account_config.get("http_forward", {}))
+        pool = _pools[key] = OriginPool(settings.get("pool_max_idle", DEFAULT_POOL_MAX_IDLE),
+                                        settings.get("pool_idle_timeout", DEFAULT_POOL_IDLE_TIMEOUT))
+    return pool
+
+
+def _sweep_interval():
+    """Half the shortest idle timeout of the pools (at least a second)"""
+    shortest = min((pool.idle_timeout for pool in _pools.values()), default=DEFAULT_POOL_IDLE_TIMEOUT)
+    return max(shortest / 2, 1.0)
+
+
+async def _sweep():
+    while True:
+        await asyncio.sleep(_sweep_interval())
+        now = time.monotonic()
+        for key, pool in list(_pools.items()):
+            pool.sweep(now)
+            # A pool with a request in flight gets that connection back
+            if not pool.idle and not pool.in_use:
+                _retired["hits"] += pool.hits
+                _retired["misses"] += pool.misses
+                del _pools[key]
+
+
+def _start_sweeper():
+    global _sweeper
+    if _sweeper is None or _sweeper.done():
+        _sweeper = asyncio.create_task(_sweep())
+
+
+def pool_stats():
+    pools = list(_pools.values())
+    return {
+        "origins": len(pools),
+        "idle": sum(len(p.idle) for p in pools),
+        "hits": _retired["hits"] + sum(p.hits for p in pools),
+        "misses": _retired["misses"] + sum(p.misses for p in pools),
+    }
+
+
+async def _copy_length(reader, writer, length, stats, attr):
+    while length > 0:
+        data = await reader.read(min(length, CHUNK_SIZE))
+        if not data:
+            raise asyncio.IncompleteReadError(b"", length)
+        writer.write(data)
+        length -= len(data)
+        setattr(stats, attr, getattr(stats, attr) + len(data))
+        await writer.drain()
+
+
+async def _copy_chunked(reader, writer, stats, attr, decode=False):
+    """Copy a chunked body; decode=True writes only the chunk data"""
+    while True:
+        size_line = await reader.readuntil(b"\r\n")
+        try:
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise ForwardError(f"bad chunk size line {size_line[:40]!r}")
+        if not decode:
+            writer.write(size_line)
+        if size == 0:
+            # Trailer section ends with an empty line
+            while True:
+                line = await reader.readuntil(b"\r\n")
+                if not decode:
+                    writer.write(line)
+                if line == b"\r\n":
+                    break
+            await writer.drain()
+            return
+        await _copy_length(reader, writer, size, stats, attr)
+        crlf = await reader.readexactly(2)
+        if not decode:
+            writer.write(crlf)
+
+
+async def _copy_until_close(reader, writer, stats, attr):
+    while True:
+        data = await reader.read(CHUNK_SIZE)
+        if not data:
+            return
+        writer.write(data)
+        setattr(stats, attr, getattr(stats, attr) + len(data))
+        await writer.drain()
+
+
+async def _read_response_head(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head[:-4].split(b"\r\n")
+    parts = lines[0].split(b" ", 2)
+    try:
+        status = int(parts[1])
+        headers = [split_header(line) for line in lines[1:]]
+    except (IndexError, ValueError) as e:
+        raise ForwardError(f"bad response head from origin: {e}")
+    return lines[0], parts[0], status, headers
+
+
+async def _exchange(conn, client_reader, client_writer, request, stats):
+    """Send the request on conn and return the final response head"""
+    reader, writer = conn
+    writer.write(request.head())
+    if request.expect_continue and request.version == "HTTP/1.1" and request.framing != FRAMING_NONE:
+        # The client holds its body back until it sees 100 Continue. Waiting
+        # for the origin's would stall here, so answer it ourselves (the
+        # Expect header is not forwarded); bodies are never resent, so this
+        # happens once per request.
+        client_writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        await client_writer.drain()
+    if request.framing == FRAMING_LENGTH:
+        await _copy_length(client_reader, writer, request.length, stats, "bytes_up")
+    elif request.framing == FRAMING_CHUNKED:
+        await _copy_chunked(client_reader, writer, stats, "bytes_up")
+    await writer.drain()
+
+    while True:
+        status_line, version, status, headers = await _read_response_head(reader)
+        if not 100 <= status < 200:
+            return status_line, version, status, headers
+        # Interim response (e.g. 103 Early Hints): pass it on, HTTP/1.0 clients don't expect them
+        if request.version == "HTTP/1.1":
+            client_writer.write(b"\r\n".join([status_line] + _forwarded_headers(headers)) + b"\r\n\r\n")
+
+
+async def forward(client_reader, client_writer, request, upstream, account_config, stats,
+                  connect_timeout=None, trace=None):
+    """Forward one request and stream the response back.
+
+    Returns True if the client connection can carry another request.
+    Raises ForwardError before anything was sent to the client, and
+    upstream.UpstreamError if the upstream connect failed. trace (the
+    connection's tunnel_trace.Timeline) is marked "replied" when the
+    first response head goes to the client.
+    """
+    pool = get_pool(account_config, upstream, request.host, request.port)
+    pool.in_use += 1
+    try:
+        return await _forward(pool, client_reader, client_writer, request, upstream, stats, connect_timeout,
+                              trace)
+    finally:
+        pool.in_use -= 1
+
+
+async def _forward(pool, client_reader, client_writer, request, upstream, stats, connect_timeout, trace):
+    conn = pool.take()
+    reused = conn is not None
+    while True:
+        if conn is None:
+            conn = await open_tunnel(upstream, request.host, request.port, timeout=connect_timeout,
+                                     until_closed=True)
+        try:
+            status_line, version, status, headers = await _exchange(
+                conn, client_reader, client_writer, request, stats)
+            break
+        except ForwardError:
+            conn[1].close()
+            raise
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            conn[1].close()
+            if reused and request.method in RETRY_METHODS and request.framing == FRAMING_NONE:
+                logger.debug(f"Reused connection to {request.host}:{request.port} failed ({e!r}), retrying")
+                conn, reused = None, False
+                continue
+            raise ForwardError(f"{request.host}:{request.port} closed before responding: {e!r}")
+    reader, writer = conn
+
+    try:
+        framing = _framing(headers)
+    except ValueError as e:
+        writer.close()
+        raise ForwardError(str(e))
+    if request.method == "HEAD" or status in (204, 304):
+        framing = (FRAMING_NONE, 0)
+    framing, length = framing or (FRAMING_CLOSE, None)
+
+    decode = framing == FRAMING_CHUNKED and request.version != "HTTP/1.1"
+    keep_client = request.client_keep_alive and framing != FRAMING_CLOSE and not decode
+    keep_upstream = (framing != FRAMING_CLOSE and version == b"HTTP/1.1"
+                     and b"close" not in _tokens(headers, b"connection"))
+    drop = (b"transfer-encoding",) if decode else ()
+    lines = [status_line] + _forwarded_headers(headers, drop)
+    lines.append(b"Connection: keep-alive" if keep_client else b"Connection: close")
+    client_writer.write(b"\r\n".join(lines) + b"\r\n\r\n")
+    if trace is not None and "replied" not in trace.marks:
+        trace.mark("replied")
+
+    try:
+        if framing == FRAMING_LENGTH:
+            await _copy_length(reader, client_writer, length, stats, "bytes_down")
+        elif framing == FRAMING_CHUNKED:
+            await _copy_chunked(reader, client_writer, stats, "bytes_down", decode)
+        elif framing == FRAMING_CLOSE:
+            await _copy_until_close(reader, client_writer, stats, "bytes_down")
+        await client_writer.drain()
+    except ForwardError as e:
+        # Too late for an error reply, the client already has the status line
+        writer.close()
+        raise ConnectionResetError(str(e))
+    except BaseException:
+        writer.close()
+        raise
+
+    if keep_upstream:
+        pool.put(reader, writer)
+    else:
+        writer.close()
+    return keep_client
@@ -0,0 +1,120 @@
+"""Bounded, single-pass HTTP request head parsing for the HTTP proxy.
+
+The whole head (request line and headers) is taken off the stream with
+one readuntil(b"\\r\\n\\r\\n") and split in one pass, instead of one
+readline() per line. The head may be at most MAX_HEAD_SIZE bytes; longer
+heads (or too many headers) get 431 Request Header Fields Too Large.
+Buffering is also capped by the stream's own limit (64 KiB by default),
+so a client that never sends the blank line can't grow it further.
+
+Header lines are only split into (name, value) pairs when `headers` is
+first used (plain-HTTP forwarding), so a CONNECT never pays for them;
+`host` and `proxy_authorization` look their header up on first access.
+Header names and values stay bytes; only the request line is decoded
+(latin-1, which can't fail). Lines must end in CRLF.
+"""
+import asyncio
+
+import timeouts
+
+MAX_HEAD_SIZE = 16 * 1024
+MAX_HEADERS = 100
+HEAD_END = b"\r\n\r\n"
+
+
+class BadHead(ValueError):
+    """Malformed request head (answered with 400)"""
+
+
+class HeadTooLarge(Exception):
+    """Head over MAX_HEAD_SIZE bytes or MAX_HEADERS lines (answered with 431)"""
+
+
+class RequestHead:
+    __slots__ = ("method", "target", "version", "_lines", "_headers")
+
+    def __init__(self, method, target, version, lines):
+        self.method = method
+        self.target = target
+        self.version = version
+        self._lines = lines                           # raw header lines
+        self._headers = None
+
+    def __repr__(self):
+        return f"RequestHead({self.method} {self.target} {self.version}, {len(self._lines)} headers)"
+
+    @property
+    def headers(self):
+        """[(name, value), ...] as bytes, split on first use; raises BadHead"""
+        if self._headers is None:
+            self._headers = [split_header(line) for line in self._lines]
+        return self._headers
+
+    def header(self, name):
+        """Value of the last header called name (lowercase bytes), or None"""
+        if self._headers is not None:
+            for key, value in reversed(self._headers):
+                if key.lower() == name:
+                    return value
+            return None
+        # Only the matching line is split
+        prefix = name + b":"
+        for line in reversed(self._lines):
+            if line[:len(prefix)].lower() == prefix:
+                return line[len(prefix):].strip()
+        return None
+
+    @property
+    def host(self):
+        """Host header value or None"""
+        return self.header(b"host")
+
+    @property
+    def proxy_authorization(self):
+        """Proxy-Authorization header value or None"""
+        return self.header(b"proxy-authorization")
+
+
+def split_header(line):
+    name, sep, value = line.partition(b":")
+    # Whitespace around the name is a smuggling vector (RFC 9112 5.1)
+    if not sep or not name or name[-1:] in b" \t" or name[:1] in b" \t":
+        raise BadHead(f"malformed header line {line[:60]!r}")
+    return name, value.strip()
+
+
+def parse(data, max_headers=MAX_HEADERS):
+    """RequestHead from a head without its final CRLFCRLF; raises BadHead"""
+    # A stray CRLF after a previous request's body is allowed (RFC 9112 2.2)
+    data = data.lstrip(b"\r\n")
+    lines = data.split(b"\r\n")
+    if len(lines) - 1 > max_headers:
+        raise HeadTooLarge(f"{len(lines) - 1} header lines")
+    parts = lines[0].split()
+    if len(parts) != 3:
+        raise BadHead(f"bad request line {lines[0][:80]!r}")
+    method, target, version = parts
+    return RequestHead(method.decode("latin-1"), target.decode("latin-1"), version.decode("latin-1"),
+                       lines[1:])
+
+
+async def read_head(reader, deadline=None, prefix=b"", max_size=MAX_HEAD_SIZE):
+    """Read and parse the next request head, or None if the client sent none.
+
+    prefix holds bytes of the head already read off the connection.
+    Raises HeadTooLarge, BadHead or asyncio.TimeoutError (past deadline).
+    """
+    try:
+        data = await timeouts.before(deadline, reader.readuntil(HEAD_END))
+    except asyncio.IncompleteReadError:
+        # Closed before a complete head; nothing to answer
+        return None
+    except asyncio.LimitOverrunError:
+        raise HeadTooLarge("head exceeds the stream limit")
+    if prefix:
+        data = prefix + data
+    if len(data) > max_size:
+        raise HeadTooLarge(f"{len(data)} byte head")
+    if len(data) == len(HEAD_END):
+        return None
+    return parse(data[:-len(HEAD_END)])
@@ -4,6 +4,16 @@ SETUP_DIR="$HOME/vpn_v2"
 PROXY_LOG="$SETUP_DIR/proxy.log"
 SURVEY_LOG="$SETUP_DIR/survey.log"
 TOR_LOG="$SETUP_DIR/tor.log"
+# SO_REUSEPORT worker processes for the proxy (0 = single process)
+PROXY_WORKERS="${PROXY_WORKERS:-0}"
+# "combined" serves SOCKS5 and HTTP on one port per account
+PROXY_MODE="${PROXY_MODE:-legacy}"
+# Prometheus /metrics port for the proxy (0 = disabled)
+PROXY_METRICS_PORT="${PROXY_METRICS_PORT:-0}"
+# Reload config.json on change, polling every N seconds (0 = only on "reload")
+PROXY_WATCH_CONFIG="${PROXY_WATCH_CONFIG:-0}"
+# Seconds open tunnels may finish when the proxy stops or hands over to a new one
+PROXY_DRAIN_TIMEOUT="${PROXY_DRAIN_TIMEOUT:-30}"
 
 # Colors
 RED='\033[0;31m'
@@ -11,6 +21,12 @@ GREEN='\033[0;32m'
 YELLOW='\033[1;33m'
 NC='\033[0m' # No Color
 
+# Ports the running proxies actually listen on (ports.json), e.g. proxy_ports --kind http
+proxy_ports() {
+    local ports=$(python3 "$SETUP_DIR/port_map.py" --config "$SETUP_DIR/config.json" --ports "$@" 2>/dev/null)
+    echo "${ports:-8888 8889}"
+}
+
 check_process() {
     local pid_file="$1"
     local name="$2"
@@ -65,13 +81,18 @@ check_process() {
 kill_process() {
     local pid_file="$1"
     local name="$2"
+    # Seconds to wait after SIGTERM before SIGKILL
+    local wait="${3:-2}"
     
     if [ -f "$pid_file" ]; then
         local pid=$(cat "$pid_file")
         if ps -p "$pid" > /dev/null 2>&1; then
             echo "Stopping $name (PID $pid)..."
             kill -15 "$pid" 2>/dev/null
-            sleep 2
+            for i in $(seq 1 "$wait"); do
+                ps -p "$pid" > /dev/null 2>&1 || break
+                sleep 1
+            done
             
             # Force kill if still running
             if ps -p "$pid" > /dev/null 2>&1; then
@@ -104,6 +125,34 @@ cleanup_old_processes() {
     sleep 1
 }
 
+# Pick the proxy script and its arguments (sets proxy_script and proxy_args)
+select_proxy() {
+    # Use combined proxy if requested, then stream-based proxy, then fixed version, then original
+    if [ "$PROXY_MODE" = "combined" ] && [ -f "$SETUP_DIR/swiss_combined_proxy.py" ]; then
+        proxy_script="swiss_combined_proxy.py"
+    elif [ -f "$SETUP_DIR/swiss_proxy_stream.py" ]; then
+        proxy_script="swiss_proxy_stream.py"
+    elif [ -f "$SETUP_DIR/smart_proxy_v2_fixed.py" ]; then
+        proxy_script="smart_proxy_v2_fixed.py"
+    else
+        proxy_script="smart_proxy_v2.py"
+    fi
+    
+    proxy_args=""
+    if [ "${proxy_script#swiss_}" != "$proxy_script" ] && [ "$PROXY_WORKERS" -gt 0 ]; then
+        proxy_args="--workers $PROXY_WORKERS"
+    fi
+    if [ "${proxy_script#swiss_}" != "$proxy_script" ] && [ "$PROXY_METRICS_PORT" -gt 0 ]; then
+        proxy_args="$proxy_args --metrics-port $PROXY_METRICS_PORT"
+    fi
+    if [ "${proxy_script#swiss_}" != "$proxy_script" ] && [ "$PROXY_WATCH_CONFIG" != "0" ]; then
+        proxy_args="$proxy_args --watch-config $PROXY_WATCH_CONFIG"
+    fi
+    if [ "${proxy_script#swiss_}" != "$proxy_script" ]; then
+        proxy_args="$proxy_args --drain-timeout $PROXY_DRAIN_TIMEOUT"
+    fi
+}
+
 start_all() {
     echo "🚀 Starting VPN v2 services..."
     echo ""
@@ -136,16 +185,8 @@ start_all() {
     echo ""
     echo "Starting Smart Proxy v2..."
     
-    # Use stream-based proxy first, then fixed version, then original
-    if [ -f "$SETUP_DIR/swiss_proxy_stream.py" ]; then
-        proxy_script="swiss_proxy_stream.py"
-    elif [ -f "$SETUP_DIR/smart_proxy_v2_fixed.py" ]; then
-        proxy_script="smart_proxy_v2_fixed.py"
-    else
-        proxy_script="smart_proxy_v2.py"
-    fi
-    
-    nohup python3 "$SETUP_DIR/$proxy_script" > "$PROXY_LOG" 2>&1 &
+    select_proxy
+    nohup python3 "$SETUP_DIR/$proxy_script" $proxy_args > "$PROXY_LOG" 2>&1 &
     local proxy_pid=$!
     echo $proxy_pid > "$SETUP_DIR/proxy.pid"
     
@@ -190,7 +231,8 @@ stop_all() {
     echo ""
     
     kill_process "$SETUP_DIR/survey.pid" "Survey automation"
-    kill_process "$SETUP_DIR/proxy.pid" "Smart proxy"
+    # Open tunnels get PROXY_DRAIN_TIMEOUT seconds to finish
+    kill_process "$SETUP_DIR/proxy.pid" "Smart proxy" $((${PROXY_DRAIN_TIMEOUT%.*} + 5))
     kill_process "$SETUP_DIR/tor.pid" "Tor"
     
     # Final cleanup
@@ -200,6 +242,40 @@ stop_all() {
     echo -e "${GREEN}✓${NC} All services stopped"
 }
 
+reload_proxy() {
+    local pid_file="$SETUP_DIR/proxy.pid"
+    local pid=$(cat "$pid_file" 2>/dev/null)
+    if [ ! -z "$pid" ] && ps -p "$pid" > /dev/null 2>&1; then
+        # Open tunnels are kept; see "Config reload" in SWISS_PROXY_README.md
+        kill -HUP "$pid"
+        echo -e "${GREEN}✓${NC} Sent reload to proxy (PID $pid). Check $PROXY_LOG"
+    else
+        echo -e "${RED}✗${NC} Proxy not running"
+        return 1
+    fi
+}
+
+graceful_restart() {
+    local pid_file="$SETUP_DIR/proxy.pid"
+    local old_pid=$(cat "$pid_file" 2>/dev/null)
+    select_proxy
+    if [ "${proxy_script#swiss_}" = "$proxy_script" ]; then
+        echo -e "${RED}✗${NC} $proxy_script has no graceful restart, use restart"
+        return 1
+    fi
+    # The new proxy takes the listening sockets over; the old one drains and exits
+    nohup python3 "$SETUP_DIR/$proxy_script" $proxy_args --takeover >> "$PROXY_LOG" 2>&1 &
+    local new_pid=$!
+    sleep 3
+    if ps -p "$new_pid" > /dev/null 2>&1; then
+        echo $new_pid > "$pid_file"
+        echo -e "${GREEN}✓${NC} Proxy restarted (PID $new_pid); PID ${old_pid:-?} drains for up to ${PROXY_DRAIN_TIMEOUT}s"
+    else
+        echo -e "${RED}✗${NC} New proxy failed to start, the old one keeps serving. Check $PROXY_LOG"
+        return 1
+    fi
+}
+
 status() {
     echo "📊 VPN v2 Status"
     echo "================"
@@ -221,7 +297,7 @@ status() {
     check_process "$SETUP_DIR/proxy.pid" "Smart Proxy"
     if [ $? -eq 0 ]; then
         echo "   Checking ports..."
-        for port in 8888 8889; do
+        for port in $(proxy_ports); do
             # Check with netstat first (for compatibility)
             if netstat -tuln 2>/dev/null | grep -q ":$port "; then
                 echo -e "   Port $port: ${GREEN}listening${NC}"
@@ -264,7 +340,7 @@ test_routing() {
     echo ""
     echo "Testing proxy ports:"
     
-    for port in 8888 8889; do
+    for port in $(proxy_ports --kind http --kind combined); do
         echo ""
         echo "Port $port:"
         if curl -s -x http://127.0.0.1:$port https://ipapi.co/json/ --connect-timeout 5 | python3 -m json.tool | grep -E '"ip"|"country"' 2>/dev/null; then
@@ -309,6 +385,12 @@ case "$1" in
         sleep 2
         start_all
         ;;
+    reload)
+        reload_proxy
+        ;;
+    graceful-restart)
+        graceful_restart
+        ;;
     status)
         status
         ;;
@@ -318,6 +400,10 @@ case "$1" in
     logs)
         logs "$2"
         ;;
+    stats)
+        shift
+        python3 "$SETUP_DIR/stats_reader.py" "$SETUP_DIR" "$@"
+        ;;
     clean)
         cleanup_old_processes
         echo "Cleanup complete"
@@ -325,13 +411,16 @@ case "$1" in
     *)
         echo "VPN v2 Manager"
         echo "=============="
-        echo "Usage: $0 {start|stop|restart|status|test|logs|clean}"
+        echo "Usage: $0 {start|stop|restart|graceful-restart|reload|status|stats|test|logs|clean}"
         echo ""
         echo "Commands:"
         echo "  start   - Start all services"
         echo "  stop    - Stop all services"
         echo "  restart - Restart all services"
+        echo "  graceful-restart - Restart the proxy without dropping tunnels or connections"
+        echo "  reload  - Reload proxy config.json without dropping tunnels"
         echo "  status  - Show status of services"
+        echo "  stats   - Live per-account counters from the stats files (--watch N, --json, --check)"
         echo "  test    - Test IP routing"
         echo "  logs    - View logs (tor|proxy|survey)"
         echo "  clean   - Clean up old processes"
@@ -0,0 +1,346 @@
+"""Prometheus metrics for the proxies.
+
+Per account and upstream: connections, connection rate, active tunnels,
+bytes per direction, handshake and upstream-connect latency histograms,
+Tor SOCKS reply error codes and errors by stage. Tunnels are counted under
+the upstream they were routed through (a fallback during failover), what
+happens before routing under the account's primary. Admission control queue
+depth and rejections per limiter. Bandwidth rates and limits per account
+and upstream (bandwidth.py). Load, connect latency and ejection state of
+balanced Tor endpoints. Upstream health probe results. Process-wide
+counters (Tor pool, DNS cache, relay buffers) come from the proxy's
+worker_stats().
+
+Updates are plain attribute increments on a per-account object, so they
+stay on for every connection; the text exposition is only built when
+/metrics is scraped. No prometheus_client dependency.
+
+Enable with --metrics-port (listens on 127.0.0.1 unless --metrics-host is
+given). In --workers mode worker N listens on metrics-port + N. The same
+listener answers GET /health with the upstream prober's results as JSON
+(503 if an account has no upstream left that isn't down), GET /traces
+with the buffered tunnel timelines (tunnel_trace.py) and GET /bandwidth
+with the current rates and limits as JSON.
+"""
+import asyncio
+import bisect
+import errno
+import json
+import logging
+import time
+
+import admission
+import bandwidth
+import tor_balancer
+import tunnel_trace
+import upstream_health
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "swiss_proxy"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Connections/sec is averaged over at least this many seconds
+RATE_WINDOW = 10.0
+MAX_REQUEST_HEAD = 8192
+# Seconds a scraper gets to send its request head
+REQUEST_TIMEOUT = 5.0
+# How long start_server() retries a port in use; a proxy taken over
+# (graceful.py) frees it as soon as it starts draining
+BIND_WAIT = 5.0
+# worker_stats() values that can go down; every other one only ever grows
+PROCESS_GAUGES = frozenset((
+    "active_tunnels", "admission_active", "admission_queued",
+    "relay_buffered_bytes", "traces_buffered",
+))
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count", "last")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.last = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.last = value
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class AccountMetrics:
+    """Counters for one account/upstream pair"""
+    __slots__ = ("account", "upstream", "labels", "connections", "active_tunnels", "bytes_up", "bytes_down",
+                 "handshake", "upstream_connect", "tor_reply_errors", "errors", "_rate_sample")
+
+    def __init__(self, account, upstream):
+        self.account = account
+        self.upstream = upstream
+        self.labels = f'account="{_escape(account)}",upstream="{_escape(upstream)}"'
+        self.connections = 0
+        self.active_tunnels = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.handshake = Histogram()
+        self.upstream_connect = Histogram()
+        self.tor_reply_errors = {}   # Tor SOCKS reply code -> count
+        self.errors = {}             # stage -> count
+        self._rate_sample = (time.monotonic(), 0)
+
+    def error(self, stage):
+        self.errors[stage] = self.errors.get(stage, 0) + 1
+
+    def upstream_error(self, e):
+        """Count an upstream.UpstreamError by stage and Tor reply code"""
+        self.error(e.stage)
+        if e.reply_code is not None:
+            self.tor_reply_errors[e.reply_code] = self.tor_reply_errors.get(e.reply_code, 0) + 1
+
+    def connection_rate(self, now):
+        sampled_at, sampled = self._rate_sample
+        elapsed = now - sampled_at
+        rate = (self.connections - sampled) / elapsed if elapsed > 0 else 0.0
+        if elapsed >= RATE_WINDOW:
+            self._rate_sample = (now, self.connections)
+        return rate
+
+
+_accounts = {}
+
+
+def for_account(account_config, upstream=None):
+    """Metrics object for an account and the upstream its tunnel was routed through.
+
+    upstream defaults to the account's primary, which is what connections
+    and errors before routing are counted under.
+    """
+    key = (account_config["email"], (upstream or account_config["upstream"])["name"])
+    m = _accounts.get(key)
+    if m is None:
+        m = _accounts[key] = AccountMetrics(*key)
+    return m
+
+
+def account_metrics():
+    """Every AccountMetrics created so far"""
+    return list(_accounts.values())
+
+
+_STATUS_VALUE = {upstream_health.STATUS_UP: 1, upstream_health.STATUS_SLOW: 0.5,
+                 upstream_health.STATUS_DOWN: 0}
+
+
+def _family(lines, name, kind, help_text, samples):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    lines.extend(samples)
+
+
+def render(process_stats=None):
+    """Prometheus text exposition of all metrics"""
+    now = time.monotonic()
+    accounts = list(_accounts.values())
+    lines = []
+    _family(lines, f"{PREFIX}_connections_total", "counter", "Client connections accepted",
+            [f"{PREFIX}_connections_total{{{m.labels}}} {m.connections}" for m in accounts])
+    _family(lines, f"{PREFIX}_connections_per_second", "gauge",
+            f"Client connection rate over the last {RATE_WINDOW:g}-{2 * RATE_WINDOW:g}s",
+            [f"{PREFIX}_connections_per_second{{{m.labels}}} {m.connection_rate(now):.3f}"
+             for m in accounts])
+    _family(lines, f"{PREFIX}_active_tunnels", "gauge", "Tunnels currently relaying",
+            [f"{PREFIX}_active_tunnels{{{m.labels}}} {m.active_tunnels}" for m in accounts])
+    samples = []
+    for m in accounts:
+        samples.append(f'{PREFIX}_bytes_total{{{m.labels},direction="up"}} {m.bytes_up}')
+        samples.append(f'{PREFIX}_bytes_total{{{m.labels},direction="down"}} {m.bytes_down}')
+    _family(lines, f"{PREFIX}_bytes_total", "counter",
+            "Bytes relayed by closed tunnels (up = client to target)", samples)
+    _family(lines, f"{PREFIX}_handshake_seconds", "histogram",
+            "Time from accept to the client's success reply",
+            [line for m in accounts for line in m.handshake.render(f"{PREFIX}_handshake_seconds", m.labels)])
+    _family(lines, f"{PREFIX}_upstream_connect_seconds", "histogram",
+            "Time to open the tunnel through the upstream",
+            [line for m in accounts
+             for line in m.upstream_connect.render(f"{PREFIX}_upstream_connect_seconds", m.labels)])
+    _family(lines, f"{PREFIX}_tor_reply_errors_total", "counter", "Tor SOCKS CONNECT replies by error code",
+            [f'{PREFIX}_tor_reply_errors_total{{{m.labels},code="{code}"}} {count}'
+             for m in accounts for code, count in sorted(m.tor_reply_errors.items())])
+    _family(lines, f"{PREFIX}_errors_total", "counter", "Failed connections by stage",
+            [f'{PREFIX}_errors_total{{{m.labels},stage="{_escape(stage)}"}} {count}'
+             for m in accounts for stage, count in sorted(m.errors.items())])
+
+    limits = admission.stats()
+    limiters = [('limiter="global"', limits["global"])]
+    limiters += [(f'limiter="account",account="{_escape(email)}"', stats)
+                 for email, stats in limits["accounts"].items()]
+    _family(lines, f"{PREFIX}_admission_active", "gauge", "Tunnels holding an admission slot",
+            [f"{PREFIX}_admission_active{{{labels}}} {stats['active']}" for labels, stats in limiters])
+    _family(lines, f"{PREFIX}_admission_queued", "gauge", "Connections waiting for an admission slot",
+            [f"{PREFIX}_admission_queued{{{labels}}} {stats['queued']}" for labels, stats in limiters])
+    _family(lines, f"{PREFIX}_admission_rejected_total", "counter",
+            "Connections rejected by admission control",
+            [f'{PREFIX}_admission_rejected_total{{{labels},reason="{reason}"}} {stats["rejected_" + reason]}'
+             for labels, stats in limiters
+             for reason in (admission.REASON_QUEUE_FULL, admission.REASON_TIMEOUT)])
+
+    shaping = bandwidth.bandwidth_stats()
+    rates = [(f'account="{_escape(email)}",direction="{direction}"', stats)
+             for email, directions in sorted(shaping["accounts"].items())
+             for direction, stats in sorted(directions.items())]
+    _family(lines, f"{PREFIX}_bandwidth_bytes_per_second", "gauge",
+            f"Relayed bytes per second over the last {bandwidth.RATE_WINDOW:g}-{2 * bandwidth.RATE_WINDOW:g}s",
+            [f"{PREFIX}_bandwidth_bytes_per_second{{{labels}}} {stats['rate']}" for labels, stats in rates])
+    _family(lines, f"{PREFIX}_bandwidth_limit_bytes_per_second", "gauge", "Account bandwidth limit",
+            [f"{PREFIX}_bandwidth_limit_bytes_per_second{{{labels}}} {stats['limit']}"
+             for labels, stats in rates if stats["limit"]])
+    _family(lines, f"{PREFIX}_bandwidth_throttled_total", "counter", "Reads held back by an account's limit",
+            [f"{PREFIX}_bandwidth_throttled_total{{{labels}}} {stats['throttled']}" for labels, stats in rates])
+    links = [(f'upstream="{_escape(name)}",direction="{direction}"', stats)
+             for name, directions in sorted(shaping["upstreams"].items())
+             for direction, stats in sorted(directions.items())]
+    _family(lines, f"{PREFIX}_upstream_bandwidth_bytes_per_second", "gauge",
+            "Bytes per second relayed through an upstream",
+            [f"{PREFIX}_upstream_bandwidth_bytes_per_second{{{labels}}} {stats['rate']}" for labels, stats in links])
+    _family(lines, f"{PREFIX}_upstream_bandwidth_capacity_bytes_per_second", "gauge",
+            "Upstream capacity shared fairly between accounts",
+            [f"{PREFIX}_upstream_bandwidth_capacity_bytes_per_second{{{labels}}} {stats['capacity']}"
+             for labels, stats in links if stats["capacity"]])
+    _family(lines, f"{PREFIX}_upstream_bandwidth_queued_total", "counter",
+            "Reads that waited for their fair share of an upstream",
+            [f"{PREFIX}_upstream_bandwidth_queued_total{{{labels}}} {stats['queued']}" for labels, stats in links
+             if stats["capacity"]])
+
+    endpoints = sorted(tor_balancer.endpoint_stats().items())
+    _family(lines, f"{PREFIX}_tor_endpoint_outstanding", "gauge",
+            "Tunnels open or connecting through a balanced Tor endpoint",
+            [f'{PREFIX}_tor_endpoint_outstanding{{endpoint="{name}"}} {stats["outstanding"]}'
+             for name, stats in endpoints])
+    _family(lines, f"{PREFIX}_tor_endpoint_connect_ewma_seconds", "gauge",
+            "EWMA of connect latency through a balanced Tor endpoint",
+            [f'{PREFIX}_tor_endpoint_connect_ewma_seconds{{endpoint="{name}"}} {stats["ewma_seconds"]}'
+             for name, stats in endpoints if stats["ewma_seconds"] is not None])
+    _family(lines, f"{PREFIX}_tor_endpoint_ejected", "gauge", "1 while a Tor endpoint is ejected",
+            [f'{PREFIX}_tor_endpoint_ejected{{endpoint="{name}"}} {int(stats["ejected"])}'
+             for name, stats in endpoints])
+    _family(lines, f"{PREFIX}_tor_endpoint_errors_total", "counter",
+            "Failed connections to a balanced Tor endpoint's SOCKS port",
+            [f'{PREFIX}_tor_endpoint_errors_total{{endpoint="{name}"}} {stats["errors"]}'
+             for name, stats in endpoints])
+
+    upstreams = sorted(upstream_health.health_stats().items())
+    _family(lines, f"{PREFIX}_upstream_up", "gauge",
+            "Last health probe verdict: 1 up, 0.5 slow, 0 down (unprobed upstreams omitted)",
+            [f'{PREFIX}_upstream_up{{upstream="{_escape(name)}"}} {_STATUS_VALUE[stats["status"]]}'
+             for name, stats in upstreams if stats["status"] in _STATUS_VALUE])
+    _family(lines, f"{PREFIX}_upstream_probe_latency_seconds", "gauge",
+            "Median latency of successful health probes in the window",
+            [f'{PREFIX}_upstream_probe_latency_seconds{{upstream="{_escape(name)}"}} {stats["median_latency"]}'
+             for name, stats in upstreams if stats["median_latency"] is not None])
+    _family(lines, f"{PREFIX}_upstream_probe_success_ratio", "gauge",
+            "Share of successful health probes in the window",
+            [f'{PREFIX}_upstream_probe_success_ratio{{upstream="{_escape(name)}"}} {stats["success_rate"]}'
+             for name, stats in upstreams if stats["success_rate"] is not None])
+
+    for key, value in sorted((process_stats or {}).items()):
+        if key == "pid" or not isinstance(value, (int, float)):
+            continue
+        kind = "gauge" if key in PROCESS_GAUGES else "counter"
+        _family(lines, f"{PREFIX}_process_{key}", kind, f"Process counter {key}",
+                [f"{PREFIX}_process_{key} {value}"])
+    return "\n".join(lines) + "\n"
+
+
+def health_report(accounts=()):
+    """(healthy, report) for GET /health; accounts are account configs"""
+    upstreams = upstream_health.health_stats()
+    routes = {}
+    for account_config in accounts:
+        upstream = upstream_health.route(account_config)
+        routes[account_config["email"]] = {
+            "upstream": upstream["name"],
+            "status": upstreams.get(upstream["name"], {}).get("status", upstream_health.STATUS_UNKNOWN),
+        }
+    healthy = all(route["status"] != upstream_health.STATUS_DOWN for route in routes.values())
+    return healthy, {"status": "ok" if healthy else "degraded", "accounts": routes, "upstreams": upstreams}
+
+
+async def _handle_scrape(reader, writer, process_stats, accounts):
+    try:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT)
+        parts = head.split(b" ", 2)
+        path, _, query = parts[1].partition(b"?") if len(parts) >= 2 and parts[0] == b"GET" else (None, b"", b"")
+        params = dict(param.partition(b"=")[::2] for param in query.split(b"&") if param)
+        if path == b"/metrics":
+            body = render(process_stats() if process_stats else None).encode()
+            status = b"200 OK"
+            content_type = b"text/plain; version=0.0.4; charset=utf-8"
+        elif path == b"/health":
+            healthy, report = health_report(accounts() if accounts else ())
+            body = json.dumps(report, indent=2).encode() + b"\n"
+            status = b"200 OK" if healthy else b"503 Service Unavailable"
+            content_type = b"application/json"
+        elif path == b"/traces":
+            slow_only = params.get(b"slow") == b"1"
+            if params.get(b"format") == b"otlp":
+                body = json.dumps(tunnel_trace.export_otlp(slow_only)).encode()
+                content_type = b"application/json"
+            else:
+                body = tunnel_trace.export_jsonl(slow_only).encode()
+                content_type = b"application/x-ndjson"
+            status = b"200 OK"
+        elif path == b"/bandwidth":
+            body = json.dumps(bandwidth.bandwidth_stats(), indent=2).encode() + b"\n"
+            status = b"200 OK"
+            content_type = b"application/json"
+        else:
+            body = b"Not Found\n"
+            status = b"404 Not Found"
+            content_type = b"text/plain"
+        writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: " + content_type
+                     + b"\r\nContent-Length: " + str(len(body)).encode()
+                     + b"\r\nConnection: close\r\n\r\n" + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(host, port, process_stats=None, accounts=None, wait=BIND_WAIT):
+    """Serve GET /metrics, GET /health, GET /traces and GET /bandwidth.
+
+    process_stats is a callable returning extra counters, accounts one
+    returning the account configs whose routes /health reports. A port in
+    use is retried for up to wait seconds, then OSError is raised.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            server = await asyncio.start_server(
+                lambda r, w: _handle_scrape(r, w, process_stats, accounts), host, port,
+                reuse_address=True, limit=MAX_REQUEST_HEAD)
+            break
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE or time.monotonic() >= deadline:
+                raise
+            await asyncio.sleep(0.1)
+    logger.info(f"Metrics endpoint: http://{host}:{port}/metrics (health: /health, traces: /traces, bandwidth: /bandwidth)")
+    return server
@@ -0,0 +1,190 @@
+"""Listener binding and the port map state file.
+
+Listening sockets are bound directly instead of probing a port with a
+throwaway socket and binding it again later (which another process could
+win in between). Every account's requested port is tried in one pass
+first, so a fallback never takes a port another account asked for; only
+the accounts whose port is in use (EADDRINUSE) then search upwards. The
+bound sockets go to asyncio.start_server(sock=...).
+
+The resulting port map is written to ports.json next to config.json so
+manager_v2.sh and the survey service know where each account ended up:
+
+    {"http": {"pid": 1234, "updated_at": "...", "ports": {"user@example.com": 8888}},
+     "socks5": {...}, "combined": {...}}
+
+    python3 port_map.py [--kind http] [--ports]
+"""
+import argparse
+import errno
+import fcntl
+import json
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_PORT_SEARCH = 100
+STATE_FILE = "ports.json"
+KIND_HTTP = "http"
+KIND_SOCKS5 = "socks5"
+KIND_COMBINED = "combined"
+# Kinds that accept HTTP proxy requests on an account's port
+HTTP_KINDS = (KIND_HTTP, KIND_COMBINED)
+
+
+def bind_listener(port, host="0.0.0.0", backlog=100, reuseport=False):
+    """Bind a non-blocking listening socket; raises OSError.
+
+    With reuseport the socket gets SO_REUSEPORT after bind() but before
+    listen(), so --workers slots can join it while a port that another
+    process holds (even with SO_REUSEPORT) still fails with EADDRINUSE.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        if reuseport:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.listen(backlog)
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _try_bind(port, host, reuseport):
+    """Listening socket on port, or None if the port is in use"""
+    try:
+        return bind_listener(port, host, reuseport=reuseport)
+    except OSError as e:
+        if e.errno != errno.EADDRINUSE:
+            raise
+        return None
+
+
+def bind_all(requested, taken=(), host="0.0.0.0", search=MAX_PORT_SEARCH, reuseport=False):
+    """Bind one listener per key of requested (key -> port).
+
+    Ports in taken are skipped; reuseport is passed to bind_listener().
+    Returns key -> (port, sock); raises RuntimeError (after closing what
+    was bound) if a key finds no port within search ports above the one
+    it asked for.
+    """
+    taken = set(taken)
+    wanted = set(requested.values())
+    bound = {}
+    busy = []
+    try:
+        for key, port in requested.items():
+            sock = None if port in taken else _try_bind(port, host, reuseport)
+            if sock is None:
+                busy.append(key)
+                continue
+            taken.add(port)
+            bound[key] = (port, sock)
+
+        for key in busy:
+            start = requested[key]
+            for port in range(start + 1, start + search + 1):
+                if port in taken or port in wanted:
+                    continue
+                sock = _try_bind(port, host, reuseport)
+                if sock is not None:
+                    taken.add(port)
+                    bound[key] = (port, sock)
+                    break
+            else:
+                raise RuntimeError(f"Could not find available port for {key}")
+    except BaseException:
+        for _, sock in bound.values():
+            sock.close()
+        raise
+    return bound
+
+
+def path_for(config_path):
+    return os.path.join(os.path.dirname(os.path.abspath(config_path)), STATE_FILE)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write(path, kind, ports):
+    """Replace kind's section of the state file (email -> port)"""
+    with open(path + ".lock", "w") as lock:
+        # Separate proxy processes share the file
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = read(path)
+        state[kind] = {
+            "pid": os.getpid(),
+            "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "ports": ports,
+        }
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+
+
+def publish(proxy):
+    """Write a proxy's account ports (proxy.port_map_kind) next to its config"""
+    ports = {entry["email"]: port for port, entry in proxy.account_by_port.items()}
+    path = path_for(proxy.config_path)
+    try:
+        write(path, proxy.port_map_kind, ports)
+    except OSError as e:
+        logger.warning(f"Could not write port map {path}: {e}")
+
+
+def live_sections(path, kinds=None):
+    """kind -> section for the kinds whose process is still running"""
+    return {kind: section for kind, section in read(path).items()
+            if (kinds is None or kind in kinds) and _pid_alive(section.get("pid", 0))}
+
+
+def lookup(config_path, email, kinds=HTTP_KINDS):
+    """Port a running proxy serves email on, or None"""
+    sections = live_sections(path_for(config_path), kinds)
+    for kind in kinds:
+        port = sections.get(kind, {}).get("ports", {}).get(email)
+        if port is not None:
+            return port
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the ports the running proxies listen on")
+    parser.add_argument("--config", default="/data/data/com.termux/files/home/vpn_v2/config.json",
+                        help="config.json the proxies were started with")
+    parser.add_argument("--kind", action="append", choices=(KIND_HTTP, KIND_SOCKS5, KIND_COMBINED),
+                        help="only this proxy kind (repeatable)")
+    parser.add_argument("--ports", action="store_true", help="print port numbers only")
+    args = parser.parse_args()
+
+    sections = live_sections(path_for(args.config), args.kind)
+    for kind, section in sorted(sections.items()):
+        for email, port in sorted(section.get("ports", {}).items(), key=lambda item: item[1]):
+            print(port if args.ports else f"{kind}\t{email}\t{port}")
+
+
+if __name__ == "__main__":
+    main()
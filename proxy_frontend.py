@@ -0,0 +1,358 @@
+"""Listener lifecycle, settings and counters shared by the proxy front ends.
+
+SwissProxy (HTTP CONNECT and forwarding), SwissSOCKS5Proxy and
+SwissCombinedProxy differ in how they handle an accepted connection
+(handle_client). Everything around that lives in ProxyFrontEnd:
+
+- binding one listener per account (port_map), registering it in
+  account_by_port and releasing it again on reload,
+- applying a (re)loaded config to the shared modules,
+- starting, stopping and supervising the per-account asyncio servers,
+  together with the metrics listener, config reload, graceful drain and
+  the stats file,
+- the counters reported by worker_stats() (--workers, stats file).
+
+The command line (parse_args, serve) is shared as well.
+"""
+import argparse
+import asyncio
+import functools
+import logging
+import os
+
+import admission
+import bandwidth
+import config_reload
+import dns_cache
+import flow_control
+import graceful
+import metrics
+import port_map
+import proxy_log
+import relay_engine
+import stats_segment
+import timeouts
+import tor_pool
+import tunnel_state
+import tunnel_trace
+import upstream_health
+import worker_pool
+
+logger = logging.getLogger(__name__)
+
+
+def process_stats():
+    """Counters of the process-wide modules, for worker_stats()"""
+    stats = {}
+    pools = tor_pool.pool_stats().values()
+    stats["tor_pool_hits"] = sum(p["hits"] for p in pools)
+    stats["tor_pool_misses"] = sum(p["misses"] for p in pools)
+    dns = dns_cache.cache_stats()
+    stats["dns_hits"] = dns["hits"] + dns["negative_hits"] + dns["coalesced"]
+    stats["dns_misses"] = dns["misses"]
+    stats["tunnels_reaped"] = timeouts.reaper_stats()["reaped"]
+    limits = admission.stats()["global"]
+    stats["admission_active"] = limits["active"]
+    stats["admission_queued"] = limits["queued"]
+    stats["admission_rejected"] = limits["rejected_queue_full"] + limits["rejected_timeout"]
+    shaping = bandwidth.totals()
+    stats["bandwidth_throttled"] = shaping["throttled"]
+    stats["bandwidth_queued"] = shaping["queued"]
+    budget = flow_control.budget_stats()
+    stats["relay_buffered_bytes"] = budget["buffered_bytes"]
+    stats["relay_budget_pauses"] = budget["pauses"]
+    access = proxy_log.access_stats()
+    stats["access_records"] = access["written"]
+    stats["access_dropped"] = access["rate_limited"] + access["queue_dropped"]
+    traces = tunnel_trace.trace_stats()
+    stats["traces_slow"] = traces["slow"]
+    stats["traces_buffered"] = traces["buffered"]
+    return stats
+
+
+class ProxyFrontEnd:
+    """One listener per account; subclasses implement handle_client()"""
+    port_map_kind = None
+    config_path = None         # the front end's CONFIG_FILE; tests override it per instance
+    title = "Proxy"            # "✅ <title> started for ..."
+    listener_name = "Proxy"    # "<listener_name> listener on port ... failed"
+
+    def __init__(self, config, allocate_ports=True):
+        self.config = config
+        self.account_by_port = {}
+        self.used_ports = set()
+        self.sockets = {}            # port -> bound socket not yet serving
+        self.counters = {"connections": 0, "active_tunnels": 0, "bytes_up": 0, "bytes_down": 0}
+        self.metrics_address = None  # (host, port) of the /metrics listener
+        self.metrics_server = None
+        self.worker_slot = 0
+        self.watch_interval = 0      # --watch-config poll interval (0 = SIGHUP only)
+        self.prebound = False        # serving the --workers parent's sockets
+        self.listeners = {}          # port -> start_server() task
+        self.servers = {}            # port -> serving asyncio.Server
+        self.clients = set()         # client handler tasks, waited for on drain
+        self.draining = False
+        self.drain_timeout = graceful.DEFAULT_DRAIN_TIMEOUT
+        self.handoff = None          # graceful.Handoff to confirm once serving
+        self.setup(config)
+        if allocate_ports:
+            self.allocate_ports()
+
+    # Settings
+
+    def setup(self, config):
+        """Configure the shared modules for the initial config"""
+        dns_cache.configure(config.get("dns", {}))
+        self._configure(config)
+
+    def apply_settings(self, config):
+        """Switch to a reloaded config; open tunnels keep their settings"""
+        if config.get("dns") != self.config.get("dns"):
+            # A new cache starts cold, so only replace it when its section changed
+            dns_cache.configure(config.get("dns", {}))
+        self.config = config
+        self._configure(config)
+
+    def _configure(self, config):
+        self.relay_engine = relay_engine.resolve_engine(config)
+        self.relay_settings = config.get("relay", {})
+        flow_control.configure(self.relay_settings)
+        admission.configure(config)
+        bandwidth.configure(config)
+        upstream_health.configure(config)
+        proxy_log.configure(config)
+        tunnel_trace.configure(config)
+        stats_segment.configure(config)
+        self._timeouts = {}
+        self._flow = {}
+
+    def timeouts_for(self, account_config):
+        """Stage timeouts for an account (cached)"""
+        limits = self._timeouts.get(account_config["email"])
+        if limits is None:
+            limits = self._timeouts[account_config["email"]] = timeouts.Timeouts.from_config(
+                self.config, account_config)
+        return limits
+
+    def flow_for(self, account_config):
+        """Relay flow settings for an account (cached)"""
+        settings = self._flow.get(account_config["email"])
+        if settings is None:
+            settings = self._flow[account_config["email"]] = flow_control.FlowSettings.from_config(
+                self.relay_settings, account_config)
+        return settings
+
+    # Ports
+
+    def account_entry(self, email, acc_config):
+        """account_by_port value for an account (read-only, shared by its tunnels)"""
+        return tunnel_state.account_record(email, acc_config, original_port=acc_config["proxy_port"])
+
+    def allocate_ports(self, handoff=None, reuseport=False):
+        """Bind a listener for every account, falling back past ports in use.
+
+        Accounts whose listener came with a takeover (graceful.Handoff)
+        keep the handed over socket. With reuseport (--workers) the
+        listeners are bound so the other worker slots can share them.
+        """
+        entries = {email: self.account_entry(email, acc_config)
+                   for email, acc_config in self.config["accounts"].items()}
+        adopted = {}
+        if handoff is not None:
+            for email, entry in entries.items():
+                taken = handoff.take(0, email, entry["original_port"])
+                if taken is not None:
+                    adopted[email] = taken
+        bound = port_map.bind_all({email: entry["original_port"] for email, entry in entries.items()
+                                   if email not in adopted},
+                                  self.used_ports | {port for port, _ in adopted.values()},
+                                  reuseport=reuseport)
+        bound.update(adopted)
+        for email, (port, sock) in bound.items():
+            self.register(entries[email], port, sock)
+
+    def bind_ports(self, entries):
+        """email -> (port, socket) for entries (email -> account_entry), not registered yet.
+
+        Raises OSError or RuntimeError (after closing what was bound).
+        """
+        return port_map.bind_all({email: entry["original_port"] for email, entry in entries.items()},
+                                 self.used_ports)
+
+    def register(self, entry, port, sock):
+        """Serve entry's account on port; sock is its bound listener (started by start_listener)"""
+        if port == entry["original_port"]:
+            logger.info(f"Port {port} is available for {entry['email']}")
+        else:
+            logger.warning(f"Port {entry['original_port']} busy, using {port} for {entry['email']}")
+        self.used_ports.add(port)
+        self.sockets[port] = sock
+        self.account_by_port[port] = entry
+
+    def release_port(self, port):
+        self.account_by_port.pop(port, None)
+        self.used_ports.discard(port)
+        sock = self.sockets.pop(port, None)
+        if sock is not None:
+            sock.close()
+
+    # Counters
+
+    def totals(self):
+        """connections, active_tunnels, bytes_up and bytes_down of this front end"""
+        return self.counters
+
+    def process_stats(self):
+        return process_stats()
+
+    def record_tunnel(self, stats):
+        """Add a finished tunnel's byte counts to the process counters"""
+        self.counters["bytes_up"] += stats.bytes_up
+        self.counters["bytes_down"] += stats.bytes_down
+
+    def worker_stats(self):
+        """Counters reported to the parent in --workers mode"""
+        stats = dict(self.totals(), pid=os.getpid())
+        stats.update(self.process_stats())
+        return stats
+
+    # Listeners
+
+    def create_client_handler(self, port, account_config):
+        """Create a client handler with account config bound to it"""
+        return functools.partial(self.serve_client, port, account_config)
+
+    async def serve_client(self, port, account_config, reader, writer):
+        """Handle a client connection accepted on port"""
+        task = asyncio.current_task()
+        self.clients.add(task)
+        try:
+            # Looked up per connection so a config reload applies to new connections
+            await self.handle_client(reader, writer, port, self.account_by_port.get(port, account_config))
+        except asyncio.CancelledError:
+            # Cut off at the end of a drain (graceful.py); nothing waits for this task
+            if not self.draining:
+                raise
+        finally:
+            self.clients.discard(task)
+
+    async def handle_client(self, reader, writer, port, account_config):
+        raise NotImplementedError
+
+    def listener_info(self, port, account):
+        """Log lines describing a started listener, after its route"""
+        return [f"Port: {port} (requested: {account['original_port']})"]
+
+    async def start_server(self, port, account, sock=None):
+        """Start a single proxy server for a specific account"""
+        handler = self.create_client_handler(port, account)
+        if sock is not None:
+            # Bound by allocate_ports(), or a worker slot's socket from the --workers parent
+            server = await asyncio.start_server(handler, sock=sock)
+        else:
+            server = await asyncio.start_server(handler, '0.0.0.0', port, reuse_address=True)
+
+        logger.info(f"✅ {self.title} started for {account['email']}")
+        logger.info(f"   Route: {account['upstream']['name']}")
+        for line in self.listener_info(port, account):
+            logger.info(f"   {line}")
+
+        self.servers[port] = server
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if self.servers.get(port) is server:
+                del self.servers[port]
+
+    def start_listener(self, port, sock=None):
+        if sock is None:
+            sock = self.sockets.pop(port, None)
+        task = asyncio.create_task(self.start_server(port, self.account_by_port[port], sock))
+        self.listeners[port] = task
+        task.add_done_callback(lambda t: self._listener_done(port, t))
+
+    def stop_listener(self, port):
+        """Stop accepting on port; connections already accepted carry on"""
+        task = self.listeners.pop(port, None)
+        if task is not None:
+            task.cancel()
+
+    def _listener_done(self, port, task):
+        if self.listeners.get(port) is task:
+            del self.listeners[port]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"{self.listener_name} listener on port {port} failed: {task.exception()}")
+
+    async def start_servers(self, sockets=None):
+        """Serve every account until no listener is left, then drain.
+
+        sockets optionally maps port -> already bound listening socket.
+        """
+        tor_pool.warm_pools(self.account_by_port.values())
+        upstream_health.start()
+
+        self.prebound = sockets is not None
+        for port in list(self.account_by_port):
+            self.start_listener(port, sockets.get(port) if sockets else None)
+        if not self.prebound:
+            port_map.publish(self)
+        watcher = config_reload.install(self)
+        handoff = graceful.install(self)
+        publisher = stats_segment.install(self)
+
+        try:
+            # After the takeover is confirmed, so the old process frees the port
+            if self.metrics_address:
+                host, port = self.metrics_address
+                self.metrics_server = await metrics.start_server(
+                    host, port + self.worker_slot, self.worker_stats,
+                    accounts=lambda: list(self.account_by_port.values()))
+            # Listeners come and go on reload; run until none is left
+            while self.listeners:
+                await asyncio.wait(list(self.listeners.values()))
+            # Stopped accepting (SIGTERM, a handoff or no accounts left): let open connections finish
+            await graceful.drain(self)
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            if handoff is not None:
+                handoff.cancel()
+            if publisher is not None:
+                publisher.cancel()
+            for port in list(self.listeners):
+                self.stop_listener(port)
+
+
+def parse_args(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="number of SO_REUSEPORT worker processes (0 = single process)")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics on this port (0 = disabled; worker N uses port + N)")
+    parser.add_argument("--metrics-host", default="127.0.0.1",
+                        help="address for the metrics listener")
+    parser.add_argument("--watch-config", type=float, default=0, metavar="SECONDS",
+                        help="reload config.json when it changes, polling every SECONDS (0 = SIGHUP only)")
+    parser.add_argument("--takeover", action="store_true",
+                        help="take the listening sockets over from the running proxy, which then drains")
+    parser.add_argument("--drain-timeout", type=float, default=graceful.DEFAULT_DRAIN_TIMEOUT,
+                        metavar="SECONDS", help="how long open connections may finish on SIGTERM or handoff")
+    return parser.parse_args()
+
+
+def serve(proxy, args):
+    """Bind (or take over) the listeners and serve until stopped; proxy was created with allocate_ports=False"""
+    if args.workers > 0:
+        worker_pool.require_reuseport()
+    handoff = graceful.take_over(proxy, args.workers) if args.takeover else None
+    proxy.allocate_ports(handoff, reuseport=args.workers > 0)
+    proxy.handoff = handoff
+    proxy.drain_timeout = args.drain_timeout
+    if args.metrics_port:
+        proxy.metrics_address = (args.metrics_host, args.metrics_port)
+    proxy.watch_interval = args.watch_config
+    if args.workers > 0:
+        worker_pool.run_workers(proxy, args.workers, handoff=handoff)
+    else:
+        asyncio.run(proxy.start_servers())
@@ -0,0 +1,230 @@
+"""Non-blocking logging and sampled per-tunnel access records.
+
+setup() replaces logging.basicConfig() in the proxies: the root logger
+gets a QueueHandler and a QueueListener thread does the actual writes to
+the log file and stderr, so a slow disk (Termux flash storage) never
+stalls the event loop. The queue is bounded; when the writer falls
+behind, records are dropped and counted instead of piling up in memory.
+Forked --workers children start their own writer thread.
+
+Per-connection chatter ("Received request", "Connected to ... via Tor",
+"Tunnel closed") is replaced by one access record per tunnel, written
+as a JSON line to the "access" logger when the tunnel ends:
+
+    {"ts": 1760792400.123, "kind": "socks5", "account": "user@example.com",
+     "client": "100.64.0.2:51234", "target": "example.com:443", "upstream": "Tor",
+     "outcome": "ok", "handshake": 0.412, "duration": 31.9, "engine": "asyncio",
+     "bytes_up": 5120, "bytes_down": 40960}
+
+Config (optional, top level of config.json):
+
+    "logging": {"access": true, "sample_rate": 1.0, "rate_limit": 100, "sample_errors": true}
+
+sample_rate is the fraction of tunnels recorded; with sample_errors,
+tunnels that failed are always considered. At most rate_limit records
+per second are written (0 = no limit), the rest are counted as dropped.
+"access": false turns the records off: the proxies check the module-level
+`enabled` flag before building anything, so a disabled access log costs
+one attribute lookup per tunnel.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger("access")
+
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+QUEUE_SIZE = 10000
+DEFAULT_SAMPLE_RATE = 1.0
+DEFAULT_RATE_LIMIT = 100.0
+
+OUTCOME_OK = "ok"
+OUTCOME_REAPED = "reaped"
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler = None
+_listener = None
+
+
+def _start_listener():
+    global _listener
+    _handler.queue = queue.Queue(QUEUE_SIZE)
+    _listener = logging.handlers.QueueListener(_handler.queue, *_listener.handlers,
+                                               respect_handler_level=True)
+    _listener.start()
+
+
+def setup(path, level=logging.INFO, force=False):
+    """Log to path and stderr through a writer thread.
+
+    Like logging.basicConfig() the first call wins, unless force replaces
+    the handlers set up before (the combined proxy imports both others).
+    """
+    global _handler, _listener
+    root = logging.getLogger()
+    if force:
+        stop()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+            handler.close()
+        for handler in _listener.handlers if _listener is not None else ():
+            handler.close()
+    elif root.handlers:
+        return
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.FileHandler(path), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    first = _handler is None
+    _handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    root.addHandler(_handler)
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    if first:
+        atexit.register(stop)
+        # The writer thread doesn't survive fork(); a child starts its own on a fresh queue
+        os.register_at_fork(after_in_child=_start_listener)
+
+
+def stop():
+    """Flush queued records and stop the writer thread (before os._exit)"""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+class AccessLog:
+    """Sampling and rate limiting of access records"""
+
+    def __init__(self):
+        self.sample_rate = DEFAULT_SAMPLE_RATE
+        self.rate_limit = DEFAULT_RATE_LIMIT
+        self.sample_errors = True
+        self.tokens = DEFAULT_RATE_LIMIT
+        self.refilled_at = time.monotonic()
+        self.written = 0
+        self.sampled_out = 0
+        self.rate_limited = 0
+
+    def __repr__(self):
+        return f"AccessLog(sample_rate={self.sample_rate}, rate_limit={self.rate_limit})"
+
+    def configure(self, settings):
+        self.sample_rate = settings.get("sample_rate", DEFAULT_SAMPLE_RATE)
+        self.rate_limit = settings.get("rate_limit", DEFAULT_RATE_LIMIT)
+        self.sample_errors = settings.get("sample_errors", True)
+        self.tokens = min(self.tokens, self.rate_limit) if self.rate_limit > 0 else 0.0
+
+    def admit(self, failed=False):
+        """Whether to write the next record"""
+        if not (failed and self.sample_errors) and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return False
+        if self.rate_limit > 0:
+            now = time.monotonic()
+            # Token bucket holding up to one second's worth of records
+            self.tokens = min(self.rate_limit, self.tokens + (now - self.refilled_at) * self.rate_limit)
+            self.refilled_at = now
+            if self.tokens < 1.0:
+                self.rate_limited += 1
+                return False
+            self.tokens -= 1.0
+        self.written += 1
+        return True
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "sampled_out": self.sampled_out,
+            "rate_limited": self.rate_limited,
+            "queue_dropped": _handler.dropped if _handler is not None else 0,
+        }
+
+
+_access = AccessLog()
+# Checked by the proxies before building a record
+enabled = True
+
+
+def configure(config):
+    """Apply the config's "logging" section (also on reload)"""
+    global enabled
+    settings = config.get("logging", {})
+    enabled = bool(settings.get("access", True))
+    _access.configure(settings)
+
+
+class TunnelRecord:
+    """Fields of one tunnel's access record, filled in as the tunnel progresses.
+
+    Create one only when `enabled` is set, and pass None around otherwise.
+    """
+    __slots__ = ("kind", "account_config", "target", "accepted_at", "writer", "upstream", "handshake",
+                 "finished")
+
+    def __init__(self, kind, account_config, target, accepted_at=None, writer=None):
+        self.kind = kind
+        self.account_config = account_config
+        self.target = target
+        self.accepted_at = accepted_at if accepted_at is not None else time.monotonic()
+        self.writer = writer          # client side, for the peer address
+        self.upstream = None
+        self.handshake = None         # seconds from accept to the success reply
+        self.finished = False
+
+    def __repr__(self):
+        return f"TunnelRecord({self.kind} {self.target})"
+
+    def finish(self, outcome, stats=None):
+        """Write the record (subject to sampling).
+
+        outcome is OUTCOME_OK, OUTCOME_REAPED or the error stage that
+        ended the tunnel; stats is the tunnel's relay_engine.RelayStats
+        if it got as far as relaying. Only the first call writes.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        if not _access.admit(outcome not in (OUTCOME_OK, OUTCOME_REAPED)):
+            return
+        peer = self.writer.get_extra_info("peername") if self.writer is not None else None
+        entry = {
+            "ts": round(time.time(), 3),
+            "kind": self.kind,
+            "account": self.account_config["email"],
+            "client": f"{peer[0]}:{peer[1]}" if peer else None,
+            "target": self.target,
+            "upstream": self.upstream["name"] if self.upstream is not None else None,
+            "outcome": outcome,
+            "handshake": round(self.handshake, 4) if self.handshake is not None else None,
+            "duration": round(time.monotonic() - self.accepted_at, 4),
+        }
+        if stats is not None:
+            entry["engine"] = stats.engine
+            entry["bytes_up"] = stats.bytes_up
+            entry["bytes_down"] = stats.bytes_down
+        access_logger.info(json.dumps(entry))
+
+
+def access_stats():
+    return _access.stats()
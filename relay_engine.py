@@ -0,0 +1,372 @@
+"""Relay engines for established proxy tunnels.
+
+Both proxies finish their handshake on asyncio streams and then hand the
+client/target pair to a relay. The default relay is the StreamReader /
+StreamWriter loop in each proxy; this module holds the alternative engines
+that take the raw sockets over instead.
+
+Config (optional, top level of config.json):
+
+    "relay": {"engine": "asyncio" | "splice" | "protocol",
+              "buffer_size": 65536}
+"""
+import asyncio
+import logging
+import os
+import socket
+import sys
+
+logger = logging.getLogger(__name__)
+
+ENGINE_ASYNCIO = "asyncio"
+ENGINE_SPLICE = "splice"
+ENGINE_PROTOCOL = "protocol"
+ENGINES = (ENGINE_ASYNCIO, ENGINE_SPLICE, ENGINE_PROTOCOL)
+
+# Default Linux pipe capacity; one splice() moves at most this much
+SPLICE_CHUNK = 65536
+
+# Receive buffer size for the protocol engine
+DEFAULT_BUFFER_SIZE = 65536
+
+# Protocol engine receive buffers, one per size, shared by every tunnel: a
+# read is written to the peer before the next one can start. A buffer the
+# peer's transport still holds unsent bytes of is left to it and replaced.
+_read_buffers = {}
+
+
+class RelayStats:
+    """Bytes moved by one tunnel, per direction"""
+    __slots__ = ("engine", "bytes_up", "bytes_down")
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.bytes_up = 0      # client -> target
+        self.bytes_down = 0    # target -> client
+
+    def __repr__(self):
+        return f"{self.engine}: {self.bytes_up} B up, {self.bytes_down} B down"
+
+
+def _engine_stats(stats, engine):
+    if stats is None:
+        return RelayStats(engine)
+    stats.engine = engine
+    return stats
+
+
+def splice_supported():
+    """Check if the kernel-side splice() relay can be used on this host"""
+    return sys.platform.startswith("linux") and hasattr(os, "splice") and hasattr(os, "pipe2")
+
+
+def resolve_engine(config):
+    """Pick the relay engine from config, falling back to asyncio"""
+    engine = config.get("relay", {}).get("engine", ENGINE_ASYNCIO)
+    if engine == ENGINE_SPLICE and not splice_supported():
+        logger.warning("splice() relay not supported on this platform, using asyncio relay")
+        return ENGINE_ASYNCIO
+    if engine not in ENGINES:
+        logger.warning(f"Unknown relay engine '{engine}', using asyncio relay")
+        return ENGINE_ASYNCIO
+    return engine
+
+
+def can_detach(writer):
+    """Check if a stream's socket can be handed over without losing data"""
+    transport = writer.transport
+    if transport is None or transport.is_closing() or transport.get_write_buffer_size():
+        return False
+    return writer.get_extra_info("socket") is not None
+
+
+def detach_stream(reader, writer):
+    """Take the socket away from an asyncio stream pair.
+
+    Returns (sock, pending) where sock is a non-blocking duplicate of the
+    stream's socket and pending is whatever the StreamReader had already
+    buffered (e.g. a TLS ClientHello sent right after the handshake).
+    Returns None if the writer still has unsent data, in which case the
+    caller should keep using the streams (see can_detach).
+    """
+    if not can_detach(writer):
+        return None
+    transport = writer.transport
+    raw = writer.get_extra_info("socket")
+
+    transport.pause_reading()
+    # StreamReader has no public API to take its buffer without awaiting
+    pending = bytes(reader._buffer)
+    reader._buffer.clear()
+
+    sock = socket.socket(fileno=os.dup(raw.fileno()))
+    sock.setblocking(False)
+    # The transport only closes its own fd; the duplicate keeps the connection open
+    transport.close()
+    return sock, pending
+
+
+def _wake(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+async def _wait_fd(add, remove, fd):
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    add(fd, _wake, fut)
+    try:
+        await fut
+    finally:
+        remove(fd)
+
+
+async def _splice_pump(src, dst, stats, attr, shaper=None):
+    """Move bytes src -> dst through a kernel pipe until EOF or error.
+
+    shaper (bandwidth.Shaper) is charged after every splice and holds the
+    next one back while the account or its upstream is over its rate.
+
+    Returns True if src reached EOF (which is passed on to dst as a
+    half-close), False on error.
+    """
+    loop = asyncio.get_running_loop()
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    pipe_r, pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    try:
+        while True:
+            try:
+                n = os.splice(src_fd, pipe_w, SPLICE_CHUNK, flags=flags)
+            except BlockingIOError:
+                await _wait_fd(loop.add_reader, loop.remove_reader, src_fd)
+                continue
+            if n == 0:
+                # Half-close: pass the EOF on, the other direction keeps going
+                dst.shutdown(socket.SHUT_WR)
+                return True
+
+            pending = n
+            while pending:
+                try:
+                    pending -= os.splice(pipe_r, dst_fd, pending, flags=flags)
+                except BlockingIOError:
+                    await _wait_fd(loop.add_writer, loop.remove_writer, dst_fd)
+            setattr(stats, attr, getattr(stats, attr) + n)
+            if shaper is not None:
+                waiter = shaper.charge(n)
+                if waiter is not None:
+                    await waiter
+    except OSError as e:
+        logger.debug(f"splice pump ended: {e}")
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+    return False
+
+
+async def splice_relay(client_reader, client_writer, target_reader, target_writer, stats=None,
+                       shapers=(None, None)):
+    """Relay an established tunnel with os.splice() through a pipe pair.
+
+    Payload bytes never enter Python: each direction is spliced
+    socket -> pipe -> socket in the kernel. Returns RelayStats, or None if
+    the streams could not be detached (caller falls back to asyncio relay).
+    """
+    if not (can_detach(client_writer) and can_detach(target_writer)):
+        return None
+    client_sock, client_pending = detach_stream(client_reader, client_writer)
+    target_sock, target_pending = detach_stream(target_reader, target_writer)
+    loop = asyncio.get_running_loop()
+    stats = _engine_stats(stats, ENGINE_SPLICE)
+    up, down = shapers
+
+    try:
+        if client_pending:
+            await loop.sock_sendall(target_sock, client_pending)
+            stats.bytes_up += len(client_pending)
+        if target_pending:
+            await loop.sock_sendall(client_sock, target_pending)
+            stats.bytes_down += len(target_pending)
+
+        pumps = [
+            asyncio.create_task(_splice_pump(client_sock, target_sock, stats, "bytes_up", up)),
+            asyncio.create_task(_splice_pump(target_sock, client_sock, stats, "bytes_down", down)),
+        ]
+        try:
+            # A clean EOF half-closes the tunnel; an error closes it
+            done, pending = await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+            if pending and all(pump.result() for pump in done):
+                await asyncio.wait(pending)
+        finally:
+            for pump in pumps:
+                pump.cancel()
+            await asyncio.gather(*pumps, return_exceptions=True)
+    except OSError as e:
+        logger.debug(f"splice relay ended: {e}")
+    finally:
+        client_sock.close()
+        target_sock.close()
+
+    return stats
+
+
+def _read_buffer(size):
+    buffer = _read_buffers.get(size)
+    if buffer is None:
+        buffer = _read_buffers[size] = memoryview(bytearray(size))
+    return buffer
+
+
+class TunnelProtocol(asyncio.BufferedProtocol):
+    """One side of a tunnel driven by the protocol engine.
+
+    Reads land in a shared receive buffer and are written straight to the
+    peer's transport, so an idle tunnel holds no buffer of its own.
+    Backpressure is applied by pausing the peer's reading when our
+    transport's write buffer fills, instead of awaiting drain(). A side
+    whose shaper (bandwidth.Shaper) asks it to wait pauses its own reading
+    until the shaper lets it go on.
+    """
+    __slots__ = ("stats", "attr", "buffer_size", "closed", "shaper", "transport", "peer", "eof", "blocked",
+                 "throttled")
+
+    def __init__(self, stats, attr, buffer_size, closed, shaper=None):
+        self.stats = stats
+        self.attr = attr
+        self.buffer_size = buffer_size
+        self.closed = closed
+        self.shaper = shaper
+        self.transport = None
+        self.peer = None
+        self.eof = False
+        self.blocked = False      # the peer's write buffer is full
+        self.throttled = False    # waiting for the shaper
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # Stay quiet until both sides are wired up
+        transport.pause_reading()
+
+    def get_buffer(self, sizehint):
+        return _read_buffer(self.buffer_size)
+
+    def buffer_updated(self, nbytes):
+        peer_transport = self.peer.transport
+        peer_transport.write(_read_buffers[self.buffer_size][:nbytes])
+        setattr(self.stats, self.attr, getattr(self.stats, self.attr) + nbytes)
+        if peer_transport.get_write_buffer_size():
+            # The transport may still reference the buffer; hand it over and
+            # read into a fresh one rather than overwrite unsent bytes
+            del _read_buffers[self.buffer_size]
+        if self.shaper is not None:
+            waiter = self.shaper.charge(nbytes)
+            if waiter is not None:
+                self.throttled = True
+                self.transport.pause_reading()
+                waiter.add_done_callback(self._unthrottle)
+
+    def _unthrottle(self, waiter):
+        self.throttled = False
+        self._resume()
+
+    def _resume(self):
+        if not (self.blocked or self.throttled or self.transport.is_closing()):
+            self.transport.resume_reading()
+
+    def eof_received(self):
+        self.eof = True
+        peer_transport = self.peer.transport
+        if self.peer.eof or not peer_transport.can_write_eof():
+            return False  # both directions done: close
+        # Half-close: pass the EOF on and keep writing to this side
+        peer_transport.write_eof()
+        return True
+
+    def pause_writing(self):
+        self.peer.blocked = True
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.blocked = False
+        self.peer._resume()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            logger.debug(f"protocol relay side closed: {exc}")
+        if self.peer is not None and self.peer.transport is not None:
+            self.peer.transport.close()
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+async def protocol_relay(client_reader, client_writer, target_reader, target_writer,
+                         buffer_size=DEFAULT_BUFFER_SIZE, flow=None, stats=None, shapers=(None, None)):
+    """Relay an established tunnel with a pair of TunnelProtocols.
+
+    flow (flow_control.FlowSettings) sets the transports' write buffer
+    watermarks; shapers are the (up, down) bandwidth.Shapers. Returns
+    RelayStats, or None if the streams could not be detached (caller falls
+    back to asyncio relay).
+    """
+    if not (can_detach(client_writer) and can_detach(target_writer)):
+        return None
+    client_sock, client_pending = detach_stream(client_reader, client_writer)
+    target_sock, target_pending = detach_stream(target_reader, target_writer)
+    loop = asyncio.get_running_loop()
+    stats = _engine_stats(stats, ENGINE_PROTOCOL)
+
+    client = TunnelProtocol(stats, "bytes_up", buffer_size, loop.create_future(), shapers[0])
+    target = TunnelProtocol(stats, "bytes_down", buffer_size, loop.create_future(), shapers[1])
+    client.peer, target.peer = target, client
+
+    try:
+        await loop.connect_accepted_socket(lambda: client, sock=client_sock)
+    except OSError as e:
+        logger.debug(f"protocol relay handover failed: {e}")
+        client_sock.close()
+        target_sock.close()
+        return stats
+    try:
+        await loop.connect_accepted_socket(lambda: target, sock=target_sock)
+    except OSError as e:
+        logger.debug(f"protocol relay handover failed: {e}")
+        client.transport.close()
+        target_sock.close()
+        return stats
+
+    if flow is not None:
+        for side in (client, target):
+            side.transport.set_write_buffer_limits(high=flow.high_water, low=flow.low_water)
+    if client_pending:
+        target.transport.write(client_pending)
+        stats.bytes_up += len(client_pending)
+    if target_pending:
+        client.transport.write(target_pending)
+        stats.bytes_down += len(target_pending)
+    client.transport.resume_reading()
+    target.transport.resume_reading()
+
+    try:
+        await asyncio.gather(client.closed, target.closed)
+    finally:
+        client.transport.close()
+        target.transport.close()
+    return stats
+
+
+async def handover(engine, client_reader, client_writer, target_reader, target_writer, settings,
+                   flow=None, stats=None, shapers=(None, None)):
+    """Hand an established tunnel to one of the socket-level engines.
+
+    stats optionally is a RelayStats the engine should count into (so its
+    counters can be watched while the tunnel runs); shapers are the
+    tunnel's (up, down) bandwidth.Shapers. Returns RelayStats, or None if
+    the caller should relay on the streams.
+    """
+    if engine == ENGINE_SPLICE:
+        return await splice_relay(client_reader, client_writer, target_reader, target_writer, stats, shapers)
+    if engine == ENGINE_PROTOCOL:
+        return await protocol_relay(client_reader, client_writer, target_reader, target_writer,
+                                    settings.get("buffer_size", DEFAULT_BUFFER_SIZE), flow, stats, shapers)
+    return None
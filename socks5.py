@@ -0,0 +1,163 @@
+"""SOCKS5 wire format: constants, frame builders and an incremental parser.
+
+Each *_length() function looks at the bytes received so far and returns the
+total length the frame needs, raising Socks5Error as soon as the bytes
+seen are invalid. read_frame() reads only up to that length, so partial
+reads are accumulated and anything a peer sent after the frame (a
+pipelined request, the first TLS record) stays in the StreamReader.
+"""
+import asyncio
+import socket
+import struct
+
+VERSION = 0x05
+
+METHOD_NO_AUTH = 0x00
+METHOD_NO_ACCEPTABLE = 0xFF
+
+CMD_CONNECT = 0x01
+
+ATYP_IPV4 = 0x01
+ATYP_DOMAIN = 0x03
+ATYP_IPV6 = 0x04
+
+REP_SUCCESS = 0x00
+REP_GENERAL_FAILURE = 0x01
+REP_CONNECTION_REFUSED = 0x05
+REP_TTL_EXPIRED = 0x06
+REP_COMMAND_NOT_SUPPORTED = 0x07
+REP_ATYP_NOT_SUPPORTED = 0x08
+
+GREETING_NO_AUTH = bytes([VERSION, 0x01, METHOD_NO_AUTH])
+
+
+class Socks5Error(Exception):
+    """Malformed or unsupported SOCKS5 frame.
+
+    rep is the reply code to send back to a client, or None if the
+    connection should just be closed.
+    """
+
+    def __init__(self, message, rep=None):
+        super().__init__(message)
+        self.rep = rep
+
+
+def socks_reply(rep):
+    """SOCKS5 reply with a zero IPv4 bind address"""
+    return bytes([VERSION, rep, 0x00, ATYP_IPV4]) + bytes(6)
+
+
+def build_connect_request(host, port, atyp=ATYP_DOMAIN):
+    """SOCKS5 CONNECT frame preserving the client's address type.
+
+    Tor supports 0x01 (IPv4), 0x03 (domain) and 0x04 (IPv6); domains are
+    passed through as-is so Tor resolves them (no DNS leak).
+    """
+    request = bytearray([VERSION, CMD_CONNECT, 0x00, atyp])
+    if atyp == ATYP_DOMAIN:
+        host_bytes = host.encode('ascii')
+        request.append(len(host_bytes))
+        request.extend(host_bytes)
+    elif atyp == ATYP_IPV4:
+        request.extend(socket.inet_pton(socket.AF_INET, host))
+    elif atyp == ATYP_IPV6:
+        request.extend(socket.inet_pton(socket.AF_INET6, host))
+    else:
+        raise Socks5Error(f"Unknown address type {atyp}", rep=REP_ATYP_NOT_SUPPORTED)
+    request.extend(struct.pack('!H', port))
+    return bytes(request)
+
+
+def _address_end(buf, offset):
+    """Length of a frame whose ATYP byte is at offset"""
+    if len(buf) <= offset:
+        return offset + 1
+    atyp = buf[offset]
+    if atyp == ATYP_IPV4:
+        return offset + 1 + 4 + 2
+    if atyp == ATYP_IPV6:
+        return offset + 1 + 16 + 2
+    if atyp == ATYP_DOMAIN:
+        if len(buf) <= offset + 1:
+            return offset + 2
+        return offset + 2 + buf[offset + 1] + 2
+    raise Socks5Error(f"Unsupported address type: {atyp}", rep=REP_ATYP_NOT_SUPPORTED)
+
+
+def _parse_address(buf, offset):
+    """(atyp, host, port) of the address whose ATYP byte is at offset"""
+    atyp = buf[offset]
+    if atyp == ATYP_IPV4:
+        host = socket.inet_ntop(socket.AF_INET, bytes(buf[offset + 1:offset + 5]))
+        end = offset + 5
+    elif atyp == ATYP_IPV6:
+        host = socket.inet_ntop(socket.AF_INET6, bytes(buf[offset + 1:offset + 17]))
+        end = offset + 17
+    else:
+        addr_len = buf[offset + 1]
+        host = bytes(buf[offset + 2:offset + 2 + addr_len]).decode('ascii')
+        end = offset + 2 + addr_len
+    return atyp, host, struct.unpack_from('!H', buf, end)[0]
+
+
+def greeting_length(buf):
+    """Client greeting: [VER, NMETHODS, METHODS...]"""
+    if buf and buf[0] != VERSION:
+        raise Socks5Error(f"Unsupported SOCKS version: {buf[0]}")
+    if len(buf) < 2:
+        return 2
+    return 2 + buf[1]
+
+
+def request_length(buf):
+    """Client request: [VER, CMD, RSV, ATYP, DST.ADDR, DST.PORT]"""
+    if buf and buf[0] != VERSION:
+        raise Socks5Error(f"Invalid SOCKS version in request: {buf[0]}")
+    if len(buf) < 4:
+        return 4
+    return _address_end(buf, 3)
+
+
+def parse_request(buf):
+    """(cmd, atyp, host, port) of a complete client request"""
+    atyp, host, port = _parse_address(buf, 3)
+    return buf[1], atyp, host, port
+
+
+def reply_length(buf):
+    """Server reply: [VER, REP, RSV, ATYP, BND.ADDR, BND.PORT]"""
+    if buf and buf[0] != VERSION:
+        raise Socks5Error(f"Invalid SOCKS version in reply: {buf[0]}")
+    if len(buf) < 4:
+        return 4
+    return _address_end(buf, 3)
+
+
+def method_and_reply_length(buf):
+    """Method selection [VER, METHOD] followed by a CONNECT reply.
+
+    This is what a server sends back for a pipelined greeting + CONNECT.
+    """
+    if len(buf) < 2:
+        if buf and buf[0] != VERSION:
+            raise Socks5Error(f"Invalid SOCKS version in method reply: {buf[0]}")
+        return 2
+    if buf[0] != VERSION or buf[1] != METHOD_NO_AUTH:
+        raise Socks5Error(f"Unexpected method reply {bytes(buf[:2])!r}")
+    return 2 + reply_length(buf[2:])
+
+
+async def read_frame(reader, length, buf=b""):
+    """Read one frame whose size is computed incrementally by length(buf).
+
+    Never reads past the end of the frame. Raises IncompleteReadError if the
+    peer closes mid-frame and Socks5Error if the frame is invalid.
+    """
+    buf = bytearray(buf)
+    while len(buf) < (need := length(buf)):
+        data = await reader.read(need - len(buf))
+        if not data:
+            raise asyncio.IncompleteReadError(bytes(buf), need)
+        buf += data
+    return buf
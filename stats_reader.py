@@ -0,0 +1,249 @@
+"""Read the proxies' memory-mapped stats files.
+
+Every running proxy process keeps a fixed-layout stats file next to
+config.json (<kind>.stats, or <kind>.<slot>.stats per --workers worker)
+and rewrites it in place about once a second (stats_segment.py). Reading
+one is a single mmap: no request through the proxy and no log parsing.
+This module owns the layout and needs nothing but the standard library,
+so monitoring scripts can copy it on its own.
+
+Layout (little-endian): a 128-byte header, then `capacity` records of
+192 bytes, one per account. The header starts with a part written once
+(magic, version, sizes, pid, kind, worker slot, start time) followed by
+the process totals. The totals and every record begin with a sequence
+number the writer makes odd while it updates them and even when done; a
+reader that sees an odd or changed number reads again, so the writer
+never takes a lock.
+
+    python3 stats_reader.py                     # all proxies next to config.json
+    python3 stats_reader.py --watch 2           # refresh every 2 seconds
+    python3 stats_reader.py --json              # for jq / dashboards
+    python3 stats_reader.py --check             # exit 1 if no proxy runs, one hangs or an upstream is down
+"""
+import argparse
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b"SWSTATS1"
+VERSION = 1
+SUFFIX = ".stats"
+DEFAULT_DIR = "/data/data/com.termux/files/home/vpn_v2"
+
+# magic, version, header size, record size, capacity, pid, worker slot, kind, started (unix time)
+STATIC = struct.Struct("<8sIIIIIi16sd")
+# seq, updated (unix time), accounts in use, connections, active tunnels, bytes up, bytes down
+TOTALS = struct.Struct("<QdI4xQqQQ")
+TOTALS_OFFSET = 64
+HEADER_SIZE = 128
+# seq, email, upstream, health, configured, connections, active tunnels, bytes up, bytes down,
+# errors, last upstream connect seconds (NaN if none yet), bytes/s up, bytes/s down, updated
+RECORD = struct.Struct("<Q64s32sBB6xQqQQQdddd")
+RECORD_SIZE = 192
+
+HEALTH = ("unknown", "up", "slow", "down")
+# Attempts at a consistent read before giving up on a record
+READ_RETRIES = 100
+# A file its writer has not touched for this long is reported as stale
+STALE_AFTER = 10.0
+
+
+def _text(raw):
+    return raw.rstrip(b"\0").decode("utf-8", "replace")
+
+
+def _read_consistent(buf, offset, layout):
+    """Fields of a seqlock-protected block, or None if it kept changing"""
+    for _ in range(READ_RETRIES):
+        fields = layout.unpack_from(buf, offset)
+        if fields[0] & 1 == 0 and struct.unpack_from("<Q", buf, offset)[0] == fields[0]:
+            return fields
+        time.sleep(0)
+    return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_file(path):
+    """One stats file as a dict; raises OSError or ValueError"""
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(buf) < HEADER_SIZE:
+            raise ValueError(f"{path}: too short for a stats file")
+        magic, version, header_size, record_size, capacity, pid, slot, kind, started = STATIC.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path}: not a version {VERSION} stats file")
+        if len(buf) < header_size + capacity * record_size:
+            raise ValueError(f"{path}: truncated")
+        totals = _read_consistent(buf, TOTALS_OFFSET, TOTALS)
+        if totals is None:
+            raise ValueError(f"{path}: header kept changing")
+        _, updated, count, connections, active, bytes_up, bytes_down = totals
+        accounts = []
+        for index in range(min(count, capacity)):
+            fields = _read_consistent(buf, header_size + index * record_size, RECORD)
+            if fields is None:
+                continue
+            (_, email, upstream, health, configured, account_connections, tunnels, account_up, account_down,
+             errors, latency, rate_up, rate_down, account_updated) = fields
+            accounts.append({
+                "email": _text(email),
+                "upstream": _text(upstream),
+                "health": HEALTH[health] if health < len(HEALTH) else HEALTH[0],
+                "configured": bool(configured),
+                "connections": account_connections,
+                "active_tunnels": tunnels,
+                "bytes_up": account_up,
+                "bytes_down": account_down,
+                "errors": errors,
+                "upstream_connect_seconds": None if math.isnan(latency) else latency,
+                "bytes_per_s_up": rate_up,
+                "bytes_per_s_down": rate_down,
+                "updated": account_updated,
+            })
+    finally:
+        buf.close()
+    alive = _pid_alive(pid)
+    return {
+        "path": path,
+        "kind": _text(kind),
+        "slot": slot if slot >= 0 else None,
+        "pid": pid,
+        "running": alive,
+        # Running but no longer updating its file (hung event loop)
+        "stale": alive and time.time() - updated > STALE_AFTER,
+        "started": started,
+        "updated": updated,
+        "connections": connections,
+        "active_tunnels": active,
+        "bytes_up": bytes_up,
+        "bytes_down": bytes_down,
+        "accounts": accounts,
+    }
+
+
+def stats_files(directory=DEFAULT_DIR):
+    return sorted(glob.glob(os.path.join(directory, "*" + SUFFIX)))
+
+
+def read_all(paths):
+    """Readable stats files among paths (files or directories)"""
+    files = []
+    for path in paths:
+        files += stats_files(path) if os.path.isdir(path) else [path]
+    results = []
+    for path in files:
+        try:
+            results.append(read_file(path))
+        except (OSError, ValueError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+    return results
+
+
+def _size(n):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(n) < 1024 or unit == "GiB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def _age(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+def render(results, show_all=False):
+    now = time.time()
+    lines = []
+    for stats in results:
+        if not (stats["running"] or show_all):
+            continue
+        name = stats["kind"] + (f" worker {stats['slot']}" if stats["slot"] is not None else "")
+        state = "not running" if not stats["running"] else (
+            f"STALE, updated {_age(now - stats['updated'])} ago" if stats["stale"] else
+            f"up {_age(now - stats['started'])}")
+        lines.append(f"{name} (PID {stats['pid']}, {state}): {stats['active_tunnels']} active tunnels, "
+                     f"{stats['connections']} connections, {_size(stats['bytes_up'])} up, "
+                     f"{_size(stats['bytes_down'])} down")
+        lines.append(f"  {'ACCOUNT':32} {'UPSTREAM':20} {'HEALTH':7} {'TUNNELS':>7} {'CONNS':>8} {'ERRORS':>7} "
+                     f"{'UP':>10} {'DOWN':>10} {'UP/S':>10} {'DOWN/S':>10} {'CONNECT':>8}")
+        for account in stats["accounts"]:
+            if not (account["configured"] or show_all):
+                continue
+            latency = account["upstream_connect_seconds"]
+            lines.append(f"  {account['email'][:32]:32} {account['upstream'][:20]:20} {account['health']:7} "
+                         f"{account['active_tunnels']:>7} {account['connections']:>8} {account['errors']:>7} "
+                         f"{_size(account['bytes_up']):>10} {_size(account['bytes_down']):>10} "
+                         f"{_size(account['bytes_per_s_up']):>10} {_size(account['bytes_per_s_down']):>10} "
+                         f"{'-' if latency is None else f'{latency:.3f}s':>8}")
+    return "\n".join(lines)
+
+
+def problems(results):
+    """What --check fails on: no running proxy, stale ones, accounts whose upstream is down"""
+    running = [stats for stats in results if stats["running"]]
+    if not running:
+        return ["no running proxy"]
+    found = [f"{stats['path']}: not updated for {time.time() - stats['updated']:.0f}s"
+             for stats in running if stats["stale"]]
+    found += [f"{stats['path']}: {account['email']} via {account['upstream']} is down"
+              for stats in running if not stats["stale"]
+              for account in stats["accounts"] if account["configured"] and account["health"] == "down"]
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*", default=[DEFAULT_DIR],
+                        help=f"stats files or directories holding them (default {DEFAULT_DIR})")
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    parser.add_argument("--watch", type=float, default=0, metavar="SECONDS", help="refresh every SECONDS")
+    parser.add_argument("--all", action="store_true",
+                        help="include stopped proxies and accounts removed from config.json")
+    parser.add_argument("--check", action="store_true",
+                        help="exit 1 if no proxy runs, one stopped updating or an account's upstream is down")
+    args = parser.parse_args()
+
+    while True:
+        results = read_all(args.paths)
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            if args.watch:
+                print("\033[H\033[J", end="")
+            print(render(results, args.all) if any(stats["running"] or args.all for stats in results)
+                  else "No running proxy found")
+        if not args.watch:
+            break
+        try:
+            time.sleep(args.watch)
+        except KeyboardInterrupt:
+            return 0
+    if args.check:
+        found = problems(results)
+        for problem in found:
+            print(problem, file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
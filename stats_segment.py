@@ -0,0 +1,192 @@
+"""Live counters in a memory-mapped stats file, for watchdogs and dashboards.
+
+Each proxy process publishes its counters in a fixed-layout file next to
+config.json (<kind>.stats, or <kind>.<slot>.stats for --workers worker
+<slot>): process totals, and per account the active tunnels, connections,
+bytes and errors, the last upstream connect latency, the current route
+and its health, and the bandwidth rates. stats_reader.py owns the layout
+and prints the files:
+
+    python3 stats_reader.py --watch 2
+
+The relay never touches the file. Once every `interval` seconds a task
+copies the counters the proxy keeps anyway (metrics.py, upstream_health,
+bandwidth) into the mapping with struct.pack_into, framing each block
+with a sequence number (odd while it is being written) instead of a lock.
+A new file is built aside and renamed into place, so a reader never maps
+a half-initialised or truncated file. Accounts removed by a reload keep
+their record, marked as no longer configured.
+
+Config (optional, top level of config.json):
+
+    "stats_file": {"enabled": true, "interval": 1.0, "capacity": 64}
+"""
+import asyncio
+import logging
+import math
+import mmap
+import os
+import struct
+import time
+
+import bandwidth
+import metrics
+import upstream_health
+from stats_reader import (HEALTH, HEADER_SIZE, MAGIC, RECORD, RECORD_SIZE, STATIC, SUFFIX, TOTALS,
+                          TOTALS_OFFSET, VERSION)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 1.0
+DEFAULT_CAPACITY = 64
+_EMAIL_BYTES = 64
+_UPSTREAM_BYTES = 32
+_SEQ = struct.Struct("<Q")
+
+
+def path_for(config_path, kind, slot=None):
+    name = kind + SUFFIX if slot is None else f"{kind}.{slot}{SUFFIX}"
+    return os.path.join(os.path.dirname(os.path.abspath(config_path)), name)
+
+
+def _encode(text, size):
+    raw = text.encode("utf-8")[:size]
+    # Don't leave half a UTF-8 sequence at the cut
+    return raw.decode("utf-8", "ignore").encode("utf-8")
+
+
+class StatsSegment:
+    """The writer's side of one stats file"""
+
+    def __init__(self, path, kind, slot=None, capacity=DEFAULT_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.slots = {}          # email -> record index
+        self.seqs = [0] * (capacity + 1)   # last sequence number per record, totals last
+        self.full_warned = False
+        size = HEADER_SIZE + capacity * RECORD_SIZE
+        tmp = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.buf = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        STATIC.pack_into(self.buf, 0, MAGIC, VERSION, HEADER_SIZE, RECORD_SIZE, capacity, os.getpid(),
+                         -1 if slot is None else slot, kind.encode(), time.time())
+        os.replace(tmp, path)
+
+    def __repr__(self):
+        return f"StatsSegment({self.path}, {len(self.slots)}/{self.capacity} accounts)"
+
+    def _write(self, index, offset, layout, *fields):
+        seq = self.seqs[index] + 1
+        # Odd while the fields change; the even number goes in only after them
+        _SEQ.pack_into(self.buf, offset, seq)
+        layout.pack_into(self.buf, offset, seq, *fields)
+        _SEQ.pack_into(self.buf, offset, seq + 1)
+        self.seqs[index] = seq + 1
+
+    def _index(self, email):
+        index = self.slots.get(email)
+        if index is None and len(self.slots) < self.capacity:
+            index = self.slots[email] = len(self.slots)
+        elif index is None and not self.full_warned:
+            self.full_warned = True
+            logger.warning(f"Stats file {self.path} holds {self.capacity} accounts, leaving out {email}")
+        return index
+
+    def write_account(self, email, upstream, health, configured, connections, active_tunnels, bytes_up,
+                      bytes_down, errors, upstream_connect, rate_up, rate_down, now):
+        index = self._index(email)
+        if index is None:
+            return
+        self._write(index, HEADER_SIZE + index * RECORD_SIZE, RECORD,
+                    _encode(email, _EMAIL_BYTES), _encode(upstream, _UPSTREAM_BYTES), health, configured,
+                    connections, active_tunnels, bytes_up, bytes_down, errors,
+                    math.nan if upstream_connect is None else upstream_connect, rate_up, rate_down, now)
+
+    def write_totals(self, connections, active_tunnels, bytes_up, bytes_down, now):
+        self._write(self.capacity, TOTALS_OFFSET, TOTALS, now, len(self.slots), connections, active_tunnels,
+                    bytes_up, bytes_down)
+
+    def close(self):
+        self.buf.close()
+
+
+_settings = {}
+
+
+def configure(config):
+    global _settings
+    _settings = config.get("stats_file", {})
+
+
+def _health_code(status):
+    return HEALTH.index(status) if status in HEALTH else 0
+
+
+def publish(segment, proxy):
+    """Copy a proxy's current counters into its stats file"""
+    now = time.time()
+    by_account = {}
+    for m in metrics.account_metrics():
+        by_account.setdefault(m.account, []).append(m)
+    health = upstream_health.health_stats()
+    rates = bandwidth.bandwidth_stats()["accounts"]
+    configured = {entry["email"]: entry for entry in proxy.account_by_port.values()}
+
+    for email in list(segment.slots) + [email for email in configured if email not in segment.slots]:
+        entry = configured.get(email)
+        entries = by_account.get(email, [])
+        if entry is not None:
+            upstream = upstream_health.route(entry)["name"]
+        else:
+            upstream = entries[-1].upstream if entries else ""
+        # Latency of the current route, else of whichever upstream was used last
+        latencies = [m.upstream_connect.last for m in entries if m.upstream == upstream]
+        latencies += [m.upstream_connect.last for m in entries if m.upstream != upstream]
+        latency = next((value for value in latencies if value is not None), None)
+        account_rates = rates.get(email, {})
+        segment.write_account(
+            email, upstream, _health_code(health.get(upstream, {}).get("status")), entry is not None,
+            sum(m.connections for m in entries), sum(m.active_tunnels for m in entries),
+            sum(m.bytes_up for m in entries), sum(m.bytes_down for m in entries),
+            sum(sum(m.errors.values()) for m in entries), latency,
+            account_rates.get(bandwidth.UP, {}).get("rate", 0),
+            account_rates.get(bandwidth.DOWN, {}).get("rate", 0), now)
+
+    totals = proxy.worker_stats()
+    segment.write_totals(totals["connections"], totals["active_tunnels"], totals["bytes_up"],
+                         totals["bytes_down"], now)
+
+
+async def _run(segment, proxy):
+    try:
+        while True:
+            try:
+                publish(segment, proxy)
+            except Exception as e:
+                logger.warning(f"Could not update {segment.path}: {e}")
+            await asyncio.sleep(_settings.get("interval", DEFAULT_INTERVAL))
+    finally:
+        segment.close()
+
+
+def install(proxy):
+    """Start publishing proxy's counters; returns the task, or None if disabled.
+
+    Call from the proxy's event loop. --workers children (proxy.prebound)
+    write one file per worker slot.
+    """
+    if not _settings.get("enabled", True):
+        return None
+    slot = proxy.worker_slot if proxy.prebound else None
+    path = path_for(proxy.config_path, proxy.port_map_kind, slot)
+    try:
+        segment = StatsSegment(path, proxy.port_map_kind, slot, _settings.get("capacity", DEFAULT_CAPACITY))
+    except OSError as e:
+        logger.warning(f"No stats file at {path}: {e}")
+        return None
+    logger.info(f"Publishing live counters to {path}")
+    return asyncio.create_task(_run(segment, proxy))
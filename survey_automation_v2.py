@@ -1,13 +1,17 @@
 import json
-import requests
 import asyncio
+import aiohttp
 from aiohttp import web
 import logging
 from datetime import datetime
 import os
+import tempfile
+from http.cookies import SimpleCookie
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin
 
+import port_map
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -27,142 +31,182 @@ def load_config():
 
 CONFIG = load_config()
 
+# Optional "survey_client" section of config.json:
+#   {"pool_size": 16, "keepalive": 30, "timeouts": {"ip_check": 10, "page": 30, "submit": 30}}
+# pool_size caps each account's open connections through its proxy; surveys
+# beyond that wait for a free connection instead of a thread.
+CLIENT_SETTINGS = CONFIG.get("survey_client", {})
+POOL_SIZE = CLIENT_SETTINGS.get("pool_size", 16)
+KEEPALIVE = CLIENT_SETTINGS.get("keepalive", 30)
+
+# Total seconds per stage; connecting through the proxy (and Tor) gets its own bound
+STAGE_TIMEOUTS = {"ip_check": 10, "page": 30, "submit": 30}
+STAGE_TIMEOUTS.update(CLIENT_SETTINGS.get("timeouts", {}))
+CONNECT_TIMEOUT = 15
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'de-CH,de;q=0.9,en;q=0.8',
+    'DNT': '1',
+    'Upgrade-Insecure-Requests': '1'
+}
+
+
+def stage_timeout(stage):
+    total = STAGE_TIMEOUTS[stage]
+    return aiohttp.ClientTimeout(total=total, sock_connect=min(CONNECT_TIMEOUT, total))
+
+
+def write_cookies(path, cookies_data):
+    """Replace a cookies file, never leaving it half-written (runs in a worker thread)"""
+    # Saves of one account can overlap in threads, so each gets its own temp file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(cookies_data, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
 class SurveyAutomation:
     def __init__(self):
         self.is_running = False
-        self.sessions = {}  # Store session cookies per account
+        self.sessions = {}  # One aiohttp.ClientSession (pool + cookies) per account
 
     def get_proxy_for_account(self, email):
-        """Returns proxy configuration for an account"""
+        """Returns the proxy URL for an account"""
         account = CONFIG["accounts"].get(email)
         if not account:
             raise ValueError(f"Unknown account: {email}")
         
-        port = account["proxy_port"]
-        proxy_url = f"http://127.0.0.1:{port}"
+        # The proxy may have fallen back to another port if proxy_port was busy
+        port = port_map.lookup(CONFIG_FILE, email) or account["proxy_port"]
+        return f"http://127.0.0.1:{port}"
+
+    def load_cookies(self, email, jar):
+        """Load saved cookies into an account's cookie jar"""
+        account = CONFIG["accounts"].get(email)
+        cookies_file = account.get("cookies_file")
         
-        return {
-            "http": proxy_url,
-            "https": proxy_url
-        }
+        if cookies_file and os.path.exists(cookies_file):
+            try:
+                with open(cookies_file, "r") as f:
+                    cookies_data = json.load(f)
+                for cookie in cookies_data:
+                    morsel = SimpleCookie()
+                    morsel[cookie.get('name')] = cookie.get('value')
+                    if cookie.get('domain'):
+                        morsel[cookie.get('name')]['domain'] = cookie.get('domain')
+                    morsel[cookie.get('name')]['path'] = cookie.get('path') or '/'
+                    jar.update_cookies(morsel)
+                logger.info(f"Loaded cookies for {email}")
+            except Exception as e:
+                logger.warning(f"Could not load cookies: {e}")
 
     def get_session(self, email):
-        """Get or create session for account"""
-        if email not in self.sessions:
-            session = requests.Session()
-            
-            # Load cookies if available
-            account = CONFIG["accounts"].get(email)
-            cookies_file = account.get("cookies_file")
-            
-            if cookies_file and os.path.exists(cookies_file):
-                try:
-                    with open(cookies_file, "r") as f:
-                        cookies_data = json.load(f)
-                        for cookie in cookies_data:
-                            session.cookies.set(
-                                cookie.get('name'),
-                                cookie.get('value'),
-                                domain=cookie.get('domain')
-                            )
-                    logger.info(f"Loaded cookies for {email}")
-                except Exception as e:
-                    logger.warning(f"Could not load cookies: {e}")
-            
+        """Get or create the long-lived session for an account (call from the event loop)"""
+        session = self.sessions.get(email)
+        if session is None or session.closed:
+            # Connections are keyed by target and proxy, so each account keeps
+            # its own keep-alive pool towards its own proxy port
+            connector = aiohttp.TCPConnector(
+                limit=POOL_SIZE,
+                limit_per_host=POOL_SIZE,
+                keepalive_timeout=KEEPALIVE
+            )
+            jar = aiohttp.CookieJar()
+            self.load_cookies(email, jar)
+            session = aiohttp.ClientSession(
+                connector=connector,
+                cookie_jar=jar,
+                headers=HEADERS,
+                trust_env=False
+            )
             self.sessions[email] = session
         
-        return self.sessions[email]
+        return session
 
-    def save_cookies(self, email, session):
-        """Save session cookies"""
+    async def close_sessions(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+
+    async def save_cookies(self, email, session):
+        """Save session cookies; the file is written off the event loop"""
         account = CONFIG["accounts"].get(email)
         cookies_file = account.get("cookies_file")
         
         if cookies_file:
             try:
                 cookies_data = []
-                for cookie in session.cookies:
+                for cookie in session.cookie_jar:
                     cookies_data.append({
-                        'name': cookie.name,
+                        'name': cookie.key,
                         'value': cookie.value,
-                        'domain': cookie.domain,
-                        'path': cookie.path
+                        'domain': cookie['domain'],
+                        'path': cookie['path']
                     })
                 
-                with open(cookies_file, "w") as f:
-                    json.dump(cookies_data, f)
+                await asyncio.to_thread(write_cookies, cookies_file, cookies_data)
                 
                 logger.info(f"Saved cookies for {email}")
             except Exception as e:
                 logger.error(f"Failed to save cookies: {e}")
 
-    def check_swiss_ip(self, proxy_config):
-        """Check IP through specific proxy"""
-        try:
-            resp = requests.get(
-                "https://ipapi.co/json/",
-                proxies=proxy_config,
-                timeout=10
-            )
-            
-            data = resp.json()
-            country = data.get("country_code", "")
-            is_swiss = country == "CH"
-            
-            return is_swiss, data
-        except Exception as e:
-            logger.error(f"IP check failed: {e}")
-            return False, {}
-
-    def accept_survey_simple(self, email, survey_url, reward=None):
-        """Accept survey using requests library (no browser automation)"""
-        
-        proxy_config = self.get_proxy_for_account(email)
-        account = CONFIG["accounts"][email]
+    async def check_swiss_ip(self, session, proxy):
+        """Check IP through specific proxy; raises asyncio.TimeoutError or aiohttp.ClientError"""
+        async with session.get(
+            "https://ipapi.co/json/",
+            proxy=proxy,
+            timeout=stage_timeout("ip_check")
+        ) as resp:
+            data = await resp.json(content_type=None)
         
-        # Check IP
-        is_swiss, ip_data = self.check_swiss_ip(proxy_config)
+        country = data.get("country_code", "")
+        is_swiss = country == "CH"
         
-        logger.info(f"Account: {email}")
-        logger.info(f"Proxy: {account['upstream']['name']}")
-        logger.info(f"IP: {ip_data.get('ip')} ({ip_data.get('country_name')})")
-        
-        if not is_swiss:
-            logger.error(f"Not in Switzerland! Location: {ip_data}")
-            return {"success": False, "error": "Not in Switzerland"}
+        return is_swiss, data
+
+    async def accept_survey_simple(self, email, survey_url, reward=None):
+        """Accept survey over HTTP (no browser automation)"""
         
-        # Get session
+        proxy = self.get_proxy_for_account(email)
+        account = CONFIG["accounts"][email]
         session = self.get_session(email)
         
+        stage = "ip_check"
         try:
-            # Set headers to mimic browser
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-                'Accept-Language': 'de-CH,de;q=0.9,en;q=0.8',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'DNT': '1',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1'
-            }
+            # Check IP
+            is_swiss, ip_data = await self.check_swiss_ip(session, proxy)
+            
+            logger.info(f"Account: {email}")
+            logger.info(f"Proxy: {account['upstream']['name']}")
+            logger.info(f"IP: {ip_data.get('ip')} ({ip_data.get('country_name')})")
+            
+            if not is_swiss:
+                logger.error(f"Not in Switzerland! Location: {ip_data}")
+                return {"success": False, "error": "Not in Switzerland"}
             
             # Navigate to survey
-            response = session.get(
+            stage = "page"
+            async with session.get(
                 survey_url,
-                proxies=proxy_config,
-                headers=headers,
-                timeout=30,
+                proxy=proxy,
+                timeout=stage_timeout(stage),
                 allow_redirects=True
-            )
-            
-            if response.status_code != 200:
-                return {
-                    "success": False,
-                    "error": f"HTTP {response.status_code}"
-                }
+            ) as response:
+                if response.status != 200:
+                    return {
+                        "success": False,
+                        "error": f"HTTP {response.status}"
+                    }
+                page_url = str(response.url)
+                html = await response.text()
             
             # Parse HTML to find survey acceptance form
-            soup = BeautifulSoup(response.text, 'html.parser')
+            soup = BeautifulSoup(html, 'html.parser')
             
             # Look for forms or buttons that might accept survey
             forms = soup.find_all('form')
@@ -180,9 +224,9 @@ class SurveyAutomation:
                 
                 # Build form action URL
                 if action:
-                    form_url = urljoin(response.url, action)
+                    form_url = urljoin(page_url, action)
                 else:
-                    form_url = response.url
+                    form_url = page_url
                 
                 # Collect form data
                 form_data = {}
@@ -195,38 +239,32 @@ class SurveyAutomation:
                 logger.info(f"Submitting form to {form_url}")
                 
                 # Submit form
+                stage = "submit"
                 if method == 'post':
-                    submit_response = session.post(
-                        form_url,
-                        data=form_data,
-                        proxies=proxy_config,
-                        headers=headers,
-                        timeout=30
-                    )
+                    request = session.post(form_url, data=form_data, proxy=proxy, timeout=stage_timeout(stage))
                 else:
-                    submit_response = session.get(
-                        form_url,
-                        params=form_data,
-                        proxies=proxy_config,
-                        headers=headers,
-                        timeout=30
-                    )
+                    request = session.get(form_url, params=form_data, proxy=proxy, timeout=stage_timeout(stage))
+                async with request as submit_response:
+                    await submit_response.read()
                 
-                logger.info(f"Form submitted, response: {submit_response.status_code}")
+                logger.info(f"Form submitted, response: {submit_response.status}")
             
             # Save cookies
-            self.save_cookies(email, session)
+            await self.save_cookies(email, session)
             
             return {
                 "success": True,
                 "message": f"Survey page accessed for {email}",
-                "url": response.url,
+                "url": page_url,
                 "forms_found": len(forms),
                 "buttons_found": len(accept_buttons)
             }
             
-        except requests.RequestException as e:
-            logger.error(f"Request error for {email}: {e}")
+        except asyncio.TimeoutError:
+            logger.error(f"Timeout in {stage} stage for {email}")
+            return {"success": False, "error": f"{stage} timed out after {STAGE_TIMEOUTS[stage]}s"}
+        except aiohttp.ClientError as e:
+            logger.error(f"Request error for {email} ({stage}): {e}")
             return {"success": False, "error": str(e)}
         except Exception as e:
             logger.error(f"Survey error for {email}: {e}")
@@ -244,15 +282,8 @@ class SurveyAutomation:
                 survey_url = data.get("url")
                 reward = data.get("reward")
                 
-                # Run in thread to avoid blocking
-                loop = asyncio.get_event_loop()
-                result = await loop.run_in_executor(
-                    None,
-                    self.accept_survey_simple,
-                    email,
-                    survey_url,
-                    reward
-                )
+                # Runs on the event loop; concurrent surveys share the account's pool
+                result = await self.accept_survey_simple(email, survey_url, reward)
                 
                 return web.json_response(result)
             except Exception as e:
@@ -279,8 +310,12 @@ class SurveyAutomation:
         logger.info("Mode: Simple (no browser automation)")
         
         # Keep running
-        while self.is_running:
-            await asyncio.sleep(1)
+        try:
+            while self.is_running:
+                await asyncio.sleep(1)
+        finally:
+            await self.close_sessions()
+            await runner.cleanup()
 
 def main():
     automation = SurveyAutomation()
@@ -0,0 +1,98 @@
+"""Combined SOCKS5 + HTTP CONNECT proxy with one listener per account.
+
+Each account listens only on its proxy_port. The first byte of every
+accepted connection decides the protocol: 0x05 goes to the SOCKS5 state
+machine of SwissSOCKS5Proxy, anything else to the HTTP CONNECT parser of
+SwissProxy. Both share the upstream layer (upstream.py) and Tor pools, so
+one event loop and one socket per account replace the dual-port layout.
+
+The legacy layout (swiss_proxy_stream.py on proxy_port plus
+swiss_socks5_proxy.py on proxy_port + 1000) remains available.
+"""
+import json
+import asyncio
+import logging
+
+import port_map
+import proxy_frontend
+import proxy_log
+from swiss_proxy_stream import SwissProxy, load_config, CONFIG_FILE
+from swiss_socks5_proxy import SwissSOCKS5Proxy
+
+# Setup logging (written by a background thread)
+proxy_log.setup('/data/data/com.termux/files/home/vpn_v2/combined_proxy.log', force=True)
+logger = logging.getLogger(__name__)
+
+SOCKS5_VERSION = 0x05
+
+
+class SwissCombinedProxy(proxy_frontend.ProxyFrontEnd):
+    port_map_kind = port_map.KIND_COMBINED
+    config_path = CONFIG_FILE
+    title = "Combined SOCKS5 + HTTP Proxy"
+    listener_name = "Combined"
+
+    def setup(self, config):
+        # The protocol handlers come from the HTTP and SOCKS5 front ends; the
+        # per-account proxy_port listeners are this one's, and the HTTP front
+        # end shares its port bookkeeping
+        self.http = SwissProxy(config, allocate_ports=False)
+        self.socks = SwissSOCKS5Proxy(config, allocate_ports=False)
+        self.http.account_by_port = self.account_by_port
+        self.http.used_ports = self.used_ports
+        self.http.sockets = self.sockets
+
+    def apply_settings(self, config):
+        """Switch both front ends to a reloaded config"""
+        self.http.apply_settings(config)
+        self.socks.apply_settings(config)
+        self.config = config
+
+    def totals(self):
+        http_totals, socks_totals = self.http.totals(), self.socks.totals()
+        return {key: http_totals[key] + socks_totals[key] for key in http_totals}
+
+    def process_stats(self):
+        return self.http.process_stats()
+
+    def listener_info(self, port, account):
+        return super().listener_info(port, account) + [f"URL: socks5://0.0.0.0:{port} | http://0.0.0.0:{port}"]
+
+    async def handle_client(self, reader, writer, port, account_config):
+        """Peek at the first byte and dispatch to the matching front end"""
+        try:
+            first = await asyncio.wait_for(reader.read(1), self.socks.timeouts_for(account_config).greeting)
+        except asyncio.TimeoutError:
+            logger.debug(f"[Port {port}] Timed out waiting for the first byte")
+            first = b""
+        except Exception as e:
+            logger.debug(f"[Port {port}] Error reading first byte: {e}")
+            first = b""
+
+        if not first:
+            writer.close()
+            return
+
+        if first[0] == SOCKS5_VERSION:
+            await self.socks.handle_client(reader, writer, port, account_config, prefix=first)
+        else:
+            await self.http.handle_client(reader, writer, port, account_config, prefix=first)
+
+def main():
+    args = proxy_frontend.parse_args("Combined SOCKS5 + HTTP proxy for Swiss accounts")
+    try:
+        config = load_config()
+        logger.info("Configuration loaded successfully")
+
+        proxy_frontend.serve(SwissCombinedProxy(config, allocate_ports=False), args)
+
+    except FileNotFoundError:
+        logger.error(f"Configuration file not found: {CONFIG_FILE}")
+    except json.JSONDecodeError as e:
+        logger.error(f"Invalid JSON in config file: {e}")
+    except Exception as e:
+        logger.error(f"Fatal error: {e}", exc_info=True)
+        raise
+
+if __name__ == "__main__":
+    main()
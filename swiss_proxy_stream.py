@@ -1,19 +1,27 @@
 import json
 import asyncio
 import logging
-import socket
-from contextlib import closing
+import time
 import re
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler('/data/data/com.termux/files/home/vpn_v2/proxy.log'),
-        logging.StreamHandler()
-    ]
-)
+import admission
+import bandwidth
+import flow_control
+import http_forward
+import http_head
+import metrics
+import port_map
+import proxy_frontend
+import proxy_log
+import timeouts
+import relay_engine
+import tunnel_state
+import tunnel_trace
+import upstream_health
+from upstream import UpstreamError, open_tunnel
+
+# Setup logging (written by a background thread)
+proxy_log.setup('/data/data/com.termux/files/home/vpn_v2/proxy.log')
 logger = logging.getLogger(__name__)
 
 CONFIG_FILE = "/data/data/com.termux/files/home/vpn_v2/config.json"
@@ -22,108 +30,220 @@ def load_config():
     with open(CONFIG_FILE, "r") as f:
         return json.load(f)
 
-def check_port_available(port):
-    """Check if port is available"""
-    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-        try:
-            sock.bind(('0.0.0.0', port))
-            return True
-        except OSError:
-            return False
+class SwissProxy(proxy_frontend.ProxyFrontEnd):
+    port_map_kind = port_map.KIND_HTTP
+    config_path = CONFIG_FILE
+    title = "HTTP/HTTPS Proxy"
+    listener_name = "HTTP"
 
-def find_available_port(start_port, max_attempts=100):
-    """Find next available port starting from start_port"""
-    for i in range(max_attempts):
-        port = start_port + i
-        if check_port_available(port):
-            return port
-    raise RuntimeError(f"Could not find available port starting from {start_port}")
+    def _configure(self, config):
+        super()._configure(config)
+        http_forward.configure(config)
 
-class SwissProxy:
-    def __init__(self, config):
-        self.config = config
-        self.account_by_port = {}
-        self.used_ports = set()
+    def process_stats(self):
+        stats = proxy_frontend.process_stats()
+        origins = http_forward.pool_stats()
+        stats["http_pool_hits"] = origins["hits"]
+        stats["http_pool_misses"] = origins["misses"]
+        return stats
 
-        # Map ports to accounts with port availability check
-        for email, acc_config in config["accounts"].items():
-            requested_port = acc_config["proxy_port"]
+    def listener_info(self, port, account):
+        return super().listener_info(port, account) + [f"URL: http://0.0.0.0:{port}"]
 
-            if check_port_available(requested_port) and requested_port not in self.used_ports:
-                port = requested_port
-                logger.info(f"Port {requested_port} is available for {email}")
-            else:
-                # Find available port that's not already used
-                port = requested_port + 1
-                while port in self.used_ports or not check_port_available(port):
-                    port += 1
-                    if port > requested_port + 100:
-                        raise RuntimeError(f"Could not find available port for {email}")
-                logger.warning(f"Port {requested_port} busy, using {port} for {email}")
+    async def handle_client(self, reader, writer, port, account_config, prefix=b""):
+        """Handle a client connection
 
-            self.used_ports.add(port)
-            self.account_by_port[port] = {
-                "email": email,
-                "original_port": requested_port,
-                **acc_config
-            }
+        prefix holds bytes already read off the connection (e.g. the first
+        byte consumed by the combined listener's protocol sniffing).
+        """
+        self.counters["connections"] += 1
+        accepted_at = time.monotonic()
+        m = metrics.for_account(account_config)
+        m.connections += 1
+        trace = tunnel_trace.begin("http", account_config, accepted_at)
+        try:
+            # Request line and headers share one deadline
+            head = await self.read_head(reader, writer, m,
+                                        timeouts.deadline(self.timeouts_for(account_config).request), prefix)
+            if head is None:
+                return
+            if trace is not None:
+                trace.mark("request")
+                trace.target = head.target
 
-    def create_client_handler(self, port, account_config):
-        """Create a client handler with account config bound to it"""
-        async def handle_client(reader, writer):
-            """Handle a client connection"""
-            try:
-                # Read the first line to determine if it's a CONNECT request
-                request_line = await reader.readline()
-                request_line = request_line.decode('utf-8').strip()
+            method = head.method
+            target = head.target
 
-                if not request_line:
+            if method == "CONNECT":
+                try:
+                    ticket = await admission.admit(account_config)
+                except admission.Rejected as e:
+                    logger.warning(f"[Port {port}] Rejected CONNECT {target}: {e}")
+                    m.error(f"admission_{e.reason}")
+                    if trace is not None:
+                        trace.finish(f"admission_{e.reason}")
+                    writer.write(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n\r\n")
+                    await writer.drain()
                     return
-
-                logger.info(f"[Port {port}] Received request: {request_line}")
-
-                # Parse the request line to determine method and target
-                parts = request_line.split()
-                if len(parts) < 3:
-                    writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+                if trace is not None:
+                    trace.mark("admitted")
+                try:
+                    await self.handle_connect(reader, writer, target, account_config, accepted_at, trace)
+                finally:
+                    ticket.release()
+            elif method in http_forward.FORWARD_METHODS:
+                try:
+                    request = http_forward.Request.from_head(head)
+                    ticket = await admission.admit(account_config)
+                except http_forward.ForwardError as e:
+                    m.error(e.stage)
+                    writer.write(b"HTTP/1.1 " + e.status + b"\r\nConnection: close\r\n\r\n")
+                    await writer.drain()
+                    return
+                except admission.Rejected as e:
+                    logger.warning(f"[Port {port}] Rejected {method} {target}: {e}")
+                    m.error(f"admission_{e.reason}")
+                    if trace is not None:
+                        trace.finish(f"admission_{e.reason}")
+                    writer.write(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n\r\n")
                     await writer.drain()
                     return
+                if trace is not None:
+                    trace.kind = "http_forward"
+                    trace.mark("admitted")
+                try:
+                    await self.handle_http(reader, writer, request, port, account_config, accepted_at, trace)
+                finally:
+                    ticket.release()
+            else:
+                writer.write(b"HTTP/1.1 501 Not Implemented\r\n\r\n")
+                await writer.drain()
 
-                method = parts[0]
-                target = parts[1]
+        except asyncio.TimeoutError:
+            logger.debug(f"[Port {port}] Request timed out")
+            m.error("request_timeout")
+        except Exception as e:
+            logger.error(f"[Port {port}] Error handling client: {e}")
+            m.error("client")
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except:
+                pass
 
-                # Read all HTTP headers until empty line
-                # This is CRITICAL for CONNECT requests - we must consume all headers
-                # before establishing the tunnel, otherwise they'll be sent to target
-                # as part of SSL/TLS handshake and break the connection
-                while True:
-                    header_line = await reader.readline()
-                    if not header_line or header_line == b'\r\n' or header_line == b'\n':
-                        break
+    async def read_head(self, reader, writer, m, deadline, prefix=b""):
+        """Next request head, or None after answering a bad one (or on EOF)"""
+        try:
+            return await http_head.read_head(reader, deadline, prefix)
+        except http_head.HeadTooLarge as e:
+            logger.warning(f"Rejected request head: {e}")
+            m.error("http_head_too_large")
+            writer.write(b"HTTP/1.1 431 Request Header Fields Too Large\r\nConnection: close\r\n\r\n")
+        except http_head.BadHead as e:
+            logger.warning(f"Rejected request head: {e}")
+            m.error("http_request")
+            writer.write(b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+        return None
 
-                if method == "CONNECT":
-                    await self.handle_connect(reader, writer, target, account_config)
-                else:
-                    # Handle regular HTTP requests - for now just send 501
-                    writer.write(b"HTTP/1.1 501 Not Implemented\r\n\r\n")
+    async def handle_http(self, reader, writer, request, port, account_config, accepted_at=None, trace=None):
+        """Forward plain-HTTP requests until either side ends the connection"""
+        limits = self.timeouts_for(account_config)
+        stats = tunnel_trace.relay_stats(relay_engine.ENGINE_ASYNCIO, trace)
+        # One access record per client connection, naming the last origin it asked for
+        record = proxy_log.TunnelRecord("http_forward", account_config, f"{request.host}:{request.port}",
+                                        accepted_at, writer) if proxy_log.enabled else None
+        outcome = proxy_log.OUTCOME_OK
+        # Waiting for the next keep-alive request counts as idle too
+        tunnel = timeouts.track(stats, asyncio.current_task(), limits.relay_idle)
+        self.counters["active_tunnels"] += 1
+        m = None
+        try:
+            while True:
+                upstream = upstream_health.route(account_config)
+                if m is None or m.upstream != upstream["name"]:
+                    # Each request is counted under the upstream that serves it
+                    if m is not None:
+                        m.active_tunnels -= 1
+                    m = metrics.for_account(account_config, upstream)
+                    m.active_tunnels += 1
+                if record is not None:
+                    record.target = f"{request.host}:{request.port}"
+                    record.upstream = upstream
+                if trace is not None:
+                    trace.target = f"{request.host}:{request.port}"
+                    trace.upstream = upstream["name"]
+                sent = (stats.bytes_up, stats.bytes_down)
+                try:
+                    keep_alive = await http_forward.forward(reader, writer, request, upstream, account_config,
+                                                            stats, limits.upstream_connect, trace)
+                except UpstreamError as e:
+                    logger.error(str(e))
+                    m.upstream_error(e)
+                    outcome = e.stage
+                    status = b"504 Gateway Timeout" if e.stage == "upstream_timeout" else b"502 Bad Gateway"
+                    writer.write(b"HTTP/1.1 " + status + b"\r\nConnection: close\r\n\r\n")
+                    await writer.drain()
+                    return
+                except http_forward.ForwardError as e:
+                    logger.error(f"[Port {port}] {request!r}: {e}")
+                    m.error(e.stage)
+                    outcome = e.stage
+                    writer.write(b"HTTP/1.1 " + e.status + b"\r\nConnection: close\r\n\r\n")
                     await writer.drain()
+                    return
+                finally:
+                    m.bytes_up += stats.bytes_up - sent[0]
+                    m.bytes_down += stats.bytes_down - sent[1]
+                if not keep_alive:
+                    return
 
-            except Exception as e:
-                logger.error(f"[Port {port}] Error handling client: {e}")
-            finally:
                 try:
-                    writer.close()
-                    await writer.wait_closed()
-                except:
-                    pass
-
-        return handle_client
+                    head = await self.read_head(reader, writer, m, timeouts.deadline(limits.relay_idle))
+                except asyncio.TimeoutError:
+                    return
+                if head is None:
+                    return
+                if head.method not in http_forward.FORWARD_METHODS:
+                    # CONNECT and friends need a fresh connection
+                    writer.write(b"HTTP/1.1 501 Not Implemented\r\nConnection: close\r\n\r\n")
+                    await writer.drain()
+                    return
+                try:
+                    request = http_forward.Request.from_head(head)
+                except http_forward.ForwardError as e:
+                    m.error(e.stage)
+                    writer.write(b"HTTP/1.1 " + e.status + b"\r\nConnection: close\r\n\r\n")
+                    await writer.drain()
+                    return
+        except asyncio.CancelledError:
+            if not tunnel.reaped:
+                raise
+            m.error("relay_idle")
+            outcome = proxy_log.OUTCOME_REAPED
+        finally:
+            if record is not None:
+                record.finish(outcome, stats)
+            if trace is not None:
+                trace.finish(outcome, stats)
+            timeouts.untrack(tunnel)
+            self.record_tunnel(stats)
+            self.counters["active_tunnels"] -= 1
+            if m is not None:
+                m.active_tunnels -= 1
 
-    async def handle_connect(self, reader, writer, target, account_config):
-        """Handle HTTPS CONNECT method"""
+    async def handle_connect(self, reader, writer, target, account_config, accepted_at=None, trace=None):
+        """Handle HTTPS CONNECT method; trace is the tunnel's tunnel_trace.Timeline"""
+        m = metrics.for_account(account_config)
+        record = proxy_log.TunnelRecord("http", account_config, target, accepted_at, writer) \
+            if proxy_log.enabled else None
         try:
             # target should be in the format host:port
             if ':' not in target:
+                m.error("http_request")
+                if trace is not None:
+                    trace.finish("http_request")
                 writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
                 await writer.drain()
                 return
@@ -132,173 +252,124 @@ class SwissProxy:
             try:
                 port = int(port_str)
             except ValueError:
+                m.error("http_request")
+                if trace is not None:
+                    trace.finish("http_request")
                 writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
                 await writer.drain()
                 return
 
-            logger.info(f"Connecting to {host}:{port} via {account_config['upstream']['name']}")
+            # The primary upstream, or a fallback while the prober finds it down or slow
+            upstream = upstream_health.route(account_config)
+            m = metrics.for_account(account_config, upstream)
+            if record is not None:
+                record.upstream = upstream
+            if trace is not None:
+                trace.upstream = upstream["name"]
 
             # Create connection to target based on upstream configuration
-            upstream = account_config["upstream"]
-            if upstream["type"] == "tor":
-                # Connect through Tor SOCKS proxy
-                try:
-                    target_reader, target_writer = await asyncio.open_connection(
-                        upstream['socks_host'], 
-                        upstream['socks_port']
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to connect to Tor SOCKS proxy: {e}")
-                    writer.write(b"HTTP/1.1 502 Bad Gateway\r\n\r\n")
-                    await writer.drain()
-                    return
-                
-                # Send SOCKS5 handshake
-                target_writer.write(bytearray([0x05, 0x01, 0x00]))  # Version 5, 1 auth method, no auth
-                await target_writer.drain()
-                
-                # Read authentication response
-                auth_response = await target_reader.read(2)
-                if len(auth_response) < 2 or auth_response[0] != 0x05:
-                    logger.error(f"SOCKS authentication failed: {auth_response}")
-                    target_writer.close()
-                    await target_writer.wait_closed()
-                    writer.write(b"HTTP/1.1 502 Bad Gateway\r\n\r\n")
-                    await writer.drain()
-                    return
-                
-                # Send CONNECT request to target
-                addr_type = 0x03  # Domain name
-                host_bytes = host.encode('ascii')
-                request_data = bytearray([0x05, 0x01, 0x00, addr_type])
-                request_data.append(len(host_bytes))
-                request_data.extend(host_bytes)
-                request_data.extend(port.to_bytes(2, 'big'))
-                
-                target_writer.write(request_data)
-                await target_writer.drain()
-                
-                # Read connection response
-                connect_response = await target_reader.read(10)
-                if len(connect_response) < 2 or connect_response[0] != 0x05 or connect_response[1] != 0x00:
-                    logger.error(f"SOCKS connection failed: response was {connect_response}")
-                    target_writer.close()
-                    await target_writer.wait_closed()
+            started = time.monotonic()
+            try:
+                target_reader, target_writer = await open_tunnel(
+                    upstream, host, port,
+                    timeout=self.timeouts_for(account_config).upstream_connect, trace=trace)
+            except UpstreamError as e:
+                logger.error(str(e))
+                m.upstream_error(e)
+                if record is not None:
+                    record.finish(e.stage)
+                if trace is not None:
+                    trace.finish(e.stage)
+                if e.stage == "upstream_timeout":
+                    writer.write(b"HTTP/1.1 504 Gateway Timeout\r\n\r\n")
+                else:
                     writer.write(b"HTTP/1.1 502 Bad Gateway\r\n\r\n")
-                    await writer.drain()
-                    return
-                
-                # Connection established, send success to client
-                writer.write(b"HTTP/1.1 200 Connection Established\r\nProxy-agent: SwissProxy/2.0\r\n\r\n")
                 await writer.drain()
-                
-            else:
-                # Direct connection to target
-                try:
-                    target_reader, target_writer = await asyncio.open_connection(host, port)
-                except Exception as e:
-                    logger.error(f"Failed to connect to target {host}:{port} - {e}")
-                    writer.write(f"HTTP/1.1 502 Bad Gateway\r\n\r\n".encode())
-                    await writer.drain()
-                    return
-                
-                # Connection established, send success to client
-                writer.write(b"HTTP/1.1 200 Connection Established\r\nProxy-agent: SwissProxy/2.0\r\n\r\n")
-                await writer.drain()
-            
+                return
+
+            m.upstream_connect.observe(time.monotonic() - started)
+
+            # Connection established, send success to client
+            writer.write(b"HTTP/1.1 200 Connection Established\r\nProxy-agent: SwissProxy/2.0\r\n\r\n")
+            await writer.drain()
+            if trace is not None:
+                trace.mark("replied")
+            if accepted_at is not None:
+                m.handshake.observe(time.monotonic() - accepted_at)
+                if record is not None:
+                    record.handshake = time.monotonic() - accepted_at
+
             # Now bridge data between client and target
-            await self.bridge_connections(reader, writer, target_reader, target_writer)
-            
+            await self.bridge_connections(reader, writer, target_reader, target_writer, account_config, record,
+                                          trace, upstream)
+
         except Exception as e:
             logger.error(f"Error in CONNECT: {e}")
+            m.error("connect")
+            if record is not None:
+                record.finish("connect")
+            if trace is not None:
+                trace.finish("connect")
             try:
                 writer.write(b"HTTP/1.1 500 Internal Server Error\r\n\r\n")
                 await writer.drain()
             except:
                 pass
 
-    async def bridge_connections(self, client_reader, client_writer, target_reader, target_writer):
-        """Bridge data between client and target"""
-        try:
-            # Create two tasks to forward data in both directions
-            async def forward_client_to_target():
-                try:
-                    while True:
-                        data = await client_reader.read(4096)
-                        if not data:
-                            break
-                        target_writer.write(data)
-                        await target_writer.drain()
-                except Exception as e:
-                    logger.debug(f"Client to target forward ended: {e}")
-                finally:
-                    try:
-                        target_writer.close()
-                        await target_writer.wait_closed()
-                    except:
-                        pass
-
-            async def forward_target_to_client():
-                try:
-                    while True:
-                        data = await target_reader.read(4096)
-                        if not data:
-                            break
-                        client_writer.write(data)
-                        await client_writer.drain()
-                except Exception as e:
-                    logger.debug(f"Target to client forward ended: {e}")
-                finally:
-                    try:
-                        client_writer.close()
-                        await client_writer.wait_closed()
-                    except:
-                        pass
-
-            # Run both directions concurrently
-            await asyncio.gather(
-                forward_client_to_target(),
-                forward_target_to_client(),
-                return_exceptions=True
-            )
-        except Exception as e:
-            logger.error(f"Bridge connection error: {e}")
-
-    async def start_server(self, port, account):
-        """Start a single proxy server for a specific account"""
-        handler = self.create_client_handler(port, account)
-        server = await asyncio.start_server(
-            handler,
-            '0.0.0.0',
-            port
-        )
-
-        logger.info(f"✅ HTTP/HTTPS Proxy started for {account['email']}")
-        logger.info(f"   Route: {account['upstream']['name']}")
-        logger.info(f"   Port: {port} (requested: {account['original_port']})")
-        logger.info(f"   URL: http://0.0.0.0:{port}")
+    async def bridge_connections(self, client_reader, client_writer, target_reader, target_writer,
+                                 account_config=None, record=None, trace=None, upstream=None):
+        """Bridge data between client and target.
 
-        async with server:
-            await server.serve_forever()
-
-    async def start_servers(self):
-        """Start HTTP/HTTPS proxy servers on multiple ports"""
-        tasks = []
-        
-        for port, account in self.account_by_port.items():
-            task = asyncio.create_task(self.start_server(port, account))
-            tasks.append(task)
-        
-        # Wait for all servers to complete (they run indefinitely)
-        await asyncio.gather(*tasks, return_exceptions=True)
+        record (proxy_log.TunnelRecord) and trace (tunnel_trace.Timeline)
+        are finished at the end. upstream is the one the tunnel was opened
+        through (default the account's primary), whose bandwidth it shares.
+        """
+        m = metrics.for_account(account_config, upstream) if account_config is not None else None
+        if account_config is not None:
+            limits, settings = self.timeouts_for(account_config), self.flow_for(account_config)
+            shapers = bandwidth.shapers_for(account_config, upstream or account_config["upstream"])
+        else:
+            limits, settings = timeouts.Timeouts(), flow_control.FlowSettings.from_config(self.relay_settings)
+            shapers = (None, None)
+        stats = tunnel_trace.relay_stats(self.relay_engine, trace)
+        tunnel = tunnel_state.Tunnel(client_reader, client_writer, target_reader, target_writer, stats, limits,
+                                     settings, shapers)
+        # The reaper cancels this task if no bytes move for relay_idle seconds
+        timeouts.track_tunnel(tunnel)
+        self.counters["active_tunnels"] += 1
+        if m is not None:
+            m.active_tunnels += 1
+        outcome = proxy_log.OUTCOME_OK
+        try:
+            await tunnel.run(self.relay_engine, self.relay_settings)
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            if not tunnel.reaped:
+                raise
+            outcome = proxy_log.OUTCOME_REAPED
+            if m is not None:
+                m.error("relay_idle")
+        finally:
+            if record is not None:
+                record.finish(outcome, stats)
+            if trace is not None:
+                trace.finish(outcome, stats)
+            timeouts.untrack(tunnel)
+            self.record_tunnel(stats)
+            self.counters["active_tunnels"] -= 1
+            if m is not None:
+                m.active_tunnels -= 1
+                m.bytes_up += stats.bytes_up
+                m.bytes_down += stats.bytes_down
+        return stats
 
 def main():
+    args = proxy_frontend.parse_args("HTTP/HTTPS proxy for Swiss accounts")
     try:
         config = load_config()
         logger.info("Configuration loaded successfully")
         
-        proxy = SwissProxy(config)
-        asyncio.run(proxy.start_servers())
+        proxy_frontend.serve(SwissProxy(config, allocate_ports=False), args)
         
     except FileNotFoundError:
         logger.error(f"Configuration file not found: {CONFIG_FILE}")
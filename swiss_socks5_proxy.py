@@ -1,19 +1,25 @@
 import json
 import asyncio
 import logging
-import socket
-import struct
-from contextlib import closing
-
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.FileHandler('/data/data/com.termux/files/home/vpn_v2/socks5_proxy.log'),
-        logging.StreamHandler()
-    ]
-)
+import time
+
+import admission
+import bandwidth
+import flow_control
+import metrics
+import port_map
+import proxy_frontend
+import proxy_log
+import timeouts
+import tunnel_state
+import tunnel_trace
+import upstream_health
+import socks5
+from socks5 import REP_SUCCESS, socks_reply
+from upstream import UpstreamError, open_tunnel
+
+# Setup logging (written by a background thread)
+proxy_log.setup('/data/data/com.termux/files/home/vpn_v2/socks5_proxy.log')
 logger = logging.getLogger(__name__)
 
 CONFIG_FILE = "/data/data/com.termux/files/home/vpn_v2/config.json"
@@ -22,340 +28,243 @@ def load_config():
     with open(CONFIG_FILE, "r") as f:
         return json.load(f)
 
-def check_port_available(port):
-    """Check if port is available"""
-    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-        try:
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.bind(('0.0.0.0', port))
-            return True
-        except OSError:
-            return False
-
-class SwissSOCKS5Proxy:
-    def __init__(self, config):
-        self.config = config
-        self.account_by_port = {}
-        self.used_ports = set()
+class SwissSOCKS5Proxy(proxy_frontend.ProxyFrontEnd):
+    port_map_kind = port_map.KIND_SOCKS5
+    config_path = CONFIG_FILE
+    title = "SOCKS5 Proxy"
+    listener_name = "SOCKS5"
 
-        # Map ports to accounts with port availability check
-        # SOCKS5 ports will be HTTP port + 1000 by default
-        for email, acc_config in config["accounts"].items():
+    def account_entry(self, email, acc_config):
+        """account_by_port value for an account (read-only, shared by its tunnels)"""
+        return tunnel_state.account_record(
+            email, acc_config,
             # SOCKS5 port = HTTP port + 1000 (e.g., 8888 -> 9888)
-            requested_port = acc_config["proxy_port"] + 1000
-
-            if check_port_available(requested_port) and requested_port not in self.used_ports:
-                port = requested_port
-                logger.info(f"Port {requested_port} is available for {email}")
-            else:
-                # Find available port that's not already used
-                port = requested_port + 1
-                while port in self.used_ports or not check_port_available(port):
-                    port += 1
-                    if port > requested_port + 100:
-                        raise RuntimeError(f"Could not find available port for {email}")
-                logger.warning(f"Port {requested_port} busy, using {port} for {email}")
-
-            self.used_ports.add(port)
-            self.account_by_port[port] = {
-                "email": email,
-                "original_port": requested_port,
-                "http_port": acc_config["proxy_port"],
-                **acc_config
-            }
+            original_port=acc_config["proxy_port"] + 1000,
+            http_port=acc_config["proxy_port"],
+        )
 
-    def create_client_handler(self, port, account_config):
-        """Create a SOCKS5 client handler with account config bound to it"""
-        async def handle_client(reader, writer):
-            """Handle a SOCKS5 client connection"""
+    def listener_info(self, port, account):
+        return [f"Port: {port} (HTTP port: {account['http_port']})", f"URL: socks5://0.0.0.0:{port}"]
+
+    async def handle_client(self, reader, writer, port, account_config, prefix=b""):
+        """Handle a SOCKS5 client connection
+
+        prefix holds bytes already read off the connection (e.g. the version
+        byte consumed by the combined listener's protocol sniffing).
+        """
+        self.counters["connections"] += 1
+        accepted_at = time.monotonic()
+        m = metrics.for_account(account_config)
+        m.connections += 1
+        limits = self.timeouts_for(account_config)
+        trace = tunnel_trace.begin("socks5", account_config, accepted_at)
+        try:
+            # SOCKS5 greeting
+            # Client sends: [VER, NMETHODS, METHODS]
+            # Frames are parsed incrementally, so short and coalesced reads are fine
             try:
-                # SOCKS5 greeting
-                # Client sends: [VER, NMETHODS, METHODS]
-                greeting = await reader.read(2)
-                if len(greeting) < 2:
-                    return
-
-                version, nmethods = greeting[0], greeting[1]
-                if version != 0x05:  # SOCKS version 5
-                    logger.error(f"[Port {port}] Unsupported SOCKS version: {version}")
-                    return
-
-                # Read authentication methods
-                methods = await reader.read(nmethods)
-
-                # We support no authentication (0x00)
-                if 0x00 not in methods:
-                    # No acceptable methods
-                    writer.write(bytes([0x05, 0xFF]))
-                    await writer.drain()
-                    return
-
-                # Send method selection: [VER, METHOD]
-                writer.write(bytes([0x05, 0x00]))  # No authentication required
+                greeting = await asyncio.wait_for(
+                    socks5.read_frame(reader, socks5.greeting_length, prefix), limits.greeting)
+            except socks5.Socks5Error as e:
+                logger.error(f"[Port {port}] {e}")
+                m.error("socks_greeting")
+                return
+            except asyncio.IncompleteReadError:
+                return
+            except asyncio.TimeoutError:
+                logger.debug(f"[Port {port}] Greeting timed out")
+                m.error("greeting_timeout")
+                return
+
+            # We support no authentication (0x00)
+            methods = greeting[2:]
+            if socks5.METHOD_NO_AUTH not in methods:
+                # No acceptable methods
+                m.error("socks_auth")
+                writer.write(bytes([socks5.VERSION, socks5.METHOD_NO_ACCEPTABLE]))
                 await writer.drain()
+                return
 
-                # SOCKS5 request
-                # Client sends: [VER, CMD, RSV, ATYP, DST.ADDR, DST.PORT]
-                request_header = await reader.read(4)
-                if len(request_header) < 4:
-                    return
-
-                version, cmd, rsv, atyp = request_header
+            # Send method selection: [VER, METHOD]
+            writer.write(bytes([socks5.VERSION, socks5.METHOD_NO_AUTH]))  # No authentication required
+            await writer.drain()
+            if trace is not None:
+                trace.mark("greeting")
 
-                if version != 0x05:
-                    logger.error(f"[Port {port}] Invalid SOCKS version in request: {version}")
-                    return
-
-                # Parse destination address based on address type
-                if atyp == 0x01:  # IPv4
-                    addr_bytes = await reader.read(4)
-                    dst_addr = socket.inet_ntop(socket.AF_INET, addr_bytes)
-                elif atyp == 0x03:  # Domain name
-                    addr_len_bytes = await reader.read(1)
-                    addr_len = addr_len_bytes[0]
-                    addr_bytes = await reader.read(addr_len)
-                    dst_addr = addr_bytes.decode('ascii')
-                elif atyp == 0x04:  # IPv6
-                    addr_bytes = await reader.read(16)
-                    dst_addr = socket.inet_ntop(socket.AF_INET6, addr_bytes)
-                else:
-                    logger.error(f"[Port {port}] Unsupported address type: {atyp}")
+            # SOCKS5 request
+            # Client sends: [VER, CMD, RSV, ATYP, DST.ADDR, DST.PORT]
+            try:
+                request = await asyncio.wait_for(
+                    socks5.read_frame(reader, socks5.request_length), limits.request)
+            except socks5.Socks5Error as e:
+                logger.error(f"[Port {port}] {e}")
+                m.error("socks_request")
+                if e.rep is not None:
                     # Send error response
-                    writer.write(bytes([0x05, 0x08, 0x00, 0x01]) + bytes(6))
+                    writer.write(socks_reply(e.rep))
                     await writer.drain()
-                    return
-
-                # Read destination port
-                port_bytes = await reader.read(2)
-                dst_port = struct.unpack('!H', port_bytes)[0]
-
-                logger.info(f"[Port {port}] SOCKS5 {cmd} request to {dst_addr}:{dst_port} via {account_config['upstream']['name']}")
-
-                # We only support CONNECT command (0x01)
-                if cmd == 0x01:  # CONNECT
-                    await self.handle_connect(reader, writer, dst_addr, dst_port, atyp, account_config, port)
-                else:
-                    logger.error(f"[Port {port}] Unsupported command: {cmd}")
-                    # Send command not supported error
-                    writer.write(bytes([0x05, 0x07, 0x00, 0x01]) + bytes(6))
+                return
+            except asyncio.IncompleteReadError:
+                return
+            except asyncio.TimeoutError:
+                logger.debug(f"[Port {port}] Request timed out")
+                m.error("request_timeout")
+                return
+
+            cmd, atyp, dst_addr, dst_port = socks5.parse_request(request)
+            if trace is not None:
+                trace.mark("request")
+                trace.target = f"{dst_addr}:{dst_port}"
+
+            # We only support CONNECT command (0x01)
+            if cmd == socks5.CMD_CONNECT:
+                try:
+                    ticket = await admission.admit(account_config)
+                except admission.Rejected as e:
+                    logger.warning(f"[Port {port}] Rejected {dst_addr}:{dst_port}: {e}")
+                    m.error(f"admission_{e.reason}")
+                    if trace is not None:
+                        trace.finish(f"admission_{e.reason}")
+                    # Queue full: refuse outright; timed out in the queue: general failure
+                    rep = (socks5.REP_CONNECTION_REFUSED if e.reason == admission.REASON_QUEUE_FULL
+                           else socks5.REP_GENERAL_FAILURE)
+                    writer.write(socks_reply(rep))
                     await writer.drain()
-
-            except Exception as e:
-                logger.error(f"[Port {port}] Error handling client: {e}", exc_info=True)
-            finally:
+                    return
+                if trace is not None:
+                    trace.mark("admitted")
                 try:
-                    writer.close()
-                    await writer.wait_closed()
-                except:
-                    pass
-
-        return handle_client
+                    await self.handle_connect(reader, writer, dst_addr, dst_port, atyp, account_config, port,
+                                              accepted_at, trace)
+                finally:
+                    ticket.release()
+            else:
+                logger.error(f"[Port {port}] Unsupported command: {cmd}")
+                m.error("socks_command")
+                # Send command not supported error
+                writer.write(socks_reply(socks5.REP_COMMAND_NOT_SUPPORTED))
+                await writer.drain()
 
-    async def handle_connect(self, client_reader, client_writer, dst_addr, dst_port, atyp, account_config, listen_port):
-        """Handle SOCKS5 CONNECT command"""
+        except Exception as e:
+            logger.error(f"[Port {port}] Error handling client: {e}", exc_info=True)
+            m.error("client")
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except:
+                pass
+
+    async def handle_connect(self, client_reader, client_writer, dst_addr, dst_port, atyp, account_config, listen_port,
+                             accepted_at=None, trace=None):
+        """Handle SOCKS5 CONNECT command; trace is the tunnel's tunnel_trace.Timeline"""
+        m = metrics.for_account(account_config)
+        record = proxy_log.TunnelRecord("socks5", account_config, f"{dst_addr}:{dst_port}", accepted_at,
+                                        client_writer) if proxy_log.enabled else None
         try:
-            upstream = account_config["upstream"]
-
-            if upstream["type"] == "tor":
-                # Connect through Tor SOCKS proxy
-                try:
-                    target_reader, target_writer = await asyncio.open_connection(
-                        upstream['socks_host'],
-                        upstream['socks_port']
-                    )
-                except Exception as e:
-                    logger.error(f"[Port {listen_port}] Failed to connect to Tor: {e}")
-                    # Send connection refused error
-                    client_writer.write(bytes([0x05, 0x05, 0x00, 0x01]) + bytes(6))
-                    await client_writer.drain()
-                    return
-
-                # Send SOCKS5 handshake to Tor
-                target_writer.write(bytes([0x05, 0x01, 0x00]))  # Version 5, 1 auth method, no auth
-                await target_writer.drain()
-
-                # Read authentication response
-                auth_response = await target_reader.read(2)
-                if len(auth_response) < 2 or auth_response[0] != 0x05:
-                    logger.error(f"[Port {listen_port}] Tor SOCKS authentication failed")
-                    client_writer.write(bytes([0x05, 0x05, 0x00, 0x01]) + bytes(6))
-                    await client_writer.drain()
-                    target_writer.close()
-                    await target_writer.wait_closed()
-                    return
-
-                # Build CONNECT request preserving the original address type
-                # Tor supports: 0x01 (IPv4), 0x03 (domain), 0x04 (IPv6)
-                # However, for IP addresses (IPv4/IPv6), convert to domain name
-                # so Tor re-resolves through its own DNS (prevents DNS leak)
-                request_data = bytearray([0x05, 0x01, 0x00])
-
-                if atyp == 0x03:
-                    # Domain name - pass through as-is
-                    request_data.append(0x03)
-                    host_bytes = dst_addr.encode('ascii')
-                    request_data.append(len(host_bytes))
-                    request_data.extend(host_bytes)
-                elif atyp == 0x01:
-                    # IPv4 - send as IPv4 type to Tor
-                    request_data.append(0x01)
-                    request_data.extend(socket.inet_pton(socket.AF_INET, dst_addr))
-                elif atyp == 0x04:
-                    # IPv6 - send as IPv6 type to Tor
-                    request_data.append(0x04)
-                    request_data.extend(socket.inet_pton(socket.AF_INET6, dst_addr))
-                else:
-                    logger.error(f"[Port {listen_port}] Unknown address type {atyp}")
-                    client_writer.write(bytes([0x05, 0x08, 0x00, 0x01]) + bytes(6))
-                    await client_writer.drain()
-                    target_writer.close()
-                    await target_writer.wait_closed()
-                    return
-
-                request_data.extend(struct.pack('!H', dst_port))
-
-                target_writer.write(request_data)
-                await target_writer.drain()
-
-                # Read connection response from Tor
-                # Response: VER(1) REP(1) RSV(1) ATYP(1) + addr + port
-                connect_response = await target_reader.read(4)
-                if len(connect_response) < 4 or connect_response[0] != 0x05 or connect_response[1] != 0x00:
-                    error_code = connect_response[1] if len(connect_response) >= 2 else 'N/A'
-                    logger.error(f"[Port {listen_port}] Tor SOCKS connection failed (code={error_code}) for {dst_addr}:{dst_port} atyp={atyp}")
-                    # Consume remaining response bytes
-                    try:
-                        await asyncio.wait_for(target_reader.read(256), timeout=1.0)
-                    except:
-                        pass
-                    client_writer.write(bytes([0x05, 0x05, 0x00, 0x01]) + bytes(6))
-                    await client_writer.drain()
-                    target_writer.close()
-                    await target_writer.wait_closed()
-                    return
-
-                # Consume the rest of the Tor response (bind addr + port)
-                resp_atyp = connect_response[3]
-                if resp_atyp == 0x01:
-                    await target_reader.read(4 + 2)  # IPv4 + port
-                elif resp_atyp == 0x03:
-                    addr_len = (await target_reader.read(1))[0]
-                    await target_reader.read(addr_len + 2)
-                elif resp_atyp == 0x04:
-                    await target_reader.read(16 + 2)  # IPv6 + port
-                else:
-                    await target_reader.read(6)  # fallback
-
-                logger.info(f"[Port {listen_port}] Connected to {dst_addr}:{dst_port} via Tor")
-
-            else:
-                # Direct connection
-                try:
-                    target_reader, target_writer = await asyncio.open_connection(dst_addr, dst_port)
-                    logger.info(f"[Port {listen_port}] Connected to {dst_addr}:{dst_port} directly")
-                except Exception as e:
-                    logger.error(f"[Port {listen_port}] Failed to connect to {dst_addr}:{dst_port}: {e}")
-                    # Send connection refused error
-                    client_writer.write(bytes([0x05, 0x05, 0x00, 0x01]) + bytes(6))
-                    await client_writer.drain()
-                    return
+            # The primary upstream, or a fallback while the prober finds it down or slow
+            upstream = upstream_health.route(account_config)
+            m = metrics.for_account(account_config, upstream)
+            if record is not None:
+                record.upstream = upstream
+            if trace is not None:
+                trace.upstream = upstream["name"]
+
+            started = time.monotonic()
+            try:
+                target_reader, target_writer = await open_tunnel(
+                    upstream, dst_addr, dst_port, atyp, timeout=self.timeouts_for(account_config).upstream_connect,
+                    trace=trace)
+            except UpstreamError as e:
+                logger.error(f"[Port {listen_port}] {e}")
+                m.upstream_error(e)
+                if record is not None:
+                    record.finish(e.stage)
+                if trace is not None:
+                    trace.finish(e.stage)
+                client_writer.write(socks_reply(e.rep))
+                await client_writer.drain()
+                return
+
+            m.upstream_connect.observe(time.monotonic() - started)
 
             # Send success response to client
-            # [VER, REP, RSV, ATYP, BND.ADDR, BND.PORT]
-            response = bytes([0x05, 0x00, 0x00, 0x01])  # Success
-            response += bytes([0, 0, 0, 0])  # Bind address 0.0.0.0
-            response += bytes([0, 0])  # Bind port 0
-            client_writer.write(response)
+            # [VER, REP, RSV, ATYP, BND.ADDR, BND.PORT] with bind address 0.0.0.0:0
+            client_writer.write(socks_reply(REP_SUCCESS))
             await client_writer.drain()
+            if trace is not None:
+                trace.mark("replied")
+            if accepted_at is not None:
+                m.handshake.observe(time.monotonic() - accepted_at)
+                if record is not None:
+                    record.handshake = time.monotonic() - accepted_at
 
             # Now relay data between client and target
-            await self.relay_data(client_reader, client_writer, target_reader, target_writer, listen_port)
+            await self.relay_data(client_reader, client_writer, target_reader, target_writer, listen_port,
+                                  account_config, record, trace, upstream)
 
         except Exception as e:
             logger.error(f"[Port {listen_port}] Error in CONNECT: {e}", exc_info=True)
-
-    async def relay_data(self, client_reader, client_writer, target_reader, target_writer, port):
-        """Relay data between client and target"""
+            m.error("connect")
+            if record is not None:
+                record.finish("connect")
+            if trace is not None:
+                trace.finish("connect")
+
+    async def relay_data(self, client_reader, client_writer, target_reader, target_writer, port,
+                         account_config=None, record=None, trace=None, upstream=None):
+        """Relay data between client and target.
+
+        record (proxy_log.TunnelRecord) and trace (tunnel_trace.Timeline)
+        are finished at the end. upstream is the one the tunnel was opened
+        through (default the account's primary), whose bandwidth it shares.
+        """
+        m = metrics.for_account(account_config, upstream) if account_config is not None else None
+        if account_config is not None:
+            limits, settings = self.timeouts_for(account_config), self.flow_for(account_config)
+            shapers = bandwidth.shapers_for(account_config, upstream or account_config["upstream"])
+        else:
+            limits, settings = timeouts.Timeouts(), flow_control.FlowSettings.from_config(self.relay_settings)
+            shapers = (None, None)
+        stats = tunnel_trace.relay_stats(self.relay_engine, trace)
+        tunnel = tunnel_state.Tunnel(client_reader, client_writer, target_reader, target_writer, stats, limits,
+                                     settings, shapers)
+        # The reaper cancels this task if no bytes move for relay_idle seconds
+        timeouts.track_tunnel(tunnel)
+        self.counters["active_tunnels"] += 1
+        if m is not None:
+            m.active_tunnels += 1
+        outcome = proxy_log.OUTCOME_OK
         try:
-            async def forward_client_to_target():
-                try:
-                    while True:
-                        data = await client_reader.read(8192)
-                        if not data:
-                            break
-                        target_writer.write(data)
-                        await target_writer.drain()
-                except Exception as e:
-                    logger.debug(f"[Port {port}] Client->Target relay ended: {e}")
-                finally:
-                    try:
-                        target_writer.close()
-                        await target_writer.wait_closed()
-                    except:
-                        pass
-
-            async def forward_target_to_client():
-                try:
-                    while True:
-                        data = await target_reader.read(8192)
-                        if not data:
-                            break
-                        client_writer.write(data)
-                        await client_writer.drain()
-                except Exception as e:
-                    logger.debug(f"[Port {port}] Target->Client relay ended: {e}")
-                finally:
-                    try:
-                        client_writer.close()
-                        await client_writer.wait_closed()
-                    except:
-                        pass
-
-            # Run both directions concurrently
-            await asyncio.gather(
-                forward_client_to_target(),
-                forward_target_to_client(),
-                return_exceptions=True
-            )
-        except Exception as e:
-            logger.error(f"[Port {port}] Relay error: {e}")
-
-    async def start_server(self, port, account):
-        """Start a single SOCKS5 proxy server for a specific account"""
-        handler = self.create_client_handler(port, account)
-        server = await asyncio.start_server(
-            handler,
-            '0.0.0.0',
-            port,
-            reuse_address=True
-        )
-
-        logger.info(f"✅ SOCKS5 Proxy started for {account['email']}")
-        logger.info(f"   Route: {account['upstream']['name']}")
-        logger.info(f"   Port: {port} (HTTP port: {account['http_port']})")
-        logger.info(f"   URL: socks5://0.0.0.0:{port}")
-
-        async with server:
-            await server.serve_forever()
-
-    async def start_servers(self):
-        """Start SOCKS5 proxy servers on multiple ports"""
-        tasks = []
-
-        for port, account in self.account_by_port.items():
-            task = asyncio.create_task(self.start_server(port, account))
-            tasks.append(task)
-
-        # Wait for all servers to complete (they run indefinitely)
-        await asyncio.gather(*tasks, return_exceptions=True)
+            await tunnel.run(self.relay_engine, self.relay_settings)
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            if not tunnel.reaped:
+                raise
+            outcome = proxy_log.OUTCOME_REAPED
+            if m is not None:
+                m.error("relay_idle")
+        finally:
+            if record is not None:
+                record.finish(outcome, stats)
+            if trace is not None:
+                trace.finish(outcome, stats)
+            timeouts.untrack(tunnel)
+            self.record_tunnel(stats)
+            self.counters["active_tunnels"] -= 1
+            if m is not None:
+                m.active_tunnels -= 1
+                m.bytes_up += stats.bytes_up
+                m.bytes_down += stats.bytes_down
+        return stats
 
 def main():
+    args = proxy_frontend.parse_args("SOCKS5 proxy for Swiss accounts")
     try:
         config = load_config()
         logger.info("Configuration loaded successfully")
 
-        proxy = SwissSOCKS5Proxy(config)
-        asyncio.run(proxy.start_servers())
+        proxy_frontend.serve(SwissSOCKS5Proxy(config, allocate_ports=False), args)
 
     except FileNotFoundError:
         logger.error(f"Configuration file not found: {CONFIG_FILE}")
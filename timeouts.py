@@ -0,0 +1,157 @@
+"""Per-stage timeouts and the idle tunnel reaper.
+
+Every stage of a connection has a deadline: the SOCKS5 greeting, the
+SOCKS5/HTTP request, the upstream connect and, once relaying, the time a
+tunnel may go without moving a byte in either direction. After one side
+of a tunnel half-closes, the other direction gets half_close seconds to
+finish. 0 disables a timeout.
+
+Idle tunnels are found by a periodic reaper that samples each tunnel's
+byte counters (RelayStats, updated by every relay engine) instead of
+timestamping every read, so it covers the splice and protocol engines as
+well. Reaped tunnels are cancelled and counted.
+
+Config (optional, top level of config.json; an account can override any
+key with its own "timeouts" object):
+
+    "timeouts": {"greeting": 10, "request": 10, "upstream_connect": 30,
+                 "relay_idle": 300, "half_close": 30}
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GREETING = 10.0
+DEFAULT_REQUEST = 10.0
+DEFAULT_UPSTREAM_CONNECT = 30.0
+DEFAULT_RELAY_IDLE = 300.0
+DEFAULT_HALF_CLOSE = 30.0
+REAP_INTERVAL = 5.0
+
+
+class Timeouts:
+    """Stage deadlines in seconds for one account (None = no limit)"""
+    __slots__ = ("greeting", "request", "upstream_connect", "relay_idle", "half_close")
+
+    def __init__(self, greeting=DEFAULT_GREETING, request=DEFAULT_REQUEST,
+                 upstream_connect=DEFAULT_UPSTREAM_CONNECT, relay_idle=DEFAULT_RELAY_IDLE,
+                 half_close=DEFAULT_HALF_CLOSE):
+        # asyncio.wait_for() takes None as "no timeout"
+        self.greeting = greeting or None
+        self.request = request or None
+        self.upstream_connect = upstream_connect or None
+        self.relay_idle = relay_idle or None
+        self.half_close = half_close or None
+
+    def __repr__(self):
+        return ("Timeouts(" + ", ".join(f"{name}={getattr(self, name)}" for name in self.__slots__) + ")")
+
+    @classmethod
+    def from_config(cls, config, account_config=None):
+        """Top-level "timeouts" overridden by the account's "timeouts" section"""
+        settings = dict(config.get("timeouts", {}))
+        if account_config:
+            settings.update(account_config.get("timeouts", {}))
+        return cls(
+            greeting=settings.get("greeting", DEFAULT_GREETING),
+            request=settings.get("request", DEFAULT_REQUEST),
+            upstream_connect=settings.get("upstream_connect", DEFAULT_UPSTREAM_CONNECT),
+            relay_idle=settings.get("relay_idle", DEFAULT_RELAY_IDLE),
+            half_close=settings.get("half_close", DEFAULT_HALF_CLOSE),
+        )
+
+
+def deadline(timeout):
+    """Loop time by which a stage must finish, or None for no limit"""
+    if timeout is None:
+        return None
+    return asyncio.get_running_loop().time() + timeout
+
+
+async def before(deadline, aw):
+    """Await aw, raising asyncio.TimeoutError once deadline has passed.
+
+    Lets a stage made of several reads (request line + headers) share one
+    deadline instead of restarting the clock on every read.
+    """
+    if deadline is None:
+        return await aw
+    return await asyncio.wait_for(aw, max(0.0, deadline - asyncio.get_running_loop().time()))
+
+
+class TrackedTunnel:
+    """A relaying tunnel as seen by the reaper; task is cancelled if it goes idle"""
+    __slots__ = ("stats", "task", "idle_timeout", "last_bytes", "last_change", "reaped")
+
+    def __init__(self, stats, task, idle_timeout):
+        self.stats = stats
+        self.task = task
+        self.idle_timeout = idle_timeout
+        self.last_bytes = 0
+        self.last_change = time.monotonic()
+        self.reaped = False
+
+
+class TunnelReaper:
+    """Cancels tunnels whose byte counters stop moving for idle_timeout"""
+
+    def __init__(self, interval=REAP_INTERVAL):
+        self.interval = interval
+        self.tunnels = set()
+        self.reaped = 0
+        self._task = None
+
+    def __repr__(self):
+        return f"TunnelReaper({len(self.tunnels)} tunnels, {self.reaped} reaped)"
+
+    def stats(self):
+        return {"tracked": len(self.tunnels), "reaped": self.reaped}
+
+    def track(self, tunnel):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self.tunnels.add(tunnel)
+        return tunnel
+
+    def untrack(self, tunnel):
+        self.tunnels.discard(tunnel)
+
+    def reap(self, now):
+        for tunnel in list(self.tunnels):
+            total = tunnel.stats.bytes_up + tunnel.stats.bytes_down
+            if total != tunnel.last_bytes:
+                tunnel.last_bytes = total
+                tunnel.last_change = now
+            elif tunnel.idle_timeout and now - tunnel.last_change >= tunnel.idle_timeout:
+                tunnel.reaped = True
+                tunnel.task.cancel()
+                self.tunnels.discard(tunnel)
+                self.reaped += 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.reap(time.monotonic())
+
+
+_reaper = TunnelReaper()
+
+
+def track(stats, task, idle_timeout):
+    """Register a relaying tunnel; task is cancelled if it goes idle"""
+    return _reaper.track(TrackedTunnel(stats, task, idle_timeout))
+
+
+def track_tunnel(tunnel):
+    """Register a TrackedTunnel built by the caller (tunnel_state.Tunnel)"""
+    return _reaper.track(tunnel)
+
+
+def untrack(tunnel):
+    _reaper.untrack(tunnel)
+
+
+def reaper_stats():
+    return _reaper.stats()
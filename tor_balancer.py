@@ -0,0 +1,177 @@
+"""Load balancing across several Tor SOCKS endpoints for one upstream.
+
+A `type: tor` upstream normally names a single socks_host/socks_port. It
+can list several local tor daemons instead, and each CONNECT then picks
+one of them:
+
+    "upstream": {"type": "tor", "name": "Tor x3",
+                 "endpoints": [{"socks_host": "127.0.0.1", "socks_port": 9050},
+                               {"socks_host": "127.0.0.1", "socks_port": 9052},
+                               {"socks_host": "127.0.0.1", "socks_port": 9054}],
+                 "balance": "least_outstanding", "eject_after": 2,
+                 "eject_base": 5, "eject_max": 120}
+
+- least_outstanding (default): fewest tunnels open or connecting through
+  the endpoint, ties broken by connect latency,
+- ewma: lowest EWMA of connect latency (Tor's CONNECT reply included,
+  so slow circuits count), weighted by outstanding tunnels.
+
+An endpoint whose SOCKS port fails eject_after times in a row (refused,
+or the greeting failed) is ejected for eject_base seconds, doubling on
+every further ejection up to eject_max; after that it gets a probe
+connection. A Tor reply error about the destination does not count
+against the endpoint. If every endpoint is ejected the one due back
+first is used anyway.
+
+Each endpoint keeps its own warm pool (tor_pool.py). Endpoint state is
+shared by every upstream that lists the endpoint, so outstanding counts
+are per tor daemon; upstreams with the same endpoints and settings share
+one balancer.
+"""
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+BALANCE_LEAST_OUTSTANDING = "least_outstanding"
+BALANCE_EWMA = "ewma"
+BALANCE_STRATEGIES = (BALANCE_LEAST_OUTSTANDING, BALANCE_EWMA)
+DEFAULT_EJECT_AFTER = 2
+DEFAULT_EJECT_BASE = 5.0
+DEFAULT_EJECT_MAX = 120.0
+# Weight of the newest connect latency sample
+EWMA_ALPHA = 0.3
+
+
+def endpoints_of(upstream):
+    """[(host, port), ...] a tor upstream connects to"""
+    if "endpoints" in upstream:
+        return [(e["socks_host"], e["socks_port"]) for e in upstream["endpoints"]]
+    return [(upstream["socks_host"], upstream["socks_port"])]
+
+
+class Endpoint:
+    """One Tor SOCKS port and its health"""
+    __slots__ = ("host", "port", "outstanding", "ewma", "failures", "ejections",
+                 "ejected_until", "connects", "errors")
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.outstanding = 0
+        self.ewma = None          # seconds; None until the first success
+        self.failures = 0         # consecutive
+        self.ejections = 0        # consecutive, sets the backoff
+        self.ejected_until = 0.0
+        self.connects = 0
+        self.errors = 0
+
+    def __repr__(self):
+        return f"Endpoint({self.host}:{self.port}, outstanding={self.outstanding}, ewma={self.ewma})"
+
+    def stats(self, now):
+        return {
+            "endpoint": f"{self.host}:{self.port}",
+            "outstanding": self.outstanding,
+            "ewma_seconds": round(self.ewma, 4) if self.ewma is not None else None,
+            "ejected": self.ejected_until > now,
+            "connects": self.connects,
+            "errors": self.errors,
+        }
+
+
+class Balancer:
+    """Picks an endpoint per CONNECT and tracks endpoint health"""
+
+    def __init__(self, endpoints, strategy=BALANCE_LEAST_OUTSTANDING, eject_after=DEFAULT_EJECT_AFTER,
+                 eject_base=DEFAULT_EJECT_BASE, eject_max=DEFAULT_EJECT_MAX):
+        if strategy not in BALANCE_STRATEGIES:
+            logger.warning(f"Unknown balance strategy '{strategy}', using {BALANCE_LEAST_OUTSTANDING}")
+            strategy = BALANCE_LEAST_OUTSTANDING
+        self.endpoints = [_endpoint(host, port) for host, port in endpoints]
+        self.strategy = strategy
+        self.eject_after = max(1, eject_after)
+        self.eject_base = eject_base
+        self.eject_max = eject_max
+
+    def __repr__(self):
+        return f"Balancer({self.strategy}, {len(self.endpoints)} endpoints)"
+
+    def stats(self):
+        now = time.monotonic()
+        return [endpoint.stats(now) for endpoint in self.endpoints]
+
+    def _cost(self, endpoint):
+        # Unmeasured endpoints cost nothing, so each gets tried early
+        latency = endpoint.ewma or 0.0
+        if self.strategy == BALANCE_EWMA:
+            return (latency * (endpoint.outstanding + 1), endpoint.outstanding)
+        return (endpoint.outstanding, latency)
+
+    def pick(self, exclude=()):
+        """Endpoint for the next connection, skipping those in exclude"""
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e not in exclude] or self.endpoints
+        healthy = [e for e in candidates if e.ejected_until <= now]
+        if not healthy:
+            return min(candidates, key=lambda e: e.ejected_until)
+        return min(healthy, key=self._cost)
+
+    def acquire(self, endpoint):
+        endpoint.outstanding += 1
+        endpoint.connects += 1
+
+    def release(self, endpoint):
+        endpoint.outstanding -= 1
+
+    def success(self, endpoint, latency):
+        endpoint.failures = 0
+        endpoint.ejections = 0
+        if endpoint.ewma is None:
+            endpoint.ewma = latency
+        else:
+            endpoint.ewma += EWMA_ALPHA * (latency - endpoint.ewma)
+
+    def failure(self, endpoint):
+        endpoint.errors += 1
+        endpoint.failures += 1
+        now = time.monotonic()
+        # Connects already in flight when it was ejected don't extend the backoff
+        if endpoint.failures < self.eject_after or endpoint.ejected_until > now:
+            return
+        backoff = min(self.eject_base * math.pow(2, endpoint.ejections), self.eject_max)
+        endpoint.ejections += 1
+        endpoint.ejected_until = now + backoff
+        logger.warning(f"Ejecting Tor endpoint {endpoint.host}:{endpoint.port} for {backoff:g}s "
+                       f"after {endpoint.failures} failures")
+
+
+_endpoints = {}
+_balancers = {}
+
+
+def _endpoint(host, port):
+    endpoint = _endpoints.get((host, port))
+    if endpoint is None:
+        endpoint = _endpoints[(host, port)] = Endpoint(host, port)
+    return endpoint
+
+
+def get_balancer(upstream):
+    """Shared balancer for a tor upstream with an "endpoints" list"""
+    key = (tuple(endpoints_of(upstream)),
+           upstream.get("balance", BALANCE_LEAST_OUTSTANDING),
+           upstream.get("eject_after", DEFAULT_EJECT_AFTER),
+           upstream.get("eject_base", DEFAULT_EJECT_BASE),
+           upstream.get("eject_max", DEFAULT_EJECT_MAX))
+    balancer = _balancers.get(key)
+    if balancer is None:
+        balancer = _balancers[key] = Balancer(*key)
+    return balancer
+
+
+def endpoint_stats():
+    """Stats of every balanced endpoint, keyed by host:port"""
+    now = time.monotonic()
+    return {f"{host}:{port}": endpoint.stats(now) for (host, port), endpoint in _endpoints.items()}
@@ -0,0 +1,209 @@
+"""Warm pool of Tor SOCKS connections that already finished method negotiation.
+
+Every CONNECT through a `type: tor` upstream used to open a fresh TCP
+socket to Tor and do the `05 01 00` greeting before it could send the
+CONNECT frame. The pool keeps sockets that are already past that step, so
+handle_connect only has to send the CONNECT request.
+
+Config (optional, per upstream in config.json):
+
+    "upstream": {"type": "tor", "socks_host": "127.0.0.1", "socks_port": 9050,
+                 "pool_size": 4, "pool_max_idle": 30}
+
+Upstreams that share socks_host/socks_port share one pool. An upstream
+with several "endpoints" (tor_balancer.py) has a pool per endpoint.
+"""
+import asyncio
+import collections
+import logging
+import time
+
+import socks5
+import tor_balancer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 4
+# Tor drops SOCKS connections that sit unattached for SocksTimeout (2 min)
+DEFAULT_MAX_IDLE = 30.0
+REFILL_BACKOFF_MAX = 30.0
+STATS_LOG_INTERVAL = 300.0
+
+
+class SocksNegotiationError(Exception):
+    """Tor did not accept the SOCKS5 method negotiation"""
+
+
+async def open_negotiated(host, port):
+    """Open a connection to a SOCKS5 server and negotiate 'no authentication'"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(socks5.GREETING_NO_AUTH)
+        await writer.drain()
+        auth_response = await reader.read(2)
+        if len(auth_response) < 2 or auth_response[0] != 0x05 or auth_response[1] != 0x00:
+            raise SocksNegotiationError(f"unexpected method reply {auth_response!r}")
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+class TorSocksPool:
+    """Pre-handshaked connections to one Tor SOCKS port"""
+
+    def __init__(self, host, port, size=DEFAULT_POOL_SIZE, max_idle=DEFAULT_MAX_IDLE):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_idle = max_idle
+        self.idle = collections.deque()  # (reader, writer, created_at)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refill_failures = 0
+        self._refill_task = None
+        self._maintenance_task = None
+
+    def __repr__(self):
+        return f"TorSocksPool({self.host}:{self.port}, size={self.size})"
+
+    def stats(self):
+        return {
+            "endpoint": f"{self.host}:{self.port}",
+            "size": self.size,
+            "idle": len(self.idle),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "refill_failures": self.refill_failures,
+        }
+
+    def _is_stale(self, entry, now):
+        reader, writer, created_at = entry
+        return (now - created_at > self.max_idle
+                or reader.at_eof()
+                or writer.is_closing())
+
+    def _evict_stale(self):
+        now = time.monotonic()
+        fresh = collections.deque()
+        for entry in self.idle:
+            if self._is_stale(entry, now):
+                entry[1].close()
+                self.evictions += 1
+            else:
+                fresh.append(entry)
+        self.idle = fresh
+
+    def take(self):
+        """Pop a warm (reader, writer) pair, or None on a miss.
+
+        The caller opens its own connection on a miss (e.g. with a
+        pipelined greeting + CONNECT).
+        """
+        self.start()
+        now = time.monotonic()
+        while self.idle:
+            entry = self.idle.popleft()
+            if self._is_stale(entry, now):
+                entry[1].close()
+                self.evictions += 1
+                continue
+            self.hits += 1
+            self._schedule_refill()
+            return entry[0], entry[1]
+
+        self.misses += 1
+        self._schedule_refill()
+        return None
+
+    async def acquire(self):
+        """Return a (reader, writer) pair ready for a SOCKS5 CONNECT request.
+
+        Raises OSError if Tor is unreachable and SocksNegotiationError if it
+        rejects the greeting.
+        """
+        conn = self.take()
+        if conn is not None:
+            return conn
+        return await open_negotiated(self.host, self.port)
+
+    def start(self):
+        """Start background refill and eviction (needs a running loop)"""
+        if self.size <= 0 or self._maintenance_task is not None:
+            return
+        self._maintenance_task = asyncio.create_task(self._maintain())
+        self._schedule_refill()
+
+    def _schedule_refill(self):
+        if self.size <= 0 or len(self.idle) >= self.size:
+            return
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        backoff = 0.5
+        while len(self.idle) < self.size:
+            try:
+                reader, writer = await open_negotiated(self.host, self.port)
+            except (OSError, SocksNegotiationError, asyncio.IncompleteReadError) as e:
+                self.refill_failures += 1
+                logger.warning(f"Tor pool {self.host}:{self.port} refill failed: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, REFILL_BACKOFF_MAX)
+                continue
+            self.idle.append((reader, writer, time.monotonic()))
+
+    async def _maintain(self):
+        last_stats_log = time.monotonic()
+        while True:
+            await asyncio.sleep(max(self.max_idle / 2, 1.0))
+            self._evict_stale()
+            self._schedule_refill()
+            if time.monotonic() - last_stats_log >= STATS_LOG_INTERVAL:
+                last_stats_log = time.monotonic()
+                logger.info(f"Tor pool stats: {self.stats()}")
+
+    async def close(self):
+        for task in (self._maintenance_task, self._refill_task):
+            if task is not None:
+                task.cancel()
+        while self.idle:
+            self.idle.popleft()[1].close()
+
+
+_pools = {}
+
+
+def get_pool(upstream, endpoint=None):
+    """Return the shared pool for a tor upstream config.
+
+    endpoint is a (host, port) from the upstream's "endpoints" list; it
+    defaults to socks_host/socks_port.
+    """
+    key = endpoint or (upstream["socks_host"], upstream["socks_port"])
+    pool = _pools.get(key)
+    if pool is None:
+        pool = TorSocksPool(
+            key[0],
+            key[1],
+            size=upstream.get("pool_size", DEFAULT_POOL_SIZE),
+            max_idle=upstream.get("pool_max_idle", DEFAULT_MAX_IDLE),
+        )
+        _pools[key] = pool
+    return pool
+
+
+def warm_pools(accounts):
+    """Create and start filling pools for every tor upstream in the accounts"""
+    for account in accounts:
+        upstream = account["upstream"]
+        if upstream["type"] == "tor":
+            for endpoint in tor_balancer.endpoints_of(upstream):
+                get_pool(upstream, endpoint).start()
+
+
+def pool_stats():
+    """Hit/miss counters of every pool, keyed by endpoint"""
+    return {f"{host}:{port}": pool.stats() for (host, port), pool in _pools.items()}
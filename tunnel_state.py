@@ -0,0 +1,125 @@
+"""Compact per-tunnel state and the state machine that relays it.
+
+From the success reply until it closes, a tunnel is one Tunnel object with
+__slots__: its four streams, byte counters, flow settings, bandwidth
+shapers, the idle reaper's bookkeeping and its state. The code that moves
+tunnels between states is shared; an open tunnel holds no closures, no
+relay wrapper task and no gather future. The asyncio engine pumps
+target -> client in the client handler's own task and client -> target
+in one extra task:
+
+    OPEN -- one way ends with a clean EOF (passed on as half-close) --> HALF_CLOSED
+    OPEN -- one way fails, reaped or cancelled ------------------------> CLOSED
+    HALF_CLOSED -- the other way ends, or half_close seconds pass -----> CLOSED
+
+The socket-level engines (relay_engine.py) also run in the handler task;
+their Tunnel only carries the counters and the reaper's fields. The idle
+reaper cancels the handler task, like it does for forwarded HTTP.
+
+Account records (the account_by_port values) are read-only mappings built
+once per account and config load and shared by every tunnel of the
+account, instead of mutable dicts.
+"""
+import asyncio
+import logging
+import types
+
+import flow_control
+import relay_engine
+import timeouts
+
+logger = logging.getLogger(__name__)
+
+OPEN = "open"
+HALF_CLOSED = "half_closed"
+CLOSED = "closed"
+
+_DIRECTIONS = {"bytes_up": "Client->Target", "bytes_down": "Target->Client"}
+
+
+def account_record(email, acc_config, **fields):
+    """Read-only account_by_port value: the account's config plus email and ports"""
+    return types.MappingProxyType({"email": email, **fields, **acc_config})
+
+
+class Tunnel(timeouts.TrackedTunnel):
+    """One relaying tunnel; create it in the client handler task that relays it"""
+    __slots__ = ("state", "client_reader", "client_writer", "target_reader", "target_writer", "settings",
+                 "half_close", "upstream", "timer", "shapers")
+
+    def __init__(self, client_reader, client_writer, target_reader, target_writer, stats, limits, settings,
+                 shapers=(None, None)):
+        super().__init__(stats, asyncio.current_task(), limits.relay_idle)
+        self.state = OPEN
+        self.client_reader = client_reader
+        self.client_writer = client_writer
+        self.target_reader = target_reader
+        self.target_writer = target_writer
+        self.settings = settings          # flow_control.FlowSettings, shared per account
+        self.half_close = limits.half_close
+        self.upstream = None              # task pumping client -> target
+        self.timer = None                 # half_close deadline
+        self.shapers = shapers            # (up, down) bandwidth.Shaper, shared per account and upstream
+
+    def __repr__(self):
+        return f"Tunnel({self.state}, {self.stats!r})"
+
+    def buffered(self):
+        """Bytes queued in both sides' write buffers (flow_control's tunnel limit)"""
+        return (self.client_writer.transport.get_write_buffer_size()
+                + self.target_writer.transport.get_write_buffer_size())
+
+    def ended(self, clean):
+        """One direction finished; clean if its EOF was passed on as a half-close"""
+        if clean and self.state == OPEN:
+            self.state = HALF_CLOSED
+            if self.half_close:
+                self.timer = asyncio.get_running_loop().call_later(self.half_close, self.close)
+        else:
+            self.close()
+
+    def close(self):
+        if self.state == CLOSED:
+            return
+        self.state = CLOSED
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.upstream is not None and self.upstream is not asyncio.current_task():
+            self.upstream.cancel()
+        self.client_writer.close()
+        self.target_writer.close()
+
+    async def run(self, engine, relay_settings):
+        """Relay until the tunnel is CLOSED; engine is a relay_engine.ENGINE_*"""
+        if engine != relay_engine.ENGINE_ASYNCIO:
+            if await relay_engine.handover(engine, self.client_reader, self.client_writer,
+                                           self.target_reader, self.target_writer, relay_settings,
+                                           self.settings, self.stats, self.shapers) is not None:
+                self.state = CLOSED
+                return
+            self.stats.engine = relay_engine.ENGINE_ASYNCIO
+
+        up, down = self.shapers
+        self.upstream = asyncio.create_task(_pump(self, self.client_reader, self.target_writer, "bytes_up", up))
+        try:
+            await _pump(self, self.target_reader, self.client_writer, "bytes_down", down)
+            if not self.upstream.done():
+                await asyncio.wait((self.upstream,))
+        finally:
+            self.close()
+            if not self.upstream.done():
+                await asyncio.wait((self.upstream,))
+
+
+async def _pump(tunnel, reader, writer, attr, shaper):
+    """Copy one direction of a tunnel and report how it ended"""
+    clean = False
+    try:
+        await flow_control.pump(reader, writer, tunnel.stats, attr, tunnel, shaper)
+        if writer.can_write_eof():
+            # Half-close: pass the EOF on and keep the other direction open
+            writer.write_eof()
+            clean = True
+    except Exception as e:
+        logger.debug(f"{_DIRECTIONS[attr]} relay ended: {e}")
+    tunnel.ended(clean)
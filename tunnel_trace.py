@@ -0,0 +1,301 @@
+"""Per-tunnel timelines, kept in memory and exported as JSON lines or spans.
+
+Every tunnel gets a Timeline: monotonic offsets (seconds since the client
+connection was accepted) of the points it passed, plus its byte counts.
+
+    accepted         client connection accepted
+    greeting         SOCKS5 method selection sent (socks5 only)
+    request          CONNECT request read (HTTP head / SOCKS5 request)
+    admitted         admission control let it through
+    tor_pooled       took a pre-negotiated connection from the Tor pool,
+    tor_connected    or connected to the Tor SOCKS port (pipelined handshake),
+    tor_negotiated   or connected and negotiated the method (unpipelined)
+    tor_reply        Tor's CONNECT reply arrived
+    direct_connected connected to the target (type: direct)
+    replied          success reply sent to the client (http_forward: first
+                     response head)
+    first_byte_up    first byte client -> target
+    first_byte_down  first byte target -> client
+
+Finished timelines go into a ring buffer of the last `buffer` tunnels,
+sampled at `sample_rate`. Slow ones (success reply later than `slow_after`
+seconds after accept, or the target's first byte more than
+`slow_first_byte` seconds after the client's) go into a second ring of
+`slow_buffer` whatever the sample rate, so outliers survive sampling.
+Timelines of failed tunnels end at the failing stage.
+
+Config (optional, top level of config.json):
+
+    "tracing": {"enabled": true, "sample_rate": 0.1, "buffer": 1000,
+                "slow_after": 3.0, "slow_first_byte": 10.0, "slow_buffer": 200}
+
+The metrics listener serves the buffers: GET /traces as JSON lines (one
+tunnel per line), GET /traces?format=otlp as OTLP/JSON (one span per
+tunnel with a child span per stage, for an OpenTelemetry collector's
+otlpjsonfile receiver or any OTLP/HTTP endpoint), add &slow=1 for the
+outliers only. With "enabled": false the proxies skip timelines entirely.
+"""
+import collections
+import json
+import random
+import time
+
+import relay_engine
+
+DEFAULT_SAMPLE_RATE = 0.1
+DEFAULT_BUFFER = 1000
+DEFAULT_SLOW_AFTER = 3.0
+DEFAULT_SLOW_FIRST_BYTE = 10.0
+DEFAULT_SLOW_BUFFER = 200
+
+SERVICE_NAME = "swiss_proxy"
+# OTLP span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_OK = 1
+STATUS_ERROR = 2
+OK_OUTCOMES = ("ok", "reaped", "cancelled")
+
+
+class Timeline:
+    """One tunnel's stage offsets and byte counts"""
+    __slots__ = ("kind", "account", "target", "upstream", "accepted_at", "started", "marks", "outcome",
+                 "duration", "engine", "bytes_up", "bytes_down", "slow", "trace_id")
+
+    def __init__(self, kind, account_config, accepted_at=None):
+        now = time.monotonic()
+        self.kind = kind
+        self.account = account_config["email"]
+        self.target = None
+        self.upstream = None
+        self.accepted_at = accepted_at if accepted_at is not None else now
+        self.started = time.time() - (now - self.accepted_at)   # wall clock at accept
+        self.marks = {}
+        self.outcome = None
+        self.duration = None
+        self.engine = None
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.slow = False
+        self.trace_id = None
+
+    def __repr__(self):
+        return f"Timeline({self.kind} {self.target}, {len(self.marks)} marks)"
+
+    def mark(self, stage):
+        self.marks[stage] = time.monotonic() - self.accepted_at
+
+    def finish(self, outcome, stats=None):
+        """Close the timeline and keep it if sampled or slow; only the first call counts"""
+        if self.outcome is not None:
+            return
+        self.duration = time.monotonic() - self.accepted_at
+        self.outcome = outcome
+        if stats is not None:
+            self.engine = stats.engine
+            self.bytes_up = stats.bytes_up
+            self.bytes_down = stats.bytes_down
+        _tracer.keep(self)
+
+    def is_slow(self, slow_after, slow_first_byte):
+        # Failed or rejected tunnels never replied; how long they lasted says nothing
+        replied = self.marks.get("replied")
+        if replied is not None and replied >= slow_after:
+            return True
+        up, down = self.marks.get("first_byte_up"), self.marks.get("first_byte_down")
+        return up is not None and down is not None and down - up >= slow_first_byte
+
+    def to_dict(self):
+        return {
+            "trace_id": f"{self.trace_id:032x}",
+            "ts": round(self.started, 6),
+            "kind": self.kind,
+            "account": self.account,
+            "target": self.target,
+            "upstream": self.upstream,
+            "outcome": self.outcome,
+            "slow": self.slow,
+            "duration": round(self.duration, 6),
+            "engine": self.engine,
+            "bytes_up": self.bytes_up,
+            "bytes_down": self.bytes_down,
+            "marks": {stage: round(offset, 6) for stage, offset in self.marks.items()},
+        }
+
+    def to_spans(self):
+        """OTLP/JSON spans: the tunnel, and one child per stage since the previous mark"""
+        trace_id = f"{self.trace_id:032x}"
+        root_id = f"{self.trace_id & (2 ** 64 - 1):016x}"
+
+        def nanos(offset):
+            return str(int((self.started + offset) * 1e9))
+
+        attributes = [_attribute("proxy.kind", self.kind), _attribute("proxy.account", self.account),
+                      _attribute("proxy.outcome", self.outcome),
+                      _attribute("net.bytes_up", self.bytes_up), _attribute("net.bytes_down", self.bytes_down)]
+        for key, value in (("proxy.target", self.target), ("proxy.upstream", self.upstream),
+                           ("proxy.engine", self.engine)):
+            if value is not None:
+                attributes.append(_attribute(key, value))
+        spans = [{
+            "traceId": trace_id,
+            "spanId": root_id,
+            "name": f"{self.kind} tunnel",
+            "kind": SPAN_KIND_SERVER,
+            "startTimeUnixNano": nanos(0.0),
+            "endTimeUnixNano": nanos(self.duration),
+            "attributes": attributes,
+            "status": {"code": STATUS_OK} if self.outcome in OK_OUTCOMES
+            else {"code": STATUS_ERROR, "message": self.outcome},
+        }]
+        previous = 0.0
+        for index, (stage, offset) in enumerate(sorted(self.marks.items(), key=lambda item: item[1]), 1):
+            spans.append({
+                "traceId": trace_id,
+                "spanId": f"{(self.trace_id + index) & (2 ** 64 - 1):016x}",
+                "parentSpanId": root_id,
+                "name": stage,
+                "kind": SPAN_KIND_INTERNAL,
+                "startTimeUnixNano": nanos(previous),
+                "endTimeUnixNano": nanos(offset),
+            })
+            previous = offset
+        return spans
+
+
+def _attribute(key, value):
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class TracedRelayStats(relay_engine.RelayStats):
+    """RelayStats that marks the first byte of each direction on its timeline.
+
+    Every relay engine updates the counters by assignment, so the
+    properties catch the first byte whichever engine moves it.
+    """
+    __slots__ = ("timeline", "_up", "_down")
+
+    def __init__(self, engine, timeline):
+        self.timeline = timeline
+        self._up = 0
+        self._down = 0
+        super().__init__(engine)
+
+    def _set_up(self, value):
+        if value and not self._up:
+            self.timeline.mark("first_byte_up")
+        self._up = value
+
+    def _set_down(self, value):
+        if value and not self._down:
+            self.timeline.mark("first_byte_down")
+        self._down = value
+
+    bytes_up = property(lambda self: self._up, _set_up)
+    bytes_down = property(lambda self: self._down, _set_down)
+
+
+def relay_stats(engine, timeline=None):
+    """The RelayStats for a tunnel, traced if it has a timeline"""
+    if timeline is None:
+        return relay_engine.RelayStats(engine)
+    return TracedRelayStats(engine, timeline)
+
+
+class Tracer:
+    """Ring buffers of finished timelines"""
+
+    def __init__(self):
+        self.sample_rate = DEFAULT_SAMPLE_RATE
+        self.slow_after = DEFAULT_SLOW_AFTER
+        self.slow_first_byte = DEFAULT_SLOW_FIRST_BYTE
+        self.recent = collections.deque(maxlen=DEFAULT_BUFFER)
+        self.slow = collections.deque(maxlen=DEFAULT_SLOW_BUFFER)
+        self.finished = 0
+        self.kept_slow = 0
+        self.sampled_out = 0
+
+    def __repr__(self):
+        return f"Tracer(sample_rate={self.sample_rate}, {len(self.recent)} recent, {len(self.slow)} slow)"
+
+    def configure(self, settings):
+        self.sample_rate = settings.get("sample_rate", DEFAULT_SAMPLE_RATE)
+        self.slow_after = settings.get("slow_after", DEFAULT_SLOW_AFTER)
+        self.slow_first_byte = settings.get("slow_first_byte", DEFAULT_SLOW_FIRST_BYTE)
+        buffer = settings.get("buffer", DEFAULT_BUFFER)
+        if buffer != self.recent.maxlen:
+            self.recent = collections.deque(self.recent, maxlen=buffer)
+        slow_buffer = settings.get("slow_buffer", DEFAULT_SLOW_BUFFER)
+        if slow_buffer != self.slow.maxlen:
+            self.slow = collections.deque(self.slow, maxlen=slow_buffer)
+
+    def keep(self, timeline):
+        self.finished += 1
+        if timeline.is_slow(self.slow_after, self.slow_first_byte):
+            timeline.slow = True
+            self.kept_slow += 1
+            ring = self.slow
+        elif self.sample_rate >= 1.0 or random.random() < self.sample_rate:
+            ring = self.recent
+        else:
+            self.sampled_out += 1
+            return
+        timeline.trace_id = random.getrandbits(128)
+        ring.append(timeline)
+
+    def timelines(self, slow_only=False):
+        kept = list(self.slow) if slow_only else list(self.recent) + list(self.slow)
+        kept.sort(key=lambda timeline: timeline.started)
+        return kept
+
+    def stats(self):
+        return {
+            "finished": self.finished,
+            "slow": self.kept_slow,
+            "sampled_out": self.sampled_out,
+            "buffered": len(self.recent) + len(self.slow),
+        }
+
+
+_tracer = Tracer()
+# Checked by the proxies before creating a timeline
+enabled = True
+
+
+def configure(config):
+    """Apply the config's "tracing" section (also on reload)"""
+    global enabled
+    settings = config.get("tracing", {})
+    enabled = bool(settings.get("enabled", True))
+    _tracer.configure(settings)
+
+
+def begin(kind, account_config, accepted_at=None):
+    """A new Timeline, or None with tracing off"""
+    if not enabled:
+        return None
+    timeline = Timeline(kind, account_config, accepted_at)
+    timeline.marks["accepted"] = 0.0
+    return timeline
+
+
+def export_jsonl(slow_only=False):
+    """Buffered timelines as JSON lines, oldest first"""
+    return "".join(json.dumps(timeline.to_dict()) + "\n" for timeline in _tracer.timelines(slow_only))
+
+
+def export_otlp(slow_only=False):
+    """Buffered timelines as an OTLP/JSON ExportTraceServiceRequest"""
+    spans = []
+    for timeline in _tracer.timelines(slow_only):
+        spans.extend(timeline.to_spans())
+    return {"resourceSpans": [{
+        "resource": {"attributes": [_attribute("service.name", SERVICE_NAME)]},
+        "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+    }]}
+
+
+def trace_stats():
+    return _tracer.stats()
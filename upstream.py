@@ -0,0 +1,238 @@
+"""Upstream layer shared by the proxy front ends.
+
+open_tunnel() connects to a destination through an account's upstream
+(`type: tor` via the Tor SOCKS port, or `type: direct`) and returns an
+asyncio stream pair ready for relaying. Failures are raised as
+UpstreamError carrying the SOCKS5 reply code to send to the client.
+
+Tor connections come from the warm pool (tor_pool.py) when possible. A
+pooled connection that Tor closed while it sat idle (no reply byte at
+all) is replaced by a fresh one once. On a pool miss the greeting and
+CONNECT are pipelined in a single write and both replies are read back
+together, unless the upstream sets "pipelined": false. A tor upstream
+with an "endpoints" list spreads its connections over several tor
+daemons (tor_balancer.py) and retries a connection refused by one
+endpoint on another.
+
+Direct connections resolve through the shared DNS cache and connect with
+Happy Eyeballs (dns_cache.py).
+"""
+import asyncio
+import functools
+import logging
+import time
+
+import dns_cache
+import socks5
+import tor_balancer
+import tor_pool
+from socks5 import ATYP_DOMAIN, REP_CONNECTION_REFUSED, REP_TTL_EXPIRED, Socks5Error
+
+logger = logging.getLogger(__name__)
+
+# Failures that say the Tor SOCKS port itself is unusable
+ENDPOINT_FAILURE_STAGES = ("tor_connect", "tor_auth")
+MAX_ENDPOINT_ATTEMPTS = 2
+
+
+class UpstreamError(Exception):
+    """Connecting through the upstream failed.
+
+    rep is the SOCKS5 reply code for the client, stage names the step that
+    failed, reply_code is Tor's own SOCKS reply code if it sent one.
+    """
+
+    def __init__(self, message, stage, rep=REP_CONNECTION_REFUSED, reply_code=None):
+        super().__init__(message)
+        self.stage = stage
+        self.rep = rep
+        self.reply_code = reply_code
+
+
+def _check_reply(reply, host, port, atyp):
+    # Reply: VER(1) REP(1) RSV(1) ATYP(1) + bind addr + port
+    if reply[1] != socks5.REP_SUCCESS:
+        raise UpstreamError(
+            f"Tor SOCKS connection failed (code={reply[1]}) for {host}:{port} atyp={atyp}",
+            "tor_reply", reply_code=reply[1])
+
+
+async def _connect_on_negotiated(reader, writer, request, host, port, atyp):
+    """Send CONNECT on a connection that already finished method negotiation"""
+    writer.write(request)
+    await writer.drain()
+    reply = await socks5.read_frame(reader, socks5.reply_length)
+    _check_reply(reply, host, port, atyp)
+
+
+async def _connect_pipelined(reader, writer, request, host, port, atyp):
+    """Send greeting + CONNECT in one write and read both replies"""
+    writer.write(socks5.GREETING_NO_AUTH + request)
+    await writer.drain()
+    try:
+        replies = await socks5.read_frame(reader, socks5.method_and_reply_length)
+    except Socks5Error as e:
+        raise UpstreamError(f"Tor SOCKS authentication failed: {e}", "tor_auth")
+    _check_reply(replies[2:], host, port, atyp)
+
+
+def _died_idle(e):
+    """True if a pooled connection failed before Tor replied at all (closed while idle)"""
+    return isinstance(e, ConnectionError) or (isinstance(e, asyncio.IncompleteReadError) and not e.partial)
+
+
+async def _handshake(reader, writer, handshake, request, host, port, atyp):
+    try:
+        await handshake(reader, writer, request, host, port, atyp)
+    except BaseException:
+        writer.close()
+        raise
+
+
+async def _open_via_pool(upstream, pool, request, host, port, atyp, trace=None):
+    conn = pool.take()
+    if conn is not None:
+        if trace is not None:
+            trace.mark("tor_pooled")
+        try:
+            await _handshake(*conn, _connect_on_negotiated, request, host, port, atyp)
+            if trace is not None:
+                trace.mark("tor_reply")
+            return conn
+        except UpstreamError:
+            raise
+        except Exception as e:
+            if not _died_idle(e):
+                raise UpstreamError(f"Tor SOCKS reply for {host}:{port} failed: {e}", "tor_reply")
+            # Tor may close a warm connection at any time; that's not the client's problem
+            pool.evictions += 1
+            logger.debug(f"Pooled Tor connection for {host}:{port} was closed ({e!r}), retrying on a fresh one")
+
+    try:
+        if upstream.get("pipelined", True):
+            reader, writer = await asyncio.open_connection(pool.host, pool.port)
+            handshake = _connect_pipelined
+            stage = "tor_connected"
+        else:
+            reader, writer = await tor_pool.open_negotiated(pool.host, pool.port)
+            handshake = _connect_on_negotiated
+            stage = "tor_negotiated"
+    except tor_pool.SocksNegotiationError as e:
+        raise UpstreamError(f"Tor SOCKS authentication failed: {e}", "tor_auth")
+    except Exception as e:
+        raise UpstreamError(f"Failed to connect to Tor: {e}", "tor_connect")
+    if trace is not None:
+        trace.mark(stage)
+
+    try:
+        await _handshake(reader, writer, handshake, request, host, port, atyp)
+    except UpstreamError:
+        raise
+    except Exception as e:
+        raise UpstreamError(f"Tor SOCKS reply for {host}:{port} failed: {e}", "tor_reply")
+    if trace is not None:
+        trace.mark("tor_reply")
+    return reader, writer
+
+
+def _release_endpoint(balancer, endpoint, _owner):
+    balancer.release(endpoint)
+
+
+_closing = set()   # tasks waiting for a tunnel's writer to close
+
+
+async def _release_when_closed(balancer, endpoint, writer):
+    try:
+        await writer.wait_closed()
+    except Exception:
+        pass  # closed with an error is closed all the same
+    finally:
+        balancer.release(endpoint)
+
+
+async def _open_balanced(upstream, request, host, port, atyp, owner, trace=None):
+    balancer = tor_balancer.get_balancer(upstream)
+    tried = []
+    while True:
+        endpoint = balancer.pick(tried)
+        tried.append(endpoint)
+        pool = tor_pool.get_pool(upstream, (endpoint.host, endpoint.port))
+        balancer.acquire(endpoint)
+        started = time.monotonic()
+        try:
+            reader, writer = await _open_via_pool(upstream, pool, request, host, port, atyp, trace)
+        except UpstreamError as e:
+            balancer.release(endpoint)
+            if e.stage not in ENDPOINT_FAILURE_STAGES:
+                raise
+            balancer.failure(endpoint)
+            if len(tried) >= min(MAX_ENDPOINT_ATTEMPTS, len(balancer.endpoints)):
+                raise
+            logger.warning(f"Tor endpoint {endpoint.host}:{endpoint.port}: {e}, trying another")
+            continue
+        except BaseException:
+            balancer.release(endpoint)
+            raise
+        balancer.success(endpoint, time.monotonic() - started)
+        if owner is not None:
+            # The tunnel stays outstanding until the handler that opened it finishes
+            owner.add_done_callback(functools.partial(_release_endpoint, balancer, endpoint))
+        else:
+            # ...or, for connections that outlive it, until the writer closes
+            task = asyncio.create_task(_release_when_closed(balancer, endpoint, writer))
+            _closing.add(task)
+            task.add_done_callback(_closing.discard)
+        return reader, writer
+
+
+async def open_tor_tunnel(upstream, host, port, atyp, owner=None, trace=None):
+    """owner is the task the tunnel lives in (used to count open tunnels per endpoint;
+    None counts it until its writer closes), trace its tunnel_trace.Timeline"""
+    try:
+        request = socks5.build_connect_request(host, port, atyp)
+    except Socks5Error as e:
+        raise UpstreamError(str(e), "request", rep=e.rep)
+
+    if "endpoints" in upstream:
+        return await _open_balanced(upstream, request, host, port, atyp, owner, trace)
+    return await _open_via_pool(upstream, tor_pool.get_pool(upstream), request, host, port, atyp, trace)
+
+
+async def open_direct_tunnel(upstream, host, port, trace=None):
+    try:
+        reader, writer = await dns_cache.open_connection(
+            host, port,
+            connect_timeout=upstream.get("connect_timeout", dns_cache.DEFAULT_CONNECT_TIMEOUT),
+            happy_eyeballs_delay=upstream.get("happy_eyeballs_delay",
+                                              dns_cache.DEFAULT_HAPPY_EYEBALLS_DELAY))
+    except Exception as e:
+        raise UpstreamError(f"Failed to connect to {host}:{port}: {e}", "direct_connect")
+    if trace is not None:
+        trace.mark("direct_connected")
+    return reader, writer
+
+
+async def open_tunnel(upstream, host, port, atyp=ATYP_DOMAIN, timeout=None, trace=None, until_closed=False):
+    """Connect to host:port through the upstream and return (reader, writer).
+
+    timeout bounds the whole connect, including Tor's CONNECT reply. trace
+    (a tunnel_trace.Timeline) gets the upstream stages marked. A balanced
+    Tor endpoint counts the tunnel as open until the calling task ends,
+    or with until_closed (connections that outlive it, e.g. pooled ones)
+    until the writer closes. Relays that detach the socket from the
+    streams need the former.
+    """
+    if upstream["type"] == "tor":
+        # Taken here because wait_for() runs the connect in a task of its own
+        owner = None if until_closed else asyncio.current_task()
+        opening = open_tor_tunnel(upstream, host, port, atyp, owner=owner, trace=trace)
+    else:
+        opening = open_direct_tunnel(upstream, host, port, trace)
+    if timeout is None:
+        return await opening
+    try:
+        return await asyncio.wait_for(opening, timeout)
+    except asyncio.TimeoutError:
+        raise UpstreamError(f"Connecting to {host}:{port} timed out after {timeout:g}s",
+                            "upstream_timeout", rep=REP_TTL_EXPIRED)
@@ -0,0 +1,254 @@
+"""Background health probing of upstreams and failover routing.
+
+Every `interval` seconds each upstream in the config (every account's
+upstream and fallback_upstreams) is probed with a real CONNECT to a probe
+target through it, the same handshake a client connection goes through.
+Without a "health" section only accounts with fallback_upstreams are
+probed, so a proxy that has nothing to fail over to makes no outbound
+connections of its own.
+A rolling window of results gives each upstream a status:
+
+- unknown: not probed yet (treated like up),
+- down: the last fail_after probes failed,
+- slow: the median latency of successful probes in the window is above
+  slow_after seconds,
+- up: otherwise.
+
+Accounts can list fallback upstreams in priority order:
+
+    "upstream": {"type": "tor", "name": "Tor", ...},
+    "fallback_upstreams": [{"type": "tor", "name": "Tor 2", ...},
+                           {"type": "direct", "name": "Direct"}]
+
+New connections use the first upstream that is up (or unknown), else
+the first slow one, else the primary. Tunnels already open are not moved.
+Upstreams are identified by name, so names must be unique.
+
+Config (optional, top level of config.json; interval 0 disables probing
+and failover, also on reload):
+
+    "health": {"interval": 60, "timeout": 10, "target": "check.torproject.org:443",
+               "window": 20, "fail_after": 3, "slow_after": 5}
+
+Results are served as JSON on GET /health of the metrics listener and as
+swiss_proxy_upstream_* metrics.
+"""
+import asyncio
+import collections
+import logging
+import statistics
+import time
+
+from upstream import UpstreamError, open_tunnel
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 60.0
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_TARGET = "check.torproject.org:443"
+DEFAULT_WINDOW = 20
+DEFAULT_FAIL_AFTER = 3
+DEFAULT_SLOW_AFTER = 5.0
+
+STATUS_UNKNOWN = "unknown"
+STATUS_UP = "up"
+STATUS_SLOW = "slow"
+STATUS_DOWN = "down"
+# Preference when routing, best first
+_STATUS_RANK = {STATUS_UP: 0, STATUS_UNKNOWN: 0, STATUS_SLOW: 1, STATUS_DOWN: 2}
+
+
+def upstreams_of(account_config):
+    """Primary upstream followed by the fallbacks, in priority order"""
+    return [account_config["upstream"]] + list(account_config.get("fallback_upstreams", ()))
+
+
+class UpstreamHealth:
+    """Rolling probe results for one upstream"""
+
+    def __init__(self, upstream, window=DEFAULT_WINDOW):
+        self.upstream = upstream
+        self.results = collections.deque(maxlen=window)   # (ok, latency)
+        self.consecutive_failures = 0
+        self.probes = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_probe = None    # wall clock time of the last probe
+
+    def __repr__(self):
+        return f"UpstreamHealth({self.upstream['name']}, {self.status()})"
+
+    def record(self, ok, latency, error=None):
+        self.results.append((ok, latency))
+        self.probes += 1
+        self.last_probe = time.time()
+        if ok:
+            self.consecutive_failures = 0
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = error
+
+    def median_latency(self):
+        latencies = [latency for ok, latency in self.results if ok]
+        return statistics.median(latencies) if latencies else None
+
+    def success_rate(self):
+        if not self.results:
+            return None
+        return sum(1 for ok, _ in self.results if ok) / len(self.results)
+
+    def status(self, fail_after=DEFAULT_FAIL_AFTER, slow_after=DEFAULT_SLOW_AFTER):
+        if not self.results:
+            return STATUS_UNKNOWN
+        if self.consecutive_failures >= fail_after:
+            return STATUS_DOWN
+        latency = self.median_latency()
+        if latency is not None and latency > slow_after:
+            return STATUS_SLOW
+        return STATUS_UP
+
+    def stats(self, fail_after=DEFAULT_FAIL_AFTER, slow_after=DEFAULT_SLOW_AFTER):
+        latency = self.median_latency()
+        rate = self.success_rate()
+        return {
+            "status": self.status(fail_after, slow_after),
+            "type": self.upstream["type"],
+            "median_latency": round(latency, 4) if latency is not None else None,
+            "success_rate": round(rate, 3) if rate is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "probes": self.probes,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_probe": self.last_probe,
+        }
+
+
+class HealthProber:
+    """Probes every configured upstream in the background"""
+
+    def __init__(self):
+        self.interval = DEFAULT_INTERVAL
+        self.timeout = DEFAULT_TIMEOUT
+        self.target = DEFAULT_TARGET
+        self.window = DEFAULT_WINDOW
+        self.fail_after = DEFAULT_FAIL_AFTER
+        self.slow_after = DEFAULT_SLOW_AFTER
+        self.upstreams = {}       # name -> UpstreamHealth
+        self._task = None
+        self._started = False     # start() was called; reloads may turn probing on and off
+
+    def __repr__(self):
+        return f"HealthProber({len(self.upstreams)} upstreams, every {self.interval:g}s)"
+
+    def configure(self, config):
+        settings = config.get("health", {})
+        self.interval = settings.get("interval", DEFAULT_INTERVAL)
+        self.timeout = settings.get("timeout", DEFAULT_TIMEOUT)
+        self.target = settings.get("target", DEFAULT_TARGET)
+        self.fail_after = settings.get("fail_after", DEFAULT_FAIL_AFTER)
+        self.slow_after = settings.get("slow_after", DEFAULT_SLOW_AFTER)
+        window = settings.get("window", DEFAULT_WINDOW)
+
+        upstreams = {}
+        for account_config in config.get("accounts", {}).values():
+            if "health" not in config and not account_config.get("fallback_upstreams"):
+                continue
+            for upstream in upstreams_of(account_config):
+                upstreams.setdefault(upstream["name"], upstream)
+        current = {}
+        for name, upstream in upstreams.items():
+            health = self.upstreams.get(name)
+            # Changed settings or window size start the upstream's history over
+            if health is None or health.upstream != upstream or window != self.window:
+                health = UpstreamHealth(upstream, window)
+            current[name] = health
+        self.window = window
+        self.upstreams = current
+        if self._started:
+            if self.interval <= 0 or not self.upstreams:
+                self.stop()
+            else:
+                self.start()
+
+    def start(self):
+        """Start probing (needs a running loop); no-op if disabled or running"""
+        self._started = True
+        if self.interval <= 0 or not self.upstreams or (self._task is not None and not self._task.done()):
+            return
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def status(self, upstream):
+        health = self.upstreams.get(upstream["name"])
+        if health is None:
+            return STATUS_UNKNOWN
+        return health.status(self.fail_after, self.slow_after)
+
+    def route(self, account_config):
+        """Upstream new connections of an account should use"""
+        candidates = upstreams_of(account_config)
+        if len(candidates) == 1 or self.interval <= 0:
+            return candidates[0]
+        # min() keeps the first of equally ranked upstreams, i.e. priority order
+        return min(candidates, key=lambda upstream: _STATUS_RANK[self.status(upstream)])
+
+    def stats(self):
+        return {name: health.stats(self.fail_after, self.slow_after)
+                for name, health in self.upstreams.items()}
+
+    async def probe(self, health):
+        host, _, port = self.target.rpartition(":")
+        started = time.monotonic()
+        try:
+            _, writer = await open_tunnel(health.upstream, host, int(port), timeout=self.timeout)
+        except UpstreamError as e:
+            health.record(False, time.monotonic() - started, f"{e.stage}: {e}")
+            return
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            # Raised outside the upstream handshake (e.g. a bad target); still a failed probe
+            health.record(False, time.monotonic() - started, repr(e))
+            return
+        health.record(True, time.monotonic() - started)
+        writer.close()
+
+    async def probe_all(self):
+        before = {name: self.status(h.upstream) for name, h in self.upstreams.items()}
+        # One task per probe: open_tunnel counts a tunnel as open until its task ends
+        await asyncio.gather(*(asyncio.create_task(self.probe(h)) for h in self.upstreams.values()),
+                             return_exceptions=True)
+        for name, health in self.upstreams.items():
+            status = self.status(health.upstream)
+            if before.get(name, STATUS_UNKNOWN) != status:
+                log = logger.warning if status in (STATUS_DOWN, STATUS_SLOW) else logger.info
+                log(f"Upstream {name} is {status} ({health.stats(self.fail_after, self.slow_after)})")
+
+    async def _run(self):
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(self.interval)
+
+
+_prober = HealthProber()
+
+
+def configure(config):
+    """Apply the config's "health" section and upstream list (also on reload)"""
+    _prober.configure(config)
+
+
+def start():
+    _prober.start()
+
+
+def route(account_config):
+    return _prober.route(account_config)
+
+
+def health_stats():
+    """{upstream name: {...}} for the health endpoint"""
+    return _prober.stats()
@@ -0,0 +1,358 @@
+"""Multi-process worker mode (--workers N) for the proxies.
+
+The proxy binds every per-account port with SO_REUSEPORT while allocating
+ports, and the parent binds each further worker slot onto it, so the
+kernel spreads accepted connections across the workers' listening
+sockets. Each worker is a forked process running its own event loop on
+its slot's sockets. The parent keeps the sockets open, restarts workers
+that die (connections queued meanwhile wait in the slot's backlog; a
+worker that keeps dying right after start is restarted after a growing
+delay), forwards SIGTERM/SIGINT and collects per-worker stats that the
+workers report over a pipe.
+
+On SIGHUP (or a config.json change with --watch-config) the parent reloads
+the config itself, so restarted workers fork with it, closes the sockets
+of removed accounts and forwards SIGHUP to every worker.
+
+The parent also serves listener handoffs (graceful.py): a new parent
+started with --takeover gets every slot's sockets, and this one then
+stops its workers. Workers drain their open tunnels on SIGTERM, so the
+parent waits --drain-timeout (plus SHUTDOWN_TIMEOUT) before killing them.
+"""
+import asyncio
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import time
+
+import config_reload
+import graceful
+import port_map
+import proxy_log
+
+logger = logging.getLogger(__name__)
+
+STATS_INTERVAL = 10.0
+RESTART_BACKOFF_MAX = 30.0
+SHUTDOWN_TIMEOUT = 10.0
+
+
+def reuseport_supported():
+    return hasattr(socket, "SO_REUSEPORT")
+
+
+def require_reuseport():
+    if not reuseport_supported():
+        raise RuntimeError("SO_REUSEPORT is not available on this platform")
+
+
+def bind_reuseport(port, host="0.0.0.0", backlog=100):
+    """Bind a listening socket that can share its port with the other workers"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class Worker:
+    __slots__ = ("slot", "sockets", "pid", "stats_fd", "stats_buf", "stats", "restarts", "started_at",
+                 "restart_at")
+
+    def __init__(self, slot, sockets):
+        self.slot = slot
+        self.sockets = sockets      # port -> listening socket
+        self.pid = None
+        self.stats_fd = None
+        self.stats_buf = b""
+        self.stats = {}
+        self.restarts = 0
+        self.started_at = 0.0
+        self.restart_at = None      # monotonic time of a pending restart
+
+
+async def _report_stats(proxy, stats_fd, interval):
+    while True:
+        await asyncio.sleep(interval)
+        line = json.dumps(proxy.worker_stats()).encode() + b"\n"
+        try:
+            os.write(stats_fd, line)
+        except BlockingIOError:
+            pass  # parent is behind; drop this sample
+
+
+async def _worker_main(proxy, sockets, stats_fd, interval):
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    # SIGTERM drains instead (graceful.install() in start_servers)
+    loop.add_signal_handler(signal.SIGINT, main_task.cancel)
+    reporter = asyncio.create_task(_report_stats(proxy, stats_fd, interval))
+    try:
+        await proxy.start_servers(sockets=sockets)
+    finally:
+        reporter.cancel()
+
+
+def _run_worker(proxy, worker, all_workers, stats_w, interval):
+    """Body of a forked worker process; never returns"""
+    code = 0
+    try:
+        os.set_blocking(stats_w, False)
+        for other in all_workers:
+            if other is not worker:
+                for sock in other.sockets.values():
+                    sock.close()
+            if other.stats_fd is not None:
+                os.close(other.stats_fd)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # Until the worker's loop installs its reload handler
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        proxy.worker_slot = worker.slot
+        logger.info(f"Worker {worker.slot} started (PID {os.getpid()})")
+        asyncio.run(_worker_main(proxy, worker.sockets, stats_w, interval))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    except Exception as e:
+        logger.error(f"Worker {worker.slot} crashed: {e}", exc_info=True)
+        code = 1
+    finally:
+        # os._exit() skips atexit, so flush the log writer thread here
+        proxy_log.stop()
+        logging.shutdown()
+        os._exit(code)
+
+
+def _spawn(proxy, worker, all_workers, interval):
+    stats_r, stats_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(stats_r)
+        _run_worker(proxy, worker, all_workers, stats_w, interval)
+    os.close(stats_w)
+    os.set_blocking(stats_r, False)
+    worker.pid = pid
+    worker.stats_fd = stats_r
+    worker.stats_buf = b""
+    worker.started_at = time.monotonic()
+
+
+def _read_stats(worker):
+    try:
+        data = os.read(worker.stats_fd, 65536)
+    except BlockingIOError:
+        return
+    if not data:
+        return
+    lines = (worker.stats_buf + data).split(b"\n")
+    worker.stats_buf = lines.pop()
+    for line in lines:
+        try:
+            worker.stats = json.loads(line)
+        except ValueError:
+            pass
+
+
+def aggregate_stats(workers):
+    """Sum numeric per-worker counters"""
+    total = {}
+    for worker in workers:
+        for key, value in worker.stats.items():
+            if key != "pid" and isinstance(value, (int, float)):
+                total[key] = total.get(key, 0) + value
+    return total
+
+
+def _reload(proxy, slots):
+    """Reload the config in the parent and tell the workers to do the same"""
+    if config_reload.reload_from_file(proxy, listeners=False) is False:
+        return
+    for worker in slots:
+        for port in [p for p in worker.sockets if p not in proxy.account_by_port]:
+            worker.sockets.pop(port).close()
+        if worker.pid is not None:
+            try:
+                os.kill(worker.pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+
+def _slot_sockets(proxy, slot, handoff):
+    """port -> listening socket for a worker slot, from a takeover where possible"""
+    sockets = {}
+    for port, entry in proxy.account_by_port.items():
+        taken = handoff.take(slot, entry["email"], entry["original_port"]) if handoff is not None else None
+        if taken is not None and taken[0] == port:
+            sockets[port] = taken[1]
+        else:
+            if taken is not None:
+                taken[1].close()
+            sockets[port] = bind_reuseport(port)
+    return sockets
+
+
+def _hand_over(proxy, handoff_sock, slots):
+    """Give a new parent every slot's sockets; True once it confirmed"""
+    conn, _ = handoff_sock.accept()
+    try:
+        conn.settimeout(graceful.HANDOFF_TIMEOUT)
+        graceful.offer(conn, graceful.account_ports(proxy), [worker.sockets for worker in slots], reuseport=True)
+        if conn.recv(len(graceful.CONFIRM)) == graceful.CONFIRM:
+            logger.info("Listeners handed over to a new parent, stopping the workers")
+            return True
+        logger.warning("Takeover was not confirmed, still serving")
+    except OSError as e:
+        logger.warning(f"Listener handoff failed: {e}")
+    finally:
+        conn.close()
+    return False
+
+
+def run_workers(proxy, workers, interval=STATS_INTERVAL, handoff=None):
+    """Bind all account ports per worker slot, fork and supervise the workers.
+
+    handoff (graceful.Handoff) holds the slot sockets of the parent being
+    taken over. Blocks until SIGTERM/SIGINT, which is forwarded to every
+    worker, or until a newer parent takes the sockets over.
+    """
+    require_reuseport()
+
+    # Slot 0 serves the listeners allocate_ports(reuseport=True) bound (or
+    # took over); the other slots join their ports
+    first = dict(proxy.sockets)
+    proxy.sockets.clear()
+    proxy.handoff = None
+    slots = []
+    for slot in range(workers):
+        if slot == 0:
+            sockets = first
+        else:
+            sockets = _slot_sockets(proxy, slot, handoff)
+        slots.append(Worker(slot, sockets))
+    if handoff is not None:
+        # Before forking, so no worker keeps a removed account's socket open
+        handoff.close_unused()
+
+    stopping = False
+    reload_requested = False
+    watcher = config_reload.ConfigWatcher(proxy.config_path) if proxy.watch_interval else None
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    def request_reload(signum, frame):
+        nonlocal reload_requested
+        reload_requested = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGHUP, request_reload)
+
+    for worker in slots:
+        _spawn(proxy, worker, slots, interval)
+    if handoff is not None:
+        handoff.confirm()
+    port_map.publish(proxy)
+    handoff_path = graceful.path_for(proxy.config_path, proxy.port_map_kind)
+    handoff_sock = graceful.bind_handoff_socket(handoff_path, replace=handoff is not None)
+    logger.info(f"Started {workers} workers on ports {sorted(proxy.account_by_port)}")
+
+    last_report = last_watch = time.monotonic()
+    while not stopping:
+        fds = [w.stats_fd for w in slots if w.stats_fd is not None]
+        if handoff_sock is not None:
+            fds.append(handoff_sock)
+        try:
+            ready, _, _ = select.select(fds, [], [], 1.0)
+        except InterruptedError:
+            ready = []
+        for worker in slots:
+            if worker.stats_fd in ready:
+                _read_stats(worker)
+        if handoff_sock is not None and handoff_sock in ready and _hand_over(proxy, handoff_sock, slots):
+            stopping = True
+
+        if watcher is not None and time.monotonic() - last_watch >= proxy.watch_interval:
+            last_watch = time.monotonic()
+            if watcher.changed():
+                logger.info(f"{proxy.config_path} changed, reloading")
+                reload_requested = True
+        if reload_requested and not stopping:
+            reload_requested = False
+            _reload(proxy, slots)
+
+        # Reap and restart crashed workers
+        while not stopping:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            worker = next((w for w in slots if w.pid == pid), None)
+            if worker is None:
+                continue
+            os.close(worker.stats_fd)
+            worker.stats_fd = None
+            worker.pid = None
+            # Back off if the worker keeps dying right after start
+            delay = 0.0
+            if time.monotonic() - worker.started_at < 5.0:
+                worker.restarts += 1
+                delay = min(2 ** worker.restarts, RESTART_BACKOFF_MAX)
+            else:
+                worker.restarts = 0
+            logger.error(f"Worker {worker.slot} (PID {pid}) exited with status {status}, "
+                         f"restarting in {delay:.0f}s")
+            worker.restart_at = time.monotonic() + delay
+        for worker in slots:
+            if not stopping and worker.restart_at is not None and time.monotonic() >= worker.restart_at:
+                worker.restart_at = None
+                _spawn(proxy, worker, slots, interval)
+
+        if time.monotonic() - last_report >= interval:
+            last_report = time.monotonic()
+            per_worker = {w.slot: w.stats for w in slots}
+            logger.info(f"Worker stats: total={aggregate_stats(slots)} per_worker={per_worker}")
+
+    logger.info("Shutting down workers...")
+    for worker in slots:
+        if worker.pid is not None:
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    # Stop accepting here too (the workers close their copies as they start draining);
+    # after a handoff the new parent holds the sockets
+    if handoff_sock is not None:
+        graceful.close_handoff_socket(handoff_sock, handoff_path)
+    for worker in slots:
+        for sock in worker.sockets.values():
+            sock.close()
+    # Workers first let their open tunnels finish
+    deadline = time.monotonic() + proxy.drain_timeout + SHUTDOWN_TIMEOUT
+    for worker in slots:
+        if worker.pid is None:
+            continue
+        while True:
+            pid, _ = os.waitpid(worker.pid, os.WNOHANG)
+            if pid:
+                break
+            if time.monotonic() > deadline:
+                logger.warning(f"Worker {worker.slot} did not stop, killing")
+                os.kill(worker.pid, signal.SIGKILL)
+                os.waitpid(worker.pid, 0)
+                break
+            time.sleep(0.1)
+    return aggregate_stats(slots)